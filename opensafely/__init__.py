@@ -1,12 +1,112 @@
 import argparse
+import atexit
+import importlib
 import sys
+import threading
+import time
 from pathlib import Path
 
-from opensafely import check, codelists, jupyter, pull, upgrade
-from opensafely._vendor.jobrunner.cli import local_run
-
 __version__ = Path(__file__).parent.joinpath("VERSION").read_text().strip()
 
+# The modules which implement each subcommand, along with the help shown for it
+# in the list of available commands (which should match the module's
+# DESCRIPTION). Some of these modules are slow to import, so we only import the
+# one for the subcommand which is actually being run.
+SUBCOMMANDS = {
+    "run": (
+        "opensafely._vendor.jobrunner.cli.local_run",
+        "Run project.yaml actions locally",
+    ),
+    "codelists": (
+        "opensafely.codelists",
+        "Commands for interacting with https://codelists.opensafely.org/",
+    ),
+    "pull": (
+        "opensafely.pull",
+        "Command for updating the docker images used to run MediciaSAFELY studies "
+        "locally",
+    ),
+    "upgrade": ("opensafely.upgrade", "Upgrade the opensafely cli tool."),
+    "check": ("opensafely.check", "Check the opensafely project for correctness"),
+    "jupyter": (
+        "opensafely.jupyter",
+        "Run a jupyter lab notebook using the OpenSAFELY environment",
+    ),
+}
+
+
+# The longest we'll wait, in seconds, for the checks for newer versions of
+# opensafely and its docker images before getting on with the command
+VERSION_CHECK_TIMEOUT = 1.0
+
+# How much longer, in seconds, we'll wait at exit for any checks which haven't
+# finished by then, so that they can cache what they find for next time
+VERSION_CHECK_EXIT_TIMEOUT = 2.0
+
+
+def check_versions(module_names, timeout=VERSION_CHECK_TIMEOUT):
+    """
+    Run the `get_version_warning()` function of each of the given modules in a
+    background thread and print any warnings they return within `timeout`
+    seconds. Any which take longer (e.g. because the network is slow) or which
+    fail are ignored, though those still running get a little longer to finish
+    at exit.
+    """
+    warnings = {}
+
+    def check(module_name):
+        try:
+            module = importlib.import_module(module_name)
+            warnings[module_name] = module.get_version_warning()
+        except Exception:
+            pass
+
+    threads = []
+    for module_name in module_names:
+        # Daemon threads, so that they never hold up exiting
+        thread = threading.Thread(target=check, args=(module_name,), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    join_threads(threads, timeout)
+    # Otherwise checks which are still running when a quick command finishes
+    # would be killed before they'd cached anything, and so every invocation
+    # would have to wait for them
+    if any(thread.is_alive() for thread in threads):
+        atexit.register(join_threads, threads, VERSION_CHECK_EXIT_TIMEOUT)
+
+    # Print in a consistent order, and only the warnings we've got so far
+    for module_name in module_names:
+        warning = warnings.get(module_name)
+        if warning:
+            print(warning)
+
+
+def join_threads(threads, timeout):
+    """Wait for all the threads to finish, but no longer than `timeout` seconds"""
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.join(max(deadline - time.monotonic(), 0))
+
+
+class SubcommandParser(argparse.ArgumentParser):
+    """
+    Parser for a subcommand which imports the module implementing it, and adds
+    the module's arguments, only when the subcommand is used
+    """
+
+    def __init__(self, *args, module_name=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.module_name = module_name
+        self.module = None
+
+    def parse_known_args(self, args=None, namespace=None):
+        if self.module_name and self.module is None:
+            self.module = importlib.import_module(self.module_name)
+            self.set_defaults(handles_unknown_args=False, function=self.module.main)
+            self.module.add_arguments(self)
+        return super().parse_known_args(args, namespace)
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -21,42 +121,28 @@ def main():
     )
 
     subparsers = parser.add_subparsers(
-        title="available commands", description="", metavar="COMMAND"
+        title="available commands",
+        description="",
+        metavar="COMMAND",
+        parser_class=SubcommandParser,
     )
 
     parser_help = subparsers.add_parser("help", help="Show this help message and exit")
     parser_help.set_defaults(function=show_help)
 
-    def add_subcommand(cmd, module):
-        subparser = subparsers.add_parser(cmd, help=module.DESCRIPTION)
-        subparser.set_defaults(
-            handles_unknown_args=False,
-            function=module.main,
-        )
-        module.add_arguments(subparser)
-
-    add_subcommand("run", local_run)
-    add_subcommand("codelists", codelists)
-    add_subcommand("pull", pull)
-    add_subcommand("upgrade", upgrade)
-    add_subcommand("check", check)
-    add_subcommand("jupyter", jupyter)
+    for cmd, (module_name, help) in SUBCOMMANDS.items():
+        subparsers.add_parser(cmd, help=help, module_name=module_name)
 
     # we version check before parse_args is called so that if a user is
     # following recent documentation but has an old opensafely installed,
     # there's some hint as to why their invocation is failing before being told
     # by argparse.
+    version_checks = []
     if len(sys.argv) == 1 or sys.argv[1] != "upgrade":
-        try:
-            upgrade.check_version()
-        except Exception:
-            pass
-
+        version_checks.append("opensafely.upgrade")
     if len(sys.argv) == 1 or sys.argv[1] != "pull":
-        try:
-            pull.check_version()
-        except Exception:
-            pass
+        version_checks.append("opensafely.pull")
+    check_versions(version_checks)
 
     # start by using looser parsing only known args, so we can get the sub command
     args, unknown = parser.parse_known_args()
@@ -75,7 +161,12 @@ def main():
     success = function(**kwargs)
 
     # if `run`ning locally, run `check` in warn mode
-    if function == local_run.main and "format-output-for-github" not in kwargs:
+    if (
+        function.__module__ == SUBCOMMANDS["run"][0]
+        and "format-output-for-github" not in kwargs
+    ):
+        from opensafely import check
+
         check.main(continue_on_error=True)
 
     sys.exit(0 if success is not False else 1)
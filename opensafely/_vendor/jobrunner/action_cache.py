@@ -0,0 +1,250 @@
+"""
+Content-addressed cache of action results for running locally
+
+Researchers often re-run actions whose code, inputs and image haven't changed
+(e.g. with `--force-run-dependencies`). Before starting a job we compute a key
+from everything which determines its outputs: the run command, the ID of the
+Docker image, the code and the contents of the input files. If we have a
+result stored under that key we restore its outputs and log file into the
+workspace instead of starting a container. Successful jobs have their results
+stored when they complete.
+
+The cache is only enabled when `config.LOCAL_ACTION_CACHE_DIR` is set, which
+`local_run` does. Once it grows beyond `config.LOCAL_ACTION_CACHE_MAX_SIZE`
+the least recently used entries are evicted.
+"""
+import hashlib
+import json
+import logging
+import os
+import shlex
+import shutil
+from pathlib import Path
+
+from opensafely._vendor.jobrunner import config
+from opensafely._vendor.jobrunner.lib import docker
+from opensafely._vendor.jobrunner.manage_jobs import (
+    METADATA_DIR,
+    copy_file,
+    delete_files,
+    get_high_privacy_workspace,
+    list_local_workspace_code,
+    list_outputs_from_action,
+)
+from opensafely._vendor.jobrunner.models import random_id
+
+log = logging.getLogger(__name__)
+
+ENTRY_FILE = "entry.json"
+LOG_FILE = "action.log"
+OUTPUTS_DIR = "outputs"
+
+# Keys of jobs which missed the cache, computed before they started, so that
+# we store their results against the code and inputs they actually ran with
+# rather than whatever is in the workspace by the time they finish
+_KEYS = {}
+
+# Maps (path, size, mtime) to content hash so we don't re-read unchanged files
+# for every action which uses them
+_FILE_HASHES = {}
+
+
+def is_enabled():
+    return config.LOCAL_ACTION_CACHE_DIR is not None
+
+
+def restore(job):
+    """
+    If there's a cached result for the job, restore its outputs and log file
+    into the workspace, update `job.outputs` and `job.image_id` to match and
+    return True. Otherwise return False.
+
+    A job is only looked up once: after a miss we just remember its key.
+    """
+    if not is_enabled() or job.id in _KEYS:
+        return False
+    try:
+        key = compute_key(job)
+    except Exception:
+        # Most likely something's missing, e.g. an input file, which will be
+        # reported properly when we try to start the job. Either way, the
+        # cache should never be the reason a job fails.
+        log.debug("Unable to compute cache key", exc_info=True)
+        return False
+    if key is None:
+        return False
+    _KEYS[job.id] = key
+    entry_dir = config.LOCAL_ACTION_CACHE_DIR / key
+    try:
+        entry = json.loads((entry_dir / ENTRY_FILE).read_text())
+    except (OSError, ValueError):
+        return False
+
+    log.info("Found cached results for action, restoring outputs")
+    workspace_dir = get_high_privacy_workspace(job.workspace)
+    outputs = entry["outputs"]
+    try:
+        for filename in outputs:
+            copy_file(entry_dir / OUTPUTS_DIR / filename, workspace_dir / filename)
+        copy_file(
+            entry_dir / LOG_FILE, workspace_dir / METADATA_DIR / f"{job.action}.log"
+        )
+    except OSError:
+        log.warning("Failed to restore cached results, running action instead")
+        log.debug("Restore failed", exc_info=True)
+        return False
+    # As in `finalise_job`, delete any outputs from the previous run which
+    # this one didn't produce
+    existing_files = list_outputs_from_action(job.workspace, job.action)
+    delete_files(workspace_dir, existing_files, files_to_keep=outputs.keys())
+    # Mark the entry as recently used
+    os.utime(entry_dir / ENTRY_FILE)
+    job.outputs = outputs
+    job.image_id = entry["image_id"]
+    return True
+
+
+def store(job):
+    """
+    Store the outputs and log file of a job which has just succeeded
+    """
+    key = _KEYS.pop(job.id, None)
+    if key is None:
+        return
+    cache_dir = config.LOCAL_ACTION_CACHE_DIR
+    entry_dir = cache_dir / key
+    if entry_dir.exists():
+        return
+    workspace_dir = get_high_privacy_workspace(job.workspace)
+    files = {
+        workspace_dir / METADATA_DIR / f"{job.action}.log": LOG_FILE,
+    }
+    for filename in job.output_files:
+        files[workspace_dir / filename] = Path(OUTPUTS_DIR, filename)
+    try:
+        size = sum(path.stat().st_size for path in files)
+        if size > config.LOCAL_ACTION_CACHE_MAX_SIZE:
+            log.debug("Results too large to cache")
+            return
+        # Build the entry alongside and then rename it into place, so that we
+        # never see partial entries
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_dir = cache_dir / f".tmp-{random_id()}"
+        try:
+            for source, dest in files.items():
+                dest = tmp_dir / dest
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy(source, dest)
+            entry = {
+                "action": job.action,
+                "outputs": job.outputs,
+                "image_id": job.image_id,
+                "size": size,
+            }
+            (tmp_dir / ENTRY_FILE).write_text(json.dumps(entry, indent=2))
+            tmp_dir.rename(entry_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    except OSError:
+        # Failing to cache a result is never worth failing the job over
+        log.warning("Failed to store results in cache")
+        log.debug("Store failed", exc_info=True)
+        return
+    evict(cache_dir, config.LOCAL_ACTION_CACHE_MAX_SIZE)
+
+
+def forget(job):
+    """
+    Drop the key of a job which won't be storing its results, i.e. one which
+    failed or was cancelled
+    """
+    _KEYS.pop(job.id, None)
+
+
+def evict(cache_dir, max_size):
+    """
+    Delete the least recently used entries until the cache is no larger than
+    `max_size` bytes
+    """
+    entries = []
+    for entry_dir in cache_dir.iterdir():
+        entry_file = entry_dir / ENTRY_FILE
+        try:
+            last_used = entry_file.stat().st_mtime
+            size = json.loads(entry_file.read_text())["size"]
+        except (OSError, ValueError, KeyError):
+            # Either not an entry or one still being built
+            continue
+        entries.append((last_used, size, entry_dir))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry_dir in sorted(entries, key=lambda entry: entry[0]):
+        if total_size <= max_size:
+            break
+        log.debug(f"Evicting cache entry {entry_dir.name}")
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= size
+
+
+def compute_key(job):
+    """
+    Return a hash of everything which determines the outputs of a job, or None
+    if its image isn't available locally
+    """
+    image = f"{config.DOCKER_REGISTRY}/{shlex.split(job.run_command)[0]}"
+    image_id = docker.image_id(image)
+    if image_id is None:
+        return None
+    workspace_dir = get_high_privacy_workspace(job.workspace)
+
+    digest = hashlib.sha256()
+
+    def add(*values):
+        for value in values:
+            digest.update(str(value).encode("utf-8"))
+            # Separator, so that values can't run into each other
+            digest.update(b"\0")
+
+    add(job.run_command, image_id, json.dumps(job.output_spec, sort_keys=True))
+
+    if job.action_repo_url and job.action_commit:
+        # Reusable actions get their code from a specific commit
+        add(job.action_repo_url, job.action_commit)
+    else:
+        for path in sorted(iter_code_files(workspace_dir)):
+            add(path.as_posix(), hash_file(workspace_dir / path))
+
+    input_files = []
+    for action in job.requires_outputs_from:
+        input_files.extend(list_outputs_from_action(job.workspace, action))
+    for filename in sorted(input_files):
+        add(Path(filename).as_posix(), hash_file(workspace_dir / filename))
+
+    return digest.hexdigest()
+
+
+def iter_code_files(workspace_dir):
+    """
+    Yield the relative paths of all the code files in the workspace (i.e. all
+    the files which get copied into the job's volume)
+    """
+    for path in list_local_workspace_code(workspace_dir):
+        full_path = workspace_dir / path
+        if not full_path.is_dir():
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(full_path):
+            for filename in filenames:
+                yield Path(dirpath, filename).relative_to(workspace_dir)
+
+
+def hash_file(path):
+    stat = path.stat()
+    cache_key = (str(path), stat.st_size, stat.st_mtime_ns)
+    if cache_key not in _FILE_HASHES:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        _FILE_HASHES[cache_key] = digest.hexdigest()
+    return _FILE_HASHES[cache_key]
+
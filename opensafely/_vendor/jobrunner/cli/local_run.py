@@ -85,6 +85,11 @@ def add_arguments(parser):
         help="Force the dependencies of the action to run, whether or not their outputs exist",
         action="store_true",
     )
+    parser.add_argument(
+        "--no-cache",
+        help="Always run actions, rather than restoring unchanged results from the cache",
+        action="store_true",
+    )
     parser.add_argument(
         "--project-dir",
         help="Project directory (default: current directory)",
@@ -98,6 +103,15 @@ def add_arguments(parser):
         help="Don't stop on first failed action",
         action="store_true",
     )
+    parser.add_argument(
+        "--parallel",
+        help=(
+            "Prepare and finalise up to N actions at once, and run at least N "
+            "at once, where their dependencies allow"
+        ),
+        type=int,
+        metavar="N",
+    )
     # This particularly useful in CI.
     parser.add_argument(
         "--timestamps",
@@ -128,6 +142,8 @@ def main(
     debug=False,
     timestamps=False,
     format_output_for_github=False,
+    no_cache=False,
+    parallel=None,
 ):
     if not docker_preflight_check():
         return False
@@ -162,6 +178,8 @@ def main(
             clean_up_docker_objects=(not debug),
             log_format=log_format,
             format_output_for_github=format_output_for_github,
+            use_cache=not no_cache,
+            parallel=parallel,
         )
     except KeyboardInterrupt:
         print("\nKilled by user")
@@ -195,14 +213,30 @@ def create_and_run_jobs(
     clean_up_docker_objects=True,
     log_format=LOCAL_RUN_FORMAT,
     format_output_for_github=False,
+    use_cache=True,
+    parallel=None,
 ):
     # Fiddle with the configuration to suit what we need for running local jobs
     docker.LABEL = docker_label
     # It's more helpful in this context to have things consistent
     config.RANDOMISE_JOB_ORDER = False
+    if parallel:
+        # Handle this many jobs concurrently, so that preparing and finalising
+        # them doesn't become the bottleneck, and make sure at least this many
+        # can run at once. The default number of workers may well be higher,
+        # in which case we leave it alone.
+        config.JOB_HANDLER_THREADS = parallel
+        config.MAX_WORKERS = max(config.MAX_WORKERS, parallel)
 
     config.HIGH_PRIVACY_WORKSPACES_DIR = project_dir.parent
     config.DATABASE_FILE = project_dir / "metadata" / "db.sqlite"
+    # The database lives in the researcher's own project directory, which may
+    # well be on a network or shared filesystem where WAL mode doesn't work,
+    # and only this process uses it
+    config.DATABASE_PROFILE = "compat"
+    config.LOCAL_ACTION_CACHE_DIR = (
+        project_dir / METADATA_DIR / ".action-cache" if use_cache else None
+    )
 
     config.TMP_DIR = temp_dir
     config.JOB_LOG_DIR = temp_dir / "logs"
@@ -323,6 +357,8 @@ def create_and_run_jobs(
     exit_condition = (
         no_jobs_remaining if continue_on_error else job_failed_or_none_remaining
     )
+    if parallel:
+        exit_condition = with_progress_summary(exit_condition)
     try:
         run_main(exit_callback=exit_condition)
     except KeyboardInterrupt:
@@ -334,11 +370,14 @@ def create_and_run_jobs(
     final_jobs = find_where(
         Job, state__in=[State.FAILED, State.SUCCEEDED], job_request_id=job_request.id
     )
-    # Always show failed jobs last, otherwise show in order run
+    # Always show failed jobs last, otherwise show in the order the jobs were
+    # created, which respects their dependencies. We avoid using the order
+    # they actually ran in as this can vary when running actions in parallel.
+    job_order = {job.id: i for i, job in enumerate(jobs)}
     final_jobs.sort(
         key=lambda job: (
             1 if job.state == State.FAILED else 0,
-            job.started_at or 0,
+            job_order.get(job.id, len(job_order)),
         )
     )
 
@@ -465,6 +504,29 @@ def job_failed_or_none_remaining(active_jobs):
     return len(active_jobs) == 0
 
 
+def with_progress_summary(exit_condition):
+    """
+    Wrap `exit_condition` so that, on each pass of the run loop, we print which
+    actions are running and which are waiting, whenever that changes
+    """
+    last_summary = None
+
+    def wrapper(active_jobs):
+        nonlocal last_summary
+        running = [job.action for job in active_jobs if job.state == State.RUNNING]
+        waiting = [job.action for job in active_jobs if job.state == State.PENDING]
+        summary = (running, waiting)
+        if summary != last_summary and active_jobs:
+            print(
+                f"=> Running: {', '.join(running) or '(none)'}; "
+                f"waiting: {', '.join(waiting) or '(none)'}"
+            )
+            last_summary = summary
+        return exit_condition(active_jobs)
+
+    return wrapper
+
+
 def filter_log_messages(record):
     """
     Not all log messages are useful in the local run context so to avoid noise
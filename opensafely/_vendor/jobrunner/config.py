@@ -24,6 +24,9 @@ GIT_REPO_DIR = WORKDIR / "repos"
 
 DATABASE_FILE = WORKDIR / "db.sqlite"
 DATABASE_SCHEMA_FILE = Path(__file__).parent / "schema.sql"
+# Which set of connection settings to use, see `CONNECTION_PROFILES` in
+# `lib/database.py`
+DATABASE_PROFILE = os.environ.get("DATABASE_PROFILE", "default")
 
 HIGH_PRIVACY_STORAGE_BASE = Path(
     os.environ.get("HIGH_PRIVACY_STORAGE_BASE", WORKDIR / "high_privacy")
@@ -46,6 +49,13 @@ PRIVATE_REPO_ACCESS_TOKEN = os.environ.get("PRIVATE_REPO_ACCESS_TOKEN", "")
 
 POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL", "5"))
 JOB_LOOP_INTERVAL = float(os.environ.get("JOB_LOOP_INTERVAL", "1.0"))
+# The run loop is woken by new jobs, state changes and containers exiting, so
+# it only needs to poll on a timer as a fallback to catch anything those
+# notifications miss. JOB_LOOP_INTERVAL is still used if we can't watch the
+# Docker event stream.
+JOB_LOOP_FALLBACK_INTERVAL = float(
+    os.environ.get("JOB_LOOP_FALLBACK_INTERVAL", "30.0")
+)
 
 BACKEND = os.environ.get("BACKEND", "expectations")
 if not _is_valid_backend_name(BACKEND):
@@ -110,6 +120,29 @@ if PRESTO_TLS_CERT_PATH:
 
 MAX_WORKERS = int(os.environ.get("MAX_WORKERS") or max(cpu_count() - 1, 1))
 
+# Number of jobs to handle concurrently in each pass of the run loop. Handling
+# a job can involve slow work (e.g. copying files in and out of volumes) so
+# when this is 1 that work is effectively serialized across all jobs.
+JOB_HANDLER_THREADS = int(os.environ.get("JOB_HANDLER_THREADS", "1"))
+
+# Number of processes to use when checking a job's output files for patient
+# IDs, which is CPU bound
+PATIENT_ID_SCAN_WORKERS = int(
+    os.environ.get("PATIENT_ID_SCAN_WORKERS") or max(cpu_count() - 1, 1)
+)
+
+# Maximum number of prepare/finalize tasks (copying code and files in and out
+# of volumes) which the local executor will run in the background at once
+MAX_BACKGROUND_TASKS = int(os.environ.get("MAX_BACKGROUND_TASKS", "4"))
+
+# Directory in which to cache the results of actions, keyed on their code,
+# inputs and image, so that unchanged actions don't have to be re-run. This is
+# only used when running locally, see `jobrunner/action_cache.py`.
+LOCAL_ACTION_CACHE_DIR = None
+LOCAL_ACTION_CACHE_MAX_SIZE = int(
+    os.environ.get("LOCAL_ACTION_CACHE_MAX_SIZE", 2 * 1024 * 1024 * 1024)
+)
+
 # This is a crude mechanism for preventing a single large JobRequest with lots
 # of associated Jobs from hogging all the resources. We want this configurable
 # because it's useful to be able to disable this during tests and when running
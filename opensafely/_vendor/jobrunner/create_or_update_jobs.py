@@ -5,11 +5,13 @@ It handles all logic connected with creating or updating Jobs in response to
 JobRequests. This includes fetching the code with git, validating the project
 and doing the necessary dependency resolution.
 """
+import dataclasses
 import logging
 import re
 import time
 
 from opensafely._vendor.jobrunner import config
+from opensafely._vendor.jobrunner.lib import wakeup
 from opensafely._vendor.jobrunner.lib.database import exists_where, insert, transaction, update_where
 from opensafely._vendor.jobrunner.lib.git import GitError, GitFileNotFoundError, read_file_from_repo
 from opensafely._vendor.jobrunner.lib.github_validators import (
@@ -87,7 +89,11 @@ def create_jobs(job_request):
     project_file = get_project_file(job_request)
     project = parse_and_validate_project_file(project_file)
     latest_jobs = get_latest_jobs_for_actions_in_project(job_request.workspace, project)
-    new_jobs = get_new_jobs_to_run(job_request, project, latest_jobs)
+    plan = plan_jobs(job_request, project, latest_jobs)
+    new_jobs = plan.jobs
+    if plan.critical_path:
+        log.info(f"Longest chain of jobs to run: {len(plan.critical_path)}")
+        log.debug(f"Longest chain: {' -> '.join(plan.critical_path)}")
     assert_new_jobs_created(new_jobs, latest_jobs)
     resolve_reusable_action_references(new_jobs)
     # There is a delay between getting the current jobs (which we fetch from
@@ -171,14 +177,7 @@ def get_new_jobs_to_run(job_request, project, current_jobs):
         current_jobs: list containing the most recent Job for each action in
             the workspace
     """
-    # Build a dict mapping action names to job instances
-    jobs_by_action = {job.action: job for job in current_jobs}
-    # Add new jobs to it by recursing through the dependency tree
-    for action in get_actions_to_run(job_request, project):
-        recursively_build_jobs(jobs_by_action, job_request, project, action)
-
-    # Pick out the new jobs we've added and return them
-    return [job for job in jobs_by_action.values() if job not in current_jobs]
+    return plan_jobs(job_request, project, current_jobs).jobs
 
 
 def get_actions_to_run(job_request, project):
@@ -189,50 +188,149 @@ def get_actions_to_run(job_request, project):
         return job_request.requested_actions
 
 
-def recursively_build_jobs(jobs_by_action, job_request, project, action):
+@dataclasses.dataclass
+class JobPlan:
+    # The new jobs to run, with every job after the jobs it waits for
+    jobs: list
+    # Maps the action of each new job to the number of jobs in the longest
+    # chain of unfinished jobs it has to wait for
+    depths: dict
+    # The actions in that longest chain, ending with the last to run
+    critical_path: list
+
+
+def plan_jobs(job_request, project, current_jobs):
     """
-    Recursively populate the `jobs_by_action` dict with jobs
+    Work out which new jobs to run in response to the supplied JobRequest
+
+    We walk the dependency graph once, depth first, visiting each action at
+    most once and stopping at actions whose existing jobs don't need re-running.
+    Actions are finished in post-order, so they come out in a valid order to
+    run them in, and an action we reach again while still visiting its
+    dependencies means the project's `needs` form a cycle.
 
     Args:
-        jobs_by_action: A dict mapping action ID strings to Job instances
-        job_request: An instance of JobRequest representing the job request.
-        project: A dict representing the project.
-        action: The string ID of the action to be added as a job.
-    """
-    existing_job = jobs_by_action.get(action)
-    if existing_job and not job_should_be_rerun(job_request, existing_job):
-        return
+        job_request: JobRequest instance
+        project: dict representing the parsed project file from the JobRequest
+        current_jobs: list containing the most recent Job for each action in
+            the workspace
 
-    action_spec = get_action_specification(project, action)
+    Returns:
+        A JobPlan instance.
 
-    # Walk over the dependencies of this action, creating any necessary jobs,
-    # and ensure that this job waits for its dependencies to finish before it
-    # starts
-    wait_for_job_ids = []
-    for required_action in action_spec.needs:
-        recursively_build_jobs(jobs_by_action, job_request, project, required_action)
-        required_job = jobs_by_action[required_action]
-        if required_job.state in [State.PENDING, State.RUNNING]:
+    Raises:
+        ProjectValidationError: The project's `needs` form a cycle.
+    """
+    jobs_by_action = {job.action: job for job in current_jobs}
+    action_specs = get_action_specs_to_run(job_request, project, jobs_by_action)
+
+    now = int(time.time())
+    jobs = []
+    depths = {}
+    # The dependency at the end of the longest chain each action waits for
+    longest_needs = {}
+    for action, action_spec in action_specs.items():
+        # Ensure that this job waits for its dependencies to finish before it
+        # starts. Because the specs are in order any new jobs for them have
+        # already been created.
+        wait_for_job_ids = []
+        depth = 0
+        for required_action in action_spec.needs:
+            required_job = jobs_by_action[required_action]
+            if required_job.state not in [State.PENDING, State.RUNNING]:
+                continue
             wait_for_job_ids.append(required_job.id)
+            if depths.get(required_action, 0) + 1 > depth:
+                depth = depths.get(required_action, 0) + 1
+                longest_needs[action] = required_action
+        depths[action] = depth
+
+        job = Job(
+            job_request_id=job_request.id,
+            state=State.PENDING,
+            repo_url=job_request.repo_url,
+            commit=job_request.commit,
+            workspace=job_request.workspace,
+            database_name=job_request.database_name,
+            action=action,
+            wait_for_job_ids=wait_for_job_ids,
+            requires_outputs_from=action_spec.needs,
+            run_command=action_spec.run,
+            output_spec=action_spec.outputs,
+            created_at=now,
+            updated_at=now,
+        )
+        jobs_by_action[action] = job
+        jobs.append(job)
+
+    critical_path = []
+    action = max(depths, key=depths.get, default=None)
+    while action is not None:
+        critical_path.append(action)
+        action = longest_needs.get(action)
+    critical_path.reverse()
+
+    return JobPlan(jobs=jobs, depths=depths, critical_path=critical_path)
 
-    job = Job(
-        job_request_id=job_request.id,
-        state=State.PENDING,
-        repo_url=job_request.repo_url,
-        commit=job_request.commit,
-        workspace=job_request.workspace,
-        database_name=job_request.database_name,
-        action=action,
-        wait_for_job_ids=wait_for_job_ids,
-        requires_outputs_from=action_spec.needs,
-        run_command=action_spec.run,
-        output_spec=action_spec.outputs,
-        created_at=int(time.time()),
-        updated_at=int(time.time()),
-    )
 
-    # Add it to the dictionary of scheduled jobs
-    jobs_by_action[action] = job
+def get_action_specs_to_run(job_request, project, jobs_by_action):
+    """
+    Return a dict mapping each action which needs a new job to its
+    ActionSpecification, with every action after the actions it needs
+
+    Args:
+        job_request: An instance of JobRequest representing the job request.
+        project: A dict representing the project.
+        jobs_by_action: A dict mapping action ID strings to the latest Job for
+            that action
+    """
+    action_specs = {}
+    # Actions we've finished with, whether or not they need a new job
+    visited = set()
+    # The actions we're part way through visiting, each with an iterator over
+    # the actions it needs which we've still to visit. Every action here needs
+    # the one after it.
+    stack = []
+    on_stack = set()
+
+    def visit(action):
+        existing_job = jobs_by_action.get(action)
+        if existing_job and not job_should_be_rerun(job_request, existing_job):
+            visited.add(action)
+            return
+        action_spec = get_action_specification(project, action)
+        stack.append((action, action_spec, iter(action_spec.needs)))
+        on_stack.add(action)
+
+    for action in get_actions_to_run(job_request, project):
+        if action in visited:
+            continue
+        visit(action)
+        while stack:
+            action, action_spec, needs = stack[-1]
+            required_action = next(needs, None)
+            if required_action is None:
+                stack.pop()
+                on_stack.remove(action)
+                visited.add(action)
+                action_specs[action] = action_spec
+            elif required_action in visited:
+                continue
+            elif required_action in on_stack:
+                raise_dependency_cycle_error(stack, required_action)
+            else:
+                visit(required_action)
+
+    return action_specs
+
+
+def raise_dependency_cycle_error(stack, action):
+    actions = [stack_action for stack_action, _, _ in stack]
+    cycle = actions[actions.index(action) :] + [action]
+    raise ProjectValidationError(
+        f"Action '{action}' depends on itself through its `needs` config:\n"
+        + " -> ".join(cycle)
+    )
 
 
 def job_should_be_rerun(job_request, job):
@@ -338,6 +436,7 @@ def insert_into_database(job_request, jobs):
         insert(SavedJobRequest(id=job_request.id, original=job_request.original))
         for job in jobs:
             insert(job)
+    wakeup.notify()
 
 
 def related_jobs_exist(job_request):
@@ -354,3 +453,4 @@ def set_cancelled_flag_for_actions(job_request_id, actions):
         job_request_id=job_request_id,
         action__in=actions,
     )
+    wakeup.notify()
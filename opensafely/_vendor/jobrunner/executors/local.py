@@ -1,8 +1,9 @@
 import json
 import logging
 import subprocess
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
+from opensafely._vendor.jobrunner import config
 from opensafely._vendor.jobrunner.job_executor import (
     ExecutorAPI,
     ExecutorState,
@@ -11,24 +12,23 @@ from opensafely._vendor.jobrunner.job_executor import (
     JobStatus,
     Privacy,
 )
-from opensafely._vendor.jobrunner.lib import docker
+from opensafely._vendor.jobrunner.lib import docker, wakeup
+from opensafely._vendor.jobrunner.lib.log_utils import set_log_context
 from opensafely._vendor.jobrunner.lib.string_utils import tabulate
 # ideally, these should be moved into this module when the old implementation
 # is removed
 from opensafely._vendor.jobrunner.manage_jobs import (
     METADATA_DIR,
-    TIMESTAMP_REFERENCE_FILE,
     cleanup_job,
     container_name,
     copy_file,
-    copy_git_commit_to_volume,
-    copy_local_workspace_to_volume,
     ensure_overwritable,
     get_container_metadata,
     get_high_privacy_archive,
     get_high_privacy_workspace,
     get_log_dir,
     get_medium_privacy_workspace,
+    populate_volume,
     volume_name,
     write_manifest_file,
 )
@@ -37,6 +37,15 @@ from opensafely._vendor.jobrunner.manage_jobs import (
 RESULTS = {}
 LABEL = "jobrunner-local"
 
+# Preparing and finalizing a job can involve copying very large files in and
+# out of volumes, so we run these tasks in the background to avoid blocking
+# the run loop. These map job ids to the Future of any task started for them.
+TASK_POOL = ThreadPoolExecutor(
+    max_workers=config.MAX_BACKGROUND_TASKS, thread_name_prefix="task"
+)
+PREPARE_TASKS = {}
+FINALIZE_TASKS = {}
+
 log = logging.getLogger(__name__)
 
 
@@ -82,17 +91,7 @@ class LocalDockerAPI(ExecutorAPI):
                 f"Docker image {job.image} is not currently available",
             )
 
-        try:
-            prepare_job(job)
-        except docker.DockerDiskSpaceError as e:
-            log.exception(str(e))
-            return JobStatus(
-                ExecutorState.ERROR, "Out of disk space, please try again later"
-            )
-
-        # technically, we're acutally PREPARED, as we did in synchronously, but
-        # the loop code is expecting PREPARING, so return that. The next time
-        # around the loop, it will pick up that it is PREPARED, and move on.
+        PREPARE_TASKS[job.id] = run_in_background(prepare_job, job)
         return JobStatus(ExecutorState.PREPARING)
 
     def execute(self, job):
@@ -123,11 +122,7 @@ class LocalDockerAPI(ExecutorAPI):
         if current.state != ExecutorState.EXECUTED:
             return current
 
-        try:
-            finalize_job(job)
-        except LocalDockerError as exc:
-            return JobStatus(ExecutorState.ERROR, f"failed to finalize job: {exc}")
-
+        FINALIZE_TASKS[job.id] = run_in_background(finalize_job, job)
         return JobStatus(ExecutorState.FINALIZING)
 
     def terminate(self, job):
@@ -137,28 +132,51 @@ class LocalDockerAPI(ExecutorAPI):
     def cleanup(self, job):
         cleanup_job(job)
         RESULTS.pop(job.id, None)
+        PREPARE_TASKS.pop(job.id, None)
+        FINALIZE_TASKS.pop(job.id, None)
         return JobStatus(ExecutorState.UNKNOWN)
 
     def get_status(self, job):
+        # Background tasks take precedence over what we can see in Docker, as
+        # while they're running the container and volume are in an
+        # intermediate state
+        task_status = get_background_task_status(job)
+        if task_status is not None:
+            return task_status
+
         name = container_name(job)
         job_running = docker.container_inspect(
             name, "State.Running", none_if_not_exists=True
         )
+        return get_container_status(
+            job, job_running, lambda: docker.volume_exists(volume_name(job))
+        )
 
-        if job_running is None:
-            # no container for this job found
+    def get_statuses(self, jobs):
+        # We check the background tasks before taking the snapshot below. A task
+        # which finishes after we've checked it is still reported as running,
+        # and we'll see its effects next time. Whereas if it finished after the
+        # snapshot, the snapshot wouldn't show them.
+        statuses = {}
+        for job in jobs:
+            task_status = get_background_task_status(job)
+            if task_status is not None:
+                statuses[job.id] = task_status
+        jobs = [job for job in jobs if job.id not in statuses]
+        if not jobs:
+            return statuses
+
+        # Rather than inspecting each job's container and volume, we take a
+        # snapshot of all of them in two calls and answer from that
+        containers = docker.list_containers(docker.LABEL)
+        volumes = docker.list_volumes(docker.LABEL)
+        for job in jobs:
+            job_running = containers.get(container_name(job))
             volume = volume_name(job)
-            if docker.volume_exists(volume):
-                return JobStatus(ExecutorState.PREPARED)
-            else:
-                return JobStatus(ExecutorState.UNKNOWN)
-
-        elif job_running:
-            return JobStatus(ExecutorState.EXECUTING)
-        elif job.id in RESULTS:
-            return JobStatus(ExecutorState.FINALIZED)
-        else:  # container present but not running, i.e. finished
-            return JobStatus(ExecutorState.EXECUTED)
+            statuses[job.id] = get_container_status(
+                job, job_running, lambda: volume in volumes
+            )
+        return statuses
 
     def get_results(self, job):
         if job.id not in RESULTS:
@@ -186,43 +204,103 @@ class LocalDockerAPI(ExecutorAPI):
         return errors
 
 
-def prepare_job(job):
-    """Creates a volume and populates it with the repo and input files."""
-    workspace_dir = get_high_privacy_workspace(job.workspace)
+def get_container_status(job, job_running, volume_exists):
+    """
+    Determine a job's status from whether its container is running (None if it
+    has no container) and, if necessary, whether its volume exists (a callable
+    so we only check when we need to)
+    """
+    if job_running is None:
+        # no container for this job found
+        if volume_exists():
+            return JobStatus(ExecutorState.PREPARED)
+        else:
+            return JobStatus(ExecutorState.UNKNOWN)
 
-    volume = volume_name(job)
-    docker.create_volume(volume, get_job_labels(job))
+    elif job_running:
+        return JobStatus(ExecutorState.EXECUTING)
+    elif job.id in RESULTS:
+        return JobStatus(ExecutorState.FINALIZED)
+    else:  # container present but not running, i.e. finished
+        return JobStatus(ExecutorState.EXECUTED)
 
-    # `docker cp` can't create parent directories for us so we make sure all
-    # these directories get created when we copy in the code
-    extra_dirs = set(Path(filename).parent for filename in job.inputs)
 
+def run_in_background(task, job):
+    """Submit `task(job)` to the background pool, preserving the log context"""
+    log_context = dict(set_log_context.current_context)
+
+    def run_task():
+        with set_log_context(**log_context):
+            try:
+                task(job)
+            finally:
+                # Let the run loop pick up the job's new state straight away
+                wakeup.notify()
+
+    return TASK_POOL.submit(run_task)
+
+
+def get_background_task_status(job):
+    """
+    Return the status implied by any background task for the job, or None if
+    its state should be determined from Docker as usual
+    """
+    return get_task_status(
+        PREPARE_TASKS.get(job.id), ExecutorState.PREPARING, "prepare"
+    ) or get_task_status(
+        FINALIZE_TASKS.get(job.id), ExecutorState.FINALIZING, "finalize"
+    )
+
+
+def get_task_status(future, running_state, task_name):
+    """
+    Return the status implied by a background task, or None if there is no task
+    or it completed successfully (in which case the job's state can be
+    determined as usual)
+    """
+    if future is None:
+        return None
+    if not future.done():
+        return JobStatus(running_state)
+    # Anything other than the errors we expect is re-raised as an internal
+    # error, exactly as if the task had been run synchronously
     try:
-        if job.study.git_repo_url and job.study.commit:
-            copy_git_commit_to_volume(
-                volume, job.study.git_repo_url, job.study.commit, extra_dirs
-            )
-        else:
-            # We only encounter jobs without a repo or commit when using the
-            # "local_run" command to execute uncommitted local code
-            copy_local_workspace_to_volume(volume, workspace_dir, extra_dirs)
-    except subprocess.CalledProcessError:
-        raise LocalDockerError(
-            f"Could not checkout commit {job.study.commit} from {job.study.git_repo_url}"
+        future.result()
+    except docker.DockerDiskSpaceError as e:
+        log.exception(str(e))
+        return JobStatus(
+            ExecutorState.ERROR, "Out of disk space, please try again later"
         )
+    except LocalDockerError as exc:
+        return JobStatus(ExecutorState.ERROR, f"failed to {task_name} job: {exc}")
+    return None
+
+
+def prepare_job(job):
+    """Creates a volume and populates it with the repo and input files."""
+    workspace_dir = get_high_privacy_workspace(job.workspace)
 
     for filename in job.inputs:
-        log.info(f"Copying input file: {filename}")
         if not (workspace_dir / filename).exists():
             raise LocalDockerError(
                 f"The file {filename} doesn't exist in workspace {job.workspace} as requested for job {job.id}"
             )
-        docker.copy_to_volume(volume, workspace_dir / filename, filename)
 
-    # Hack: see `get_unmatched_outputs`. For some reason this requires a
-    # non-empty file so copying `os.devnull` didn't work.
-    some_non_empty_file = Path(__file__)
-    docker.copy_to_volume(volume, some_non_empty_file, TIMESTAMP_REFERENCE_FILE)
+    volume = volume_name(job)
+    docker.create_volume(volume, get_job_labels(job))
+
+    try:
+        populate_volume(
+            volume,
+            workspace_dir,
+            job.study.git_repo_url,
+            job.study.commit,
+            job.inputs,
+        )
+    except subprocess.CalledProcessError:
+        raise LocalDockerError(
+            f"Could not checkout commit {job.study.commit} from {job.study.git_repo_url}"
+        )
     return volume
 
 
@@ -1,5 +1,5 @@
 import logging
-from typing import Callable, List
+from typing import Callable, List, Mapping
 
 from opensafely._vendor.jobrunner.job_executor import (
     ExecutorAPI,
@@ -25,6 +25,13 @@ class LoggingExecutor(ExecutorAPI):
         self._add_logging(self._wrapped.terminate)
         self._add_logging(self._wrapped.cleanup)
 
+    def get_statuses(self, jobs: List[JobDefinition]) -> Mapping[str, JobStatus]:
+        statuses = self._wrapped.get_statuses(jobs)
+        for job in jobs:
+            if job.id in statuses:
+                self._log_state_change(job, statuses[job.id])
+        return statuses
+
     def get_results(self, job: JobDefinition) -> JobResults:
         return self._wrapped.get_results(job)
 
@@ -34,13 +41,16 @@ class LoggingExecutor(ExecutorAPI):
     def _add_logging(self, method: Callable[[JobDefinition], JobStatus]):
         def wrapper(job: JobDefinition) -> JobStatus:
             status = method(job)
-            if self._is_new_state(job, status.state):
-                self._write_log(job, status)
-                self._state_cache[job.id] = status.state
+            self._log_state_change(job, status)
             return status
 
         setattr(self, method.__name__, wrapper)
 
+    def _log_state_change(self, job, status):
+        if self._is_new_state(job, status.state):
+            self._write_log(job, status)
+            self._state_cache[job.id] = status.state
+
     def _is_new_state(self, job, state):
         return job.id not in self._state_cache or self._state_cache[job.id] != state
 
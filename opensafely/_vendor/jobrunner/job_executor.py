@@ -211,7 +211,8 @@ class ExecutorAPI:
 
         1. Check the job is known to the system. If not, return the UNKNOWN state.
 
-        2. Return the current state of the job from the executors perspective.
+        2. Return the current state of the job from the executors perspective. If a prepare or finalize task has
+           failed, return the ERROR state with an appropriate message.
 
         This should return a JobStatus with the appropriate state for the job. It is polled by job-runner to track the
         completion of the various tasks.
@@ -222,6 +223,18 @@ class ExecutorAPI:
 
         """
 
+    def get_statuses(self, jobs: List[JobDefinition]) -> Mapping[str, JobStatus]:
+        """
+        Return the current status of several jobs, as a dict mapping job ids to JobStatus.
+
+        This is called once per loop with every active job, so that implementations can fetch the state of all of them
+        in a single batch rather than making a round trip per job. It has the same requirements as get_status(), and
+        any job missing from the returned dict will have its status fetched individually instead.
+
+        The default implementation simply calls get_status() for each job.
+        """
+        return {job.id: self.get_status(job) for job in jobs}
+
     def get_results(self, job: JobDefinition) -> JobResults:
         """
         Return the finalized results for a job.
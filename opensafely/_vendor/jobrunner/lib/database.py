@@ -9,6 +9,7 @@ surface area of this module is sufficiently small that swapping it out
 shouldn't be too large a job.
 """
 import dataclasses
+import functools
 import json
 import sqlite3
 import threading
@@ -18,13 +19,52 @@ from opensafely._vendor.jobrunner import config
 
 CONNECTION_CACHE = threading.local()
 
+# PRAGMAs applied to every new connection, selected by `config.DATABASE_PROFILE`
+#
+# The sync, run and stats threads all share the database, and most writes are
+# small autocommitted updates (e.g. status messages). In the default rollback
+# journal mode each of those is an fsync'd transaction which blocks readers,
+# so by default we use WAL mode, in which readers and the writer don't block
+# each other, with `synchronous=NORMAL`, which only syncs at checkpoints. The
+# database remains consistent after a power loss, but the most recent commits
+# may be lost. The "compat" profile restores SQLite's own defaults, e.g. for
+# filesystems where WAL isn't supported, and we fall back to it whenever
+# SQLite declines to switch to WAL mode.
+# See: https://www.sqlite.org/wal.html
+CONNECTION_PROFILES = {
+    "default": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        # milliseconds to wait for a lock before raising "database is locked"
+        "busy_timeout": 5000,
+        "mmap_size": 64 * 1024 * 1024,
+    },
+    "compat": {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+        "mmap_size": 0,
+    },
+}
+
+# Changes to apply to existing databases, in order. New databases are created
+# directly from `schema.sql`, which must therefore always reflect the result of
+# applying every migration. We use SQLite's `user_version` to record how many
+# migrations a database has had applied, so this list must only ever be
+# appended to.
+MIGRATIONS = [
+    # 1: supports `find_latest_by(Job, "action", "created_at", workspace=...)`
+    """
+    CREATE INDEX IF NOT EXISTS idx_job__workspace_action_created_at
+    ON job (workspace, action, created_at)
+    """,
+]
+
 
 def insert(item):
     table = item.__tablename__
     fields = dataclasses.fields(item)
-    columns = ", ".join(escape(field.name) for field in fields)
-    placeholders = ", ".join(["?"] * len(fields))
-    sql = f"INSERT INTO {escape(table)} ({columns}) VALUES({placeholders})"
+    sql = insert_sql(table, tuple(field.name for field in fields))
     get_connection().execute(sql, encode_field_values(fields, item))
 
 
@@ -42,24 +82,51 @@ def update_where(itemclass, update_dict, **query_params):
     table = itemclass.__tablename__
     fields = [f for f in dataclasses.fields(itemclass) if f.name in update_dict]
     assert len(fields) == len(update_dict)
-    updates = ", ".join(f"{escape(field.name)} = ?" for field in fields)
     update_params = encode_field_values(fields, update_dict)
     where, where_params = query_params_to_sql(query_params)
-    get_connection().execute(
-        f"UPDATE {escape(table)} SET {updates} WHERE {where}",
-        update_params + where_params,
-    )
+    sql = update_sql(table, tuple(field.name for field in fields), where)
+    get_connection().execute(sql, update_params + where_params)
 
 
 def find_where(itemclass, **query_params):
     table = itemclass.__tablename__
     fields = dataclasses.fields(itemclass)
     where, params = query_params_to_sql(query_params)
-    sql = f"SELECT * FROM {escape(table)} WHERE {where}"
+    sql = select_sql(table, where)
     cursor = get_connection().execute(sql, params)
     return [itemclass(*decode_field_values(fields, row)) for row in cursor]
 
 
+def find_latest_by(itemclass, partition_by, order_by, **query_params):
+    """
+    Like `find_where` but returns only the row with the greatest `order_by`
+    value for each distinct value of `partition_by`, ordered by
+    `partition_by`. Ties are broken in favour of the earliest inserted row.
+    """
+    table = itemclass.__tablename__
+    fields = dataclasses.fields(itemclass)
+    where, params = query_params_to_sql(query_params)
+    if sqlite3.sqlite_version_info < (3, 25, 0):
+        # Window functions aren't available so we have to do it the slow way
+        return _find_latest_by_in_python(
+            find_where(itemclass, **query_params), partition_by, order_by
+        )
+    sql = latest_by_sql(table, partition_by, order_by, where)
+    cursor = get_connection().execute(sql, params)
+    return [itemclass(*decode_field_values(fields, row)) for row in cursor]
+
+
+def _find_latest_by_in_python(items, partition_by, order_by):
+    latest = {}
+    for item in items:
+        key = getattr(item, partition_by)
+        if key not in latest or getattr(item, order_by) > getattr(
+            latest[key], order_by
+        ):
+            latest[key] = item
+    return [latest[key] for key in sorted(latest)]
+
+
 def find_all(itemclass):
     return find_where(itemclass)
 
@@ -142,41 +209,135 @@ def get_connection_from_file(filename):
     conn.isolation_level = None
     # Support dict-like access to rows
     conn.row_factory = sqlite3.Row
+    apply_profile(conn, config.DATABASE_PROFILE)
     schema_count = list(conn.execute("SELECT COUNT(*) FROM sqlite_master"))[0][0]
     if schema_count == 0:
         with open(config.DATABASE_SCHEMA_FILE) as f:
             schema_sql = f.read()
         conn.executescript(schema_sql)
+        conn.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+    else:
+        migrate(conn)
     return conn
 
 
+def apply_profile(conn, profile):
+    for pragma, value in CONNECTION_PROFILES[profile].items():
+        result = conn.execute(f"PRAGMA {pragma} = {value}").fetchone()
+        # Setting the journal mode returns the mode actually in use, which
+        # isn't WAL if the filesystem (or an in-memory database) can't support
+        # it. `synchronous=NORMAL` is only safe in WAL mode.
+        if (
+            pragma == "journal_mode"
+            and profile != "compat"
+            and result[0].lower() != value.lower()
+        ):
+            apply_profile(conn, "compat")
+            return
+
+
+def migrate(conn):
+    """
+    Apply any migrations which this database doesn't yet have
+    """
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= len(MIGRATIONS):
+        return
+    # Take the write lock before re-checking the version so that other
+    # connections can't apply the same migrations concurrently
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for version, sql in enumerate(MIGRATIONS[version:], start=version + 1):
+            conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {version}")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+# The SQL for any given query depends only on the table, the fields involved
+# and the "shape" of the WHERE clause (which fields, and how many values in any
+# `__in` lists), so we build each distinct statement once and re-use the
+# string. As well as saving the string building on every call, handing SQLite
+# the identical string lets it re-use its own compiled statement (see the
+# `cached_statements` argument to `sqlite3.connect`).
+
+
+@functools.lru_cache(maxsize=256)
+def insert_sql(table, field_names):
+    columns = ", ".join(escape(name) for name in field_names)
+    placeholders = ", ".join(["?"] * len(field_names))
+    return f"INSERT INTO {escape(table)} ({columns}) VALUES({placeholders})"
+
+
+@functools.lru_cache(maxsize=256)
+def update_sql(table, field_names, where):
+    updates = ", ".join(f"{escape(name)} = ?" for name in field_names)
+    return f"UPDATE {escape(table)} SET {updates} WHERE {where}"
+
+
+@functools.lru_cache(maxsize=256)
+def select_sql(table, where):
+    return f"SELECT * FROM {escape(table)} WHERE {where}"
+
+
+@functools.lru_cache(maxsize=256)
+def latest_by_sql(table, partition_by, order_by, where):
+    partition_by, order_by = escape(partition_by), escape(order_by)
+    return f"""
+        SELECT * FROM (
+            SELECT *, ROW_NUMBER() OVER (
+                PARTITION BY {partition_by} ORDER BY {order_by} DESC, rowid
+            ) AS _row_number
+            FROM {escape(table)} WHERE {where}
+        )
+        WHERE _row_number = 1
+        ORDER BY {partition_by}
+    """
+
+
 def query_params_to_sql(params):
     """
     Turn a dict of query parameters into a pair of (SQL string, SQL values).
     All parameters are implicitly ANDed together, and there's a bit of magic to
     handle `field__in=list_of_values` queries, LIKE queries and Enum classes.
     """
-    parts = []
+    shape = []
     values = []
     for key, value in params.items():
+        if key.endswith("__in"):
+            shape.append((key, len(value)))
+            values.extend(value)
+        else:
+            shape.append((key, None))
+            values.append(value)
+    # Bit of a hack: convert any Enum instances to their values so we can use
+    # them in querying
+    values = [v.value if isinstance(v, Enum) else v for v in values]
+    return where_sql(tuple(shape)), values
+
+
+@functools.lru_cache(maxsize=256)
+def where_sql(shape):
+    """
+    Build the WHERE clause for a tuple of (key, length) pairs, where length is
+    the number of values for `__in` queries and None otherwise
+    """
+    parts = []
+    for key, length in shape:
         if key.endswith("__in"):
             field = key[:-4]
-            placeholders = ", ".join(["?"] * len(value))
+            placeholders = ", ".join(["?"] * length)
             parts.append(f"{escape(field)} IN ({placeholders})")
-            values.extend(value)
         elif key.endswith("__like"):
             field = key[:-6]
             parts.append(f"{escape(field)} LIKE ?")
-            values.append(value)
         else:
             parts.append(f"{escape(key)} = ?")
-            values.append(value)
-    # Bit of a hack: convert any Enum instances to their values so we can use
-    # them in querying
-    values = [v.value if isinstance(v, Enum) else v for v in values]
     if not parts:
         parts = ["1 = 1"]
-    return " AND ".join(parts), values
+    return " AND ".join(parts)
 
 
 def escape(s):
@@ -1,14 +1,27 @@
 """
 Utility functions for interacting with Docker
+
+Where we can, the most frequently used of these talk to the Docker daemon
+directly over its unix socket (see `docker_api`), otherwise they shell out to
+the `docker` CLI. Either way they raise the same exceptions.
 """
 import json
+import logging
 import os
+import posixpath
 import re
+import socket
 import subprocess
+import tarfile
+import threading
 
 from opensafely._vendor.jobrunner import config
+from opensafely._vendor.jobrunner.lib import docker_api
+from opensafely._vendor.jobrunner.lib.docker_api import DockerAPIError, quote_name
 from opensafely._vendor.jobrunner.lib.subprocess_utils import subprocess_run
 
+log = logging.getLogger(__name__)
+
 # Docker requires a container in order to interact with volumes, but it doesn't
 # much matter what it is for our purposes as long as it has `sh` and `find`
 MANAGEMENT_CONTAINER_IMAGE = f"{config.DOCKER_REGISTRY}/busybox"
@@ -78,6 +91,25 @@ def docker(docker_args, timeout=DEFAULT_TIMEOUT, **kwargs):
             raise
 
 
+def api_request(method, path, allowed_statuses=(), timeout=DEFAULT_TIMEOUT, **kwargs):
+    """
+    Make a request to the Docker Engine API, raising the same exceptions as
+    `docker()` does for timeouts and lack of disk space, and DockerAPIError for
+    any other unsuccessful response whose status isn't in `allowed_statuses`
+    """
+    client = docker_api.get_client()
+    try:
+        response = client.request(method, path, timeout=timeout, **kwargs)
+    except socket.timeout as e:
+        raise DockerTimeoutError from e
+    if response.status < 300 or response.status in allowed_statuses:
+        return response
+    message = response.message
+    if ": no space left on device" in message:
+        raise DockerDiskSpaceError(message)
+    raise DockerAPIError(response.status, message)
+
+
 def create_volume(volume_name, labels=None):
     """
     Creates the named volume and also creates (but does not start) a "manager"
@@ -109,10 +141,19 @@ def create_volume(volume_name, labels=None):
         # handle this manually here.
         if e.returncode != 125 or b"is already in use by container" not in e.stderr:
             raise
+    except DockerAPIError as e:
+        # As above: 409 Conflict means the manager container already exists
+        if e.status != 409:
+            raise
 
 
 def volume_exists(volume_name):
     """Does the given volume exist?"""
+    if docker_api.get_client():
+        response = api_request(
+            "GET", f"/volumes/{quote_name(volume_name)}", allowed_statuses=(404,)
+        )
+        return response.status != 404
     try:
         docker(["volume", "inspect", volume_name], check=True, capture_output=True)
     except subprocess.CalledProcessError:
@@ -158,6 +199,25 @@ def copy_to_volume(volume_name, source, dest, timeout=None):
     As this command can potentially take a long time with large files it does
     not, by default, have any timeout.
     """
+    if docker_api.get_client():
+        if source.is_dir():
+            # Add the directory's children individually, rather than the
+            # directory itself, so we don't clobber the destination
+            # directory's permissions
+            def build_archive(tar):
+                for child in sorted(source.iterdir()):
+                    tar.add(child, arcname=child.name)
+
+            dest_dir = dest
+        else:
+
+            def build_archive(tar):
+                tar.add(source, arcname=posixpath.basename(dest))
+
+            dest_dir = posixpath.dirname(dest)
+        put_archive(volume_name, build_archive, dest_dir, timeout=timeout)
+        return
+
     if source.is_dir():
         # Ensure the *contents* of the directory are copied, rather than the
         # directory itself. See:
@@ -175,6 +235,82 @@ def copy_to_volume(volume_name, source, dest, timeout=None):
     )
 
 
+def put_archive(volume_name, build_archive, dest=".", timeout=None):
+    """
+    Stream a tar archive, written by calling `build_archive(tarfile)`, into the
+    named volume and extract it at `dest`. As with `docker cp` parent
+    directories of `dest` must already exist.
+
+    Note that when talking to the Docker API `timeout` applies to each read or
+    write on the socket, whereas with the CLI it applies to the whole transfer.
+    """
+    path = posixpath.normpath(f"{VOLUME_MOUNT_POINT}/{dest}")
+    with TarStream(build_archive) as stream:
+        if docker_api.get_client():
+            api_request(
+                "PUT",
+                f"/containers/{quote_name(manager_name(volume_name))}/archive",
+                params={"path": path},
+                body=stream,
+                timeout=timeout,
+            )
+        else:
+            # `docker cp` accepts a tar archive on stdin if the source is "-"
+            docker(
+                ["cp", "-", f"{manager_name(volume_name)}:{path}"],
+                stdin=stream,
+                check=True,
+                capture_output=True,
+                timeout=timeout,
+            )
+
+
+class TarStream:
+    """
+    Readable file-like object producing a tar archive, which is written by
+    `build_archive` in a background thread so it can be streamed without first
+    being assembled on disk or in memory
+    """
+
+    def __init__(self, build_archive):
+        self.build_archive = build_archive
+        self.error = None
+        read_fd, write_fd = os.pipe()
+        self._reader = os.fdopen(read_fd, "rb")
+        self._writer = os.fdopen(write_fd, "wb")
+        self._thread = threading.Thread(target=self._write, daemon=True)
+
+    def _write(self):
+        try:
+            with self._writer, tarfile.open(fileobj=self._writer, mode="w|") as tar:
+                self.build_archive(tar)
+        except BrokenPipeError:
+            # The reader went away, so whatever caused that is the real error
+            pass
+        except Exception as e:
+            self.error = e
+
+    def read(self, size=-1):
+        return self._reader.read(size)
+
+    def fileno(self):
+        # Allows the stream to be passed directly as stdin to a subprocess
+        return self._reader.fileno()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Closing the reader unblocks the writer if we bailed out early
+        self._reader.close()
+        self._thread.join()
+        # A failure to build the archive will likely have caused a confusing
+        # error from Docker about a truncated archive, so raise the original
+        if self.error is not None:
+            raise self.error
+
+
 def copy_from_volume(volume_name, source, dest, timeout=None):
     """
     Copy the contents of `source` from the root of the named volume to `dest`
@@ -275,6 +411,68 @@ def manager_name(volume_name):
     return f"{volume_name}-manager"
 
 
+def list_containers(label):
+    """
+    Return a dict mapping the names of all containers (running or not) which
+    carry `label` to a boolean indicating whether they are running
+
+    Fetching these in one go is much cheaper than inspecting every container
+    individually.
+    """
+    if docker_api.get_client():
+        response = api_request(
+            "GET",
+            "/containers/json",
+            params={"all": "1", "filters": json.dumps({"label": [label]})},
+        )
+        containers = [(c["Names"], c["State"]) for c in response.json()]
+    else:
+        response = docker(
+            [
+                "container",
+                "ls",
+                "--all",
+                "--no-trunc",
+                "--filter",
+                f"label={label}",
+                "--format",
+                "{{json .}}",
+            ],
+            check=True,
+            capture_output=True,
+        )
+        containers = [
+            (row["Names"].split(","), row["State"])
+            for row in map(json.loads, response.stdout.splitlines())
+        ]
+    results = {}
+    for names, state in containers:
+        # These are the states in which `State.Running` is true
+        is_running = state in ("running", "paused", "restarting")
+        for name in names:
+            results[name.lstrip("/")] = is_running
+    return results
+
+
+def list_volumes(label):
+    """
+    Return the set of names of all volumes which carry `label`
+    """
+    if docker_api.get_client():
+        response = api_request(
+            "GET", "/volumes", params={"filters": json.dumps({"label": [label]})}
+        )
+        return {volume["Name"] for volume in response.json()["Volumes"] or []}
+    response = docker(
+        ["volume", "ls", "--filter", f"label={label}", "--format", "{{.Name}}"],
+        check=True,
+        capture_output=True,
+        text=True,
+        encoding="utf-8",
+    )
+    return set(response.stdout.split())
+
+
 def container_exists(name):
     return bool(container_inspect(name, "ID", none_if_not_exists=True))
 
@@ -292,6 +490,15 @@ def container_inspect(name, key="", none_if_not_exists=False):
 
     See: https://docs.docker.com/engine/reference/commandline/inspect/
     """
+    if docker_api.get_client():
+        response = api_request(
+            "GET", f"/containers/{quote_name(name)}/json", allowed_statuses=(404,)
+        )
+        if response.status == 404:
+            if none_if_not_exists:
+                return
+            raise DockerAPIError(response.status, response.message)
+        return _lookup_key(response.json(), key)
     try:
         response = docker(
             ["container", "inspect", "--format", "{{json .%s}}" % key, name],
@@ -310,6 +517,22 @@ def container_inspect(name, key="", none_if_not_exists=False):
     return json.loads(response.stdout)
 
 
+def _lookup_key(metadata, key):
+    """
+    Emulate `docker inspect --format '{{json .Some.Key}}'`, which addresses
+    fields by their Go struct names (e.g. `ID`) rather than the names they are
+    given in the JSON (e.g. `Id`)
+    """
+    value = metadata
+    for part in filter(None, key.split(".")):
+        if not isinstance(value, dict):
+            return None
+        if part not in value:
+            part = next((k for k in value if k.lower() == part.lower()), part)
+        value = value.get(part)
+    return value
+
+
 def run(
     name,
     args,
@@ -320,6 +543,12 @@ def run(
     labels=None,
     extra_args=None,
 ):
+    if docker_api.get_client():
+        if _run_via_api(
+            name, args, volume, env, allow_network_access, label, labels, extra_args
+        ):
+            return
+
     run_args = ["run", "--init", "--detach", "--label", LABEL, "--name", name]
     if extra_args is not None:
         run_args.extend(extra_args)
@@ -345,7 +574,74 @@ def run(
     )
 
 
+def _run_via_api(
+    name, args, volume, env, allow_network_access, label, labels, extra_args
+):
+    """
+    Equivalent of `docker run --init --detach` using the Engine API. Returns
+    False if this isn't possible (unsupported `extra_args`, or the image needs
+    pulling) in which case the caller should use the CLI instead.
+    """
+    host_config = {"Init": True}
+    container_config = {
+        "Image": args[0],
+        "Cmd": list(map(str, args[1:])),
+        "Env": [f"{key}={value}" for key, value in (env or {}).items()],
+        "Labels": {LABEL: ""},
+        "HostConfig": host_config,
+    }
+    for arg in extra_args or []:
+        if arg == "--interactive":
+            container_config["OpenStdin"] = True
+        elif arg.startswith("--restart="):
+            host_config["RestartPolicy"] = {"Name": arg.partition("=")[2]}
+        else:
+            return False
+    if not allow_network_access:
+        host_config["NetworkMode"] = "none"
+    if volume:
+        host_config["Binds"] = [f"{volume[0]}:{volume[1]}"]
+    if label is not None:
+        container_config["Labels"][label] = ""
+    if labels:
+        container_config["Labels"].update(labels)
+
+    response = api_request(
+        "POST",
+        "/containers/create",
+        params={"name": name},
+        body=container_config,
+        # Unlike `docker run`, the API won't pull missing images for us
+        allowed_statuses=(404,),
+    )
+    if response.status == 404:
+        return False
+    try:
+        api_request("POST", f"/containers/{quote_name(name)}/start")
+    except Exception:
+        # Otherwise the container we couldn't start would stop us ever
+        # creating another with the same name
+        try:
+            api_request(
+                "DELETE",
+                f"/containers/{quote_name(name)}",
+                params={"force": "1"},
+                allowed_statuses=(404,),
+            )
+        except Exception:
+            log.exception(f"Failed to remove container {name} after failed start")
+        raise
+    return True
+
+
 def image_exists_locally(image_name_and_version):
+    if docker_api.get_client():
+        response = api_request(
+            "GET",
+            f"/images/{quote_name(image_name_and_version)}/json",
+            allowed_statuses=(404,),
+        )
+        return response.status != 404
     try:
         docker(
             ["image", "inspect", "--format", "ok", image_name_and_version],
@@ -359,6 +655,33 @@ def image_exists_locally(image_name_and_version):
         raise
 
 
+def image_id(image_name_and_version):
+    """
+    Return the ID (content digest) of a local image, or None if it doesn't
+    exist locally
+    """
+    if docker_api.get_client():
+        response = api_request(
+            "GET",
+            f"/images/{quote_name(image_name_and_version)}/json",
+            allowed_statuses=(404,),
+        )
+        return response.json()["Id"] if response.status != 404 else None
+    try:
+        response = docker(
+            ["image", "inspect", "--format", "{{.Id}}", image_name_and_version],
+            check=True,
+            capture_output=True,
+            text=True,
+            encoding="utf-8",
+        )
+    except subprocess.CalledProcessError as e:
+        if e.returncode == 1 and "No such image" in e.stderr:
+            return None
+        raise
+    return response.stdout.strip()
+
+
 def delete_container(name):
     try:
         docker(
@@ -373,6 +696,15 @@ def delete_container(name):
 
 
 def kill(name):
+    if docker_api.get_client():
+        # 404 means no such container and 409 that it's not running, both of
+        # which we ignore
+        api_request(
+            "POST",
+            f"/containers/{quote_name(name)}/kill",
+            allowed_statuses=(404, 409),
+        )
+        return
     try:
         docker(
             ["container", "kill", name],
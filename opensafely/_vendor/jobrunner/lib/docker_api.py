@@ -0,0 +1,167 @@
+"""
+Minimal client for the Docker Engine HTTP API which talks directly to the
+daemon's unix socket
+
+Shelling out to the `docker` CLI costs tens of milliseconds per call which, with
+many active jobs, comes to dominate the run loop. Talking to the socket
+directly over a small pool of keep-alive connections avoids this. We only
+support local unix sockets: anything else (TCP, SSH, Windows named pipes) is
+left to the CLI, see `get_client()`.
+
+See: https://docs.docker.com/engine/api/
+"""
+import http.client
+import json
+import os
+import queue
+import socket
+import threading
+from urllib.parse import quote, urlencode
+
+DEFAULT_SOCKET_PATH = "/var/run/docker.sock"
+
+# Number of idle connections we keep around for re-use
+POOL_SIZE = 8
+
+
+class DockerAPIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.message = message
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        # The host name is only used for the `Host` header which the daemon
+        # ignores
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+    def set_timeout(self, timeout):
+        self.timeout = timeout
+        if self.sock is not None:
+            self.sock.settimeout(timeout)
+
+
+class Response:
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+    @property
+    def message(self):
+        """Error message from the daemon, if any"""
+        try:
+            return self.json()["message"]
+        except (ValueError, KeyError, TypeError):
+            return self.body.decode("utf-8", "ignore")
+
+
+class DockerAPIClient:
+    def __init__(self, socket_path, pool_size=POOL_SIZE):
+        self.socket_path = socket_path
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def request(self, method, path, params=None, body=None, timeout=None):
+        """
+        Make a request to the daemon, returning a `Response`
+
+        `body` may be a dict (sent as JSON), bytes or a file-like object (which
+        is streamed using chunked encoding). Raises `socket.timeout` if
+        `timeout` (in seconds) expires.
+        """
+        url = path if not params else f"{path}?{urlencode(params)}"
+        headers = {}
+        if isinstance(body, dict):
+            body = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        elif body is not None and not isinstance(body, bytes):
+            headers["Content-Type"] = "application/x-tar"
+
+        connection = self._get_connection()
+        try:
+            connection.set_timeout(timeout)
+            connection.request(method, url, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except BaseException:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._put_connection(connection)
+        return Response(response.status, data)
+
+    def _get_connection(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return UnixHTTPConnection(self.socket_path)
+
+    def _put_connection(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def ping(self):
+        try:
+            return self.request("GET", "/_ping", timeout=5).status == 200
+        except OSError:
+            return False
+
+
+def quote_name(name):
+    """Quote a container, volume or image name for inclusion in a URL path"""
+    return quote(str(name), safe="/:")
+
+
+def get_socket_path():
+    docker_host = os.environ.get("DOCKER_HOST", "")
+    if docker_host.startswith("unix://"):
+        return docker_host[len("unix://") :]
+    # Some other kind of remote daemon which we leave to the CLI
+    if docker_host:
+        return None
+    if os.path.exists(DEFAULT_SOCKET_PATH):
+        return DEFAULT_SOCKET_PATH
+    return None
+
+
+_client = None
+_client_checked = False
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return a shared client instance, or None if the daemon's socket isn't
+    available to us (in which case callers should fall back to the CLI). This
+    is determined once, on first use.
+    """
+    global _client, _client_checked
+    with _client_lock:
+        if not _client_checked:
+            _client_checked = True
+            if os.environ.get("DOCKER_USE_CLI", "").lower() not in ("true", "1"):
+                socket_path = get_socket_path()
+                if socket_path:
+                    client = DockerAPIClient(socket_path)
+                    if client.ping():
+                        _client = client
+        return _client
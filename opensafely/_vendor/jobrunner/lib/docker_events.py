@@ -0,0 +1,102 @@
+"""
+Watches the Docker event stream so that we notice containers exiting as soon as
+it happens, rather than on the next poll of every container's state
+"""
+import logging
+import subprocess
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# How long to wait before re-establishing the event stream if it drops (e.g.
+# because the Docker daemon was restarted). Value is in seconds.
+RESTART_DELAY = 5
+
+# How long to wait for the Docker daemon to answer when checking that the event
+# stream is live. Value is in seconds.
+PROBE_TIMEOUT = 10
+
+
+class DockerEventWatcher(threading.Thread):
+    """
+    Background thread which runs `docker events` and invokes `callback` with
+    the name of every container carrying `label` which exits
+    """
+
+    def __init__(self, callback, label):
+        super().__init__(name="evnt", daemon=True)
+        self.callback = callback
+        self.label = label
+        # True while we have a live event stream. When it's False the caller
+        # can't rely on being told about exiting containers and should fall
+        # back to polling more frequently.
+        self.connected = False
+        self._process = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self._watch()
+            except FileNotFoundError:
+                log.warning("Could not find docker; not watching for events")
+                return
+            except Exception:
+                log.exception("Error reading Docker event stream")
+            finally:
+                self.connected = False
+            self._stopped.wait(RESTART_DELAY)
+
+    def _watch(self):
+        started_at = str(int(time.time()))
+        self._process = subprocess.Popen(
+            self._events_command() + ["--format", "{{.Actor.Attributes.name}}"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            encoding="utf-8",
+        )
+        # `docker events` prints nothing until something happens, so we can't
+        # tell from its output whether it managed to connect. Instead we ask
+        # the daemon for the events since we started, which it answers
+        # straight away if it's reachable, and then check that the stream
+        # didn't exit (e.g. because it couldn't connect) in the meantime.
+        self.connected = self._probe(started_at) and self._process.poll() is None
+        if not self.connected:
+            log.debug("Docker event stream not available, polling instead")
+        for line in self._process.stdout:
+            name = line.strip()
+            if name:
+                log.debug(f"Container exited: {name}")
+                self.callback(name)
+        self._process.wait()
+
+    def _events_command(self):
+        return [
+            "docker",
+            "events",
+            "--filter",
+            "type=container",
+            "--filter",
+            "event=die",
+            "--filter",
+            f"label={self.label}",
+        ]
+
+    def _probe(self, since):
+        try:
+            subprocess.run(
+                self._events_command()
+                + ["--since", since, "--until", str(int(time.time()))],
+                check=True,
+                capture_output=True,
+                timeout=PROBE_TIMEOUT,
+            )
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            return False
+        return True
+
+    def stop(self):
+        self._stopped.set()
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
@@ -4,7 +4,11 @@ Utility functions for interacting with git
 import logging
 import os
 import subprocess
+import tarfile
+import tempfile
+import threading
 import time
+from collections import defaultdict
 from pathlib import Path, PurePath
 from urllib.parse import urlparse, urlunparse
 
@@ -28,6 +32,18 @@ NEVER_PROMPT_FOR_AUTH_ENV = dict(
 )
 
 
+# Git doesn't cope well with concurrent operations on the same repository (they
+# contend for the index and ref lock files) and jobs can now be prepared in
+# background threads, so we serialise access to each local repo
+_REPO_LOCKS = defaultdict(threading.Lock)
+_REPO_LOCKS_GUARD = threading.Lock()
+
+
+def repo_lock(repo_dir):
+    with _REPO_LOCKS_GUARD:
+        return _REPO_LOCKS[str(repo_dir)]
+
+
 class GitError(Exception):
     pass
 
@@ -49,20 +65,21 @@ def read_file_from_repo(repo_url, commit_sha, path):
     Return the contents of the file at `path` in `repo_url` as of `commit_sha`
     """
     repo_dir = get_local_repo_dir(repo_url)
-    ensure_commit_fetched(repo_dir, repo_url, commit_sha)
-    try:
-        response = subprocess_run(
-            ["git", "show", f"{commit_sha}:{path}"],
-            capture_output=True,
-            check=True,
-            cwd=repo_dir,
-        )
-    except subprocess.SubprocessError as e:
-        if e.stderr.startswith(b"fatal: path ") and b"does not exist" in e.stderr:
-            raise GitFileNotFoundError(f"File '{path}' not found in repository")
-        else:
-            log.exception(f"Error reading from {repo_url} @ {commit_sha}")
-            raise GitError(f"Error reading from {repo_url} @ {commit_sha}")
+    with repo_lock(repo_dir):
+        ensure_commit_fetched(repo_dir, repo_url, commit_sha)
+        try:
+            response = subprocess_run(
+                ["git", "show", f"{commit_sha}:{path}"],
+                capture_output=True,
+                check=True,
+                cwd=repo_dir,
+            )
+        except subprocess.SubprocessError as e:
+            if e.stderr.startswith(b"fatal: path ") and b"does not exist" in e.stderr:
+                raise GitFileNotFoundError(f"File '{path}' not found in repository")
+            else:
+                log.exception(f"Error reading from {repo_url} @ {commit_sha}")
+                raise GitError(f"Error reading from {repo_url} @ {commit_sha}")
     # Note the response here is bytes not text as git doesn't know what
     # encoding the file is supposed to have
     return response.stdout
@@ -73,22 +90,59 @@ def checkout_commit(repo_url, commit_sha, target_dir):
     Checkout the contents of `repo_url` as of `commit_sha` into `target_dir`
     """
     repo_dir = get_local_repo_dir(repo_url)
-    ensure_commit_fetched(repo_dir, repo_url, commit_sha)
-    os.makedirs(target_dir, exist_ok=True)
-    subprocess_run(
-        [
-            "git",
-            f"--work-tree={target_dir}",
-            "checkout",
-            "--quiet",
-            "--force",
-            commit_sha,
-        ],
-        check=True,
-        # Set GIT_DIR rather than changing working directory so that
-        # `target_dir` gets correctly resolved
-        env=dict(os.environ, GIT_DIR=repo_dir),
-    )
+    with repo_lock(repo_dir):
+        ensure_commit_fetched(repo_dir, repo_url, commit_sha)
+        os.makedirs(target_dir, exist_ok=True)
+        subprocess_run(
+            [
+                "git",
+                f"--work-tree={target_dir}",
+                "checkout",
+                "--quiet",
+                "--force",
+                commit_sha,
+            ],
+            check=True,
+            # Set GIT_DIR rather than changing working directory so that
+            # `target_dir` gets correctly resolved
+            env=dict(os.environ, GIT_DIR=repo_dir),
+        )
+
+
+def add_commit_to_archive(repo_url, commit_sha, tar):
+    """
+    Add the contents of `repo_url` as of `commit_sha` to `tar` (a tarfile open
+    for writing), streaming them straight out of `git archive` rather than
+    checking them out to disk first
+    """
+    repo_dir = get_local_repo_dir(repo_url)
+    with repo_lock(repo_dir):
+        ensure_commit_fetched(repo_dir, repo_url, commit_sha)
+    cmd = ["git", "archive", "--format=tar", commit_sha]
+    # We only read stderr once we've finished with stdout, so it goes to a
+    # temporary file rather than a pipe, which git could fill and then block on
+    with tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(
+            cmd,
+            cwd=str(repo_dir),
+            stdout=subprocess.PIPE,
+            stderr=stderr_file,
+        )
+        try:
+            with tarfile.open(fileobj=process.stdout, mode="r|") as archive:
+                for member in archive:
+                    fileobj = archive.extractfile(member) if member.isfile() else None
+                    tar.addfile(member, fileobj)
+        except tarfile.ReadError:
+            # Most likely git failed and produced no output, which we report below
+            pass
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+            stderr_file.seek(0)
+            stderr = stderr_file.read()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr)
 
 
 def commit_reachable_from_ref(repo_url, commit_sha, ref):
@@ -0,0 +1,28 @@
+"""
+Crude cross-thread signalling which lets anything that changes the state of the
+world (new jobs arriving from the sync thread, containers exiting, jobs moving
+between states) wake the run loop immediately rather than having it poll the
+database and Docker on a fixed interval.
+"""
+import threading
+
+_EVENT = threading.Event()
+
+
+def notify():
+    """Ask the run loop to do another pass as soon as possible"""
+    _EVENT.set()
+
+
+def wait(timeout):
+    """
+    Block until `notify()` is called or `timeout` seconds have passed,
+    whichever comes first. Returns True if we were explicitly notified.
+
+    The event is cleared *after* waking so that any notification which arrives
+    while the caller is busy handling jobs is not lost: it will cause the next
+    call to return immediately.
+    """
+    notified = _EVENT.wait(timeout)
+    _EVENT.clear()
+    return notified
@@ -7,19 +7,23 @@ idempotent. This means that the job-runner can be killed at any point and will
 still end up in a consistent state when it's restarted.
 """
 import datetime
+import io
 import json
 import logging
+import multiprocessing
 import os.path
+import random
 import shlex
 import shutil
-import tempfile
+import tarfile
 import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 from opensafely._vendor.jobrunner import config
 from opensafely._vendor.jobrunner.lib import docker
 from opensafely._vendor.jobrunner.lib.database import find_one
-from opensafely._vendor.jobrunner.lib.git import checkout_commit
+from opensafely._vendor.jobrunner.lib.git import add_commit_to_archive
 from opensafely._vendor.jobrunner.lib.path_utils import list_dir_with_ignore_patterns
 from opensafely._vendor.jobrunner.lib.string_utils import tabulate
 from opensafely._vendor.jobrunner.lib.subprocess_utils import subprocess_run
@@ -30,11 +34,10 @@ from opensafely._vendor.jobrunner.project import (
 )
 from opensafely._vendor.jobrunner.queries import calculate_workspace_state
 
-import opensafely._vendor.jobrunner.patients
-
-from numpy.random import randint
-
-seed = str(randint(low=0, high=10, size=1)[0])
+# The patient ID checks need pandas, which is slow to import, so we only import
+# opensafely._vendor.jobrunner.patients when there are outputs to check. For the same reason the seed comes from the
+# standard library's random module rather than numpy's.
+seed = str(random.randint(0, 9))
 
 # print("%%%%%%%%%%%%%%%%%%%%%%%%%%%")
 # print("Seed is", seed)
@@ -73,6 +76,14 @@ JOB_LABEL = "jobrunner-job"
 # created
 TIMESTAMP_REFERENCE_FILE = ".opensafely-timestamp"
 
+# Code should only be a few megabytes so if copying it into a volume takes more
+# than this many seconds something is badly wrong (see `populate_volume`)
+COPY_TIMEOUT = 60
+
+# Input files can be arbitrarily large, so we allow them extra time on the
+# assumption that they copy at least this fast (in bytes per second)
+MIN_COPY_RATE = 10 * 1024 * 1024
+
 
 class JobError(Exception):
     pass
@@ -161,10 +172,6 @@ def create_and_populate_volume(job):
     volume = volume_name(job)
     docker.create_volume(volume)
 
-    # `docker cp` can't create parent directories for us so we make sure all
-    # these directories get created when we copy in the code
-    extra_dirs = set(Path(filename).parent for filename in input_files.keys())
-
     # Jobs which are running reusable actions pull their code from the reusable
     # action repo, all other jobs pull their code from the study repo
     repo_url = job.action_repo_url or job.repo_url
@@ -172,63 +179,97 @@ def create_and_populate_volume(job):
     # Both of action commit and repo_url should be set if either are
     assert bool(job.action_commit) == bool(job.action_repo_url)
 
+    populate_volume(volume, workspace_dir, repo_url, commit, input_files.keys())
+    return volume
+
+
+def populate_volume(volume, workspace_dir, repo_url, commit, input_files):
+    """
+    Copy the job's code, its input files from `workspace_dir` and the timestamp
+    reference file into `volume`
+
+    Everything is streamed into the volume as a single tar archive, rather than
+    making a separate `docker cp` call for every file.
+    """
+
+    # The archive is built in a background thread so we log up front, in order
+    # to keep the current logging context
     if repo_url and commit:
-        copy_git_commit_to_volume(volume, repo_url, commit, extra_dirs)
+        log.info(f"Copying in code from {repo_url}@{commit}")
     else:
-        # We only encounter jobs without a repo or commit when using the
-        # "local_run" command to execute uncommitted local code
-        copy_local_workspace_to_volume(volume, workspace_dir, extra_dirs)
-        # copy_local_workspace_to_volume(volume, Path(job.repo_url).resolve(), extra_dirs)
-
-    for filename, action in input_files.items():
-        log.info(f"Copying input file {action}: {filename}")
-        docker.copy_to_volume(volume, workspace_dir / filename, filename)
-    # Hack: see `get_unmatched_outputs`. For some reason this requires a
-    # non-empty file so copying `os.devnull` didn't work.
-    some_non_empty_file = Path(__file__)
-    docker.copy_to_volume(volume, some_non_empty_file, TIMESTAMP_REFERENCE_FILE)
-    return volume
+        log.info(f"Copying in code from {workspace_dir}")
+    for filename in input_files:
+        log.info(f"Copying input file: {filename}")
+
+    def build_archive(tar):
+        if repo_url and commit:
+            add_commit_to_archive(repo_url, commit, tar)
+        else:
+            # We only encounter jobs without a repo or commit when using the
+            # "local_run" command to execute uncommitted local code
+            add_local_workspace_to_archive(workspace_dir, tar)
+
+        add_directories_to_archive(tar, [Path(f).parent for f in input_files])
+        for filename in input_files:
+            tar.add(workspace_dir / filename, arcname=Path(filename).as_posix())
+
+        # Hack: see `get_unmatched_outputs`. For some reason this requires a
+        # non-empty file. We give it the current time so that anything the job
+        # writes counts as newer, but the code and inputs copied above don't.
+        info = tarfile.TarInfo(TIMESTAMP_REFERENCE_FILE)
+        contents = b"timestamp reference\n"
+        info.size = len(contents)
+        info.mtime = time.time()
+        tar.addfile(info, io.BytesIO(contents))
+
+    try:
+        docker.put_archive(
+            volume, build_archive, timeout=get_copy_timeout(workspace_dir, input_files)
+        )
+    except docker.DockerTimeoutError:
+        # Aborting a `docker cp` into a container at the wrong time can
+        # leave the container in a completely broken state where any
+        # attempt to interact with or even remove it will just hang, see:
+        # https://github.com/docker/for-mac/issues/4491
+        #
+        # This means we can end up with jobs where any attempt to start
+        # them (by copying in code from git) causes the job-runner to
+        # completely lock up. To avoid this we use a timeout. The exception
+        # this triggers will cause the job to fail with an "internal error"
+        # message, which will then stop it blocking other jobs. We need a
+        # specific exception class here as we need to avoid trying to remove
+        # the container, which we would ordinarily do on error, because that
+        # operation will also hang :(
+        log.exception("Timed out copying code to volume, see issue #154")
+        raise BrokenContainerError(
+            "There was a (hopefully temporary) internal Docker error, "
+            "please try the job again"
+        )
 
 
-def copy_git_commit_to_volume(volume, repo_url, commit, extra_dirs):
-    log.info(f"Copying in code from {repo_url}@{commit}")
-    # git-archive will create a tarball on stdout and docker cp will accept a
-    # tarball on stdin, so if we wanted to we could do this all without a
-    # temporary directory, but not worth it at this stage
-    config.TMP_DIR.mkdir(parents=True, exist_ok=True)
-    with tempfile.TemporaryDirectory(dir=config.TMP_DIR) as tmpdir:
-        tmpdir = Path(tmpdir)
-        checkout_commit(repo_url, commit, tmpdir)
-        # Because `docker cp` can't create parent directories automatically, we
-        # make sure parent directories exist for all the files we're going to
-        # copy in later
-        for directory in extra_dirs:
-            tmpdir.joinpath(directory).mkdir(parents=True, exist_ok=True)
-        try:
-            docker.copy_to_volume(volume, tmpdir, ".", timeout=60)
-        except docker.DockerTimeoutError:
-            # Aborting a `docker cp` into a container at the wrong time can
-            # leave the container in a completely broken state where any
-            # attempt to interact with or even remove it will just hang, see:
-            # https://github.com/docker/for-mac/issues/4491
-            #
-            # This means we can end up with jobs where any attempt to start
-            # them (by copying in code from git) causes the job-runner to
-            # completely lock up. To avoid this we use a timeout (60 seconds,
-            # which should be more than enough to copy in a few megabytes of
-            # code). The exception this triggers will cause the job to fail
-            # with an "internal error" message, which will then stop it
-            # blocking other jobs. We need a specific exception class here as
-            # we need to avoid trying to remove the container, which we would
-            # ordinarily do on error, because that operation will also hang :(
-            log.exception("Timed out copying code to volume, see issue #154")
-            raise BrokenContainerError(
-                "There was a (hopefully temporary) internal Docker error, "
-                "please try the job again"
-            )
-
-
-def copy_local_workspace_to_volume(volume, workspace_dir, extra_dirs):
+def get_copy_timeout(workspace_dir, input_files):
+    """
+    Return the timeout, in seconds, for copying a job's code and input files into
+    its volume, which scales with the size of the input files
+    """
+    input_size = sum((workspace_dir / filename).stat().st_size for filename in input_files)
+    return COPY_TIMEOUT + input_size / MIN_COPY_RATE
+
+
+def add_local_workspace_to_archive(workspace_dir, tar):
+    code_files = list_local_workspace_code(workspace_dir)
+    add_directories_to_archive(tar, [Path(f).parent for f in code_files])
+    for filename in sorted(code_files):
+        # Directories are added recursively
+        tar.add(workspace_dir / filename, arcname=Path(filename).as_posix())
+
+
+def list_local_workspace_code(workspace_dir):
+    """
+    Return the paths, relative to `workspace_dir`, of the files and directories
+    which make up the code of a local workspace. Directories should be taken
+    to include everything inside them.
+    """
     # To mimic a production run, we only want output files to appear in the
     # volume if they were produced by an explicitly listed dependency. So
     # before copying in the code we get a list of all output patterns in the
@@ -236,27 +277,27 @@ def copy_local_workspace_to_volume(volume, workspace_dir, extra_dirs):
     project_file = workspace_dir / "project.yaml"
     ignore_patterns = get_all_output_patterns_from_project_file(project_file)
     ignore_patterns.extend([".git", METADATA_DIR])
-    code_files = list_dir_with_ignore_patterns(workspace_dir, ignore_patterns)
-
-    # Because `docker cp` can't create parent directories automatically, we
-    # need to make sure empty parent directories exist for all the files we're
-    # going to copy in. For now we do this by actually creating a bunch of
-    # empty dirs in a temp directory. It should be possible to do this using
-    # the `tarfile` module to talk directly to `docker cp` stdin if we care
-    # enough.
-    directories = set(Path(filename).parent for filename in code_files)
-    directories.update(extra_dirs)
-    directories.discard(Path("."))
-    if directories:
-        with tempfile.TemporaryDirectory() as tmpdir:
-            tmpdir = Path(tmpdir)
-            for directory in directories:
-                tmpdir.joinpath(directory).mkdir(parents=True, exist_ok=True)
-            docker.copy_to_volume(volume, tmpdir, ".")
-
-    log.info(f"Copying in code from {workspace_dir}")
-    for filename in code_files:
-        docker.copy_to_volume(volume, workspace_dir / filename, filename)
+    return list_dir_with_ignore_patterns(workspace_dir, ignore_patterns)
+
+
+def add_directories_to_archive(tar, directories):
+    """
+    Add entries for the supplied directories, and all their parents, to the
+    archive so that they exist before any files are extracted into them
+    """
+    all_directories = set()
+    for directory in directories:
+        directory = Path(directory)
+        all_directories.add(directory)
+        all_directories.update(directory.parents)
+    all_directories.discard(Path("."))
+    # Sorting ensures parents come before their children
+    for directory in sorted(all_directories, key=lambda d: d.parts):
+        info = tarfile.TarInfo(directory.as_posix())
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        info.mtime = time.time()
+        tar.addfile(info)
 
 
 def job_still_running(job):
@@ -330,30 +371,8 @@ def finalise_job(job):
         log.info(f"Extracting output file: {filename}")
         docker.copy_from_volume(volume, filename, workspace_dir / filename)
 
-        # After the docker.copy_from_volume() function is executed, the output file is now copied to the local workspace in the jobrunner.
-
-        # print("%%%%%%%%%%%%%%%%%%%%%%%%%%%")
-        # print("seed", seed)
-        # print("%%%%%%%%%%%%%%%%%%%%%%%%%%%")
-
-        # Ahmed Gad
-        # The patient ID inspection must be applied only for the jobs that use the cohortextractor image. 
-        # This if statement checks if the run command starts with cohortextractor. If so, then this is a cohortextractor image and patient ID inspection must be applied.
-        if job.run_command.lower().strip().find("cohortextractor:", 0, 16) == 0:
-            # The inspect_pat_ID() function checks if the patient ID exists in any column of some randomly selected rows of the output data file.
-            # result is True if any column in any row has the patient ID.
-            result, detected_columns_names, unique_columns_names = opensafely._vendor.jobrunner.patients.inspect_pat_ID(data_file_path=workspace_dir / filename)
-            # If the patient ID found, then call the hash_columns() function to hash the ID.
-            if result:
-                print("The output data file {file} contains patient ID which is not allowed. The patient ID is replaced by a random ID.".format(file=workspace_dir / filename))
-                # Next is to apply ad-hoc hashing to the patient ID if it exists in the output file.
-                data_hashed = opensafely._vendor.jobrunner.patients.hash_columns(data_file_path=workspace_dir / filename, 
-                                                                                 columns_names=unique_columns_names, 
-                                                                                 seed=seed)
-                data_hashed.to_csv(workspace_dir / filename, index=False)
-            else:
-                pass
-                # print("No patient ID found in the file {file}".format(file=workspace_dir / filename))
+    # After the docker.copy_from_volume() calls, the output files are now copied to the local workspace in the jobrunner.
+    remove_patient_ids(job, workspace_dir)
 
     # Delete outputs from previous run of action. It would be simpler to delete
     # all existing outputs and then copy over the new ones, but this way we
@@ -390,6 +409,70 @@ def finalise_job(job):
     return job
 
 
+def remove_patient_ids(job, workspace_dir):
+    # Ahmed Gad
+    # The patient ID inspection must be applied only for the jobs that use the
+    # cohortextractor image. This if statement checks if the run command starts
+    # with cohortextractor. If so, then this is a cohortextractor image and
+    # patient ID inspection must be applied.
+    if job.run_command.lower().strip().find("cohortextractor:", 0, 16) != 0:
+        return
+    from opensafely._vendor.jobrunner import patients
+
+    # Only the file formats we know how to read (and write back) are inspected,
+    # see patients.get_file_format().
+    filenames = [
+        filename
+        for filename in job.output_files
+        if patients.get_file_format(filename)
+    ]
+    if not filenames:
+        return
+
+    # Scanning large outputs is CPU bound, so when there are several of them we
+    # scan them in parallel in separate processes. We use "spawn" rather than
+    # "fork" as the job-runner has other threads running, which don't mix well
+    # with forking.
+    workers = min(config.PATIENT_ID_SCAN_WORKERS, len(filenames))
+    if workers > 1:
+        pool = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    else:
+        pool = None
+    try:
+        futures = {}
+        if pool:
+            for filename in filenames:
+                futures[filename] = pool.submit(
+                    patients.remove_pat_IDs, workspace_dir / filename, seed
+                )
+        for filename in filenames:
+            # Failures are reported in the same way whether or not the file was
+            # checked in another process
+            try:
+                if pool:
+                    columns_names = futures[filename].result()
+                else:
+                    columns_names = patients.remove_pat_IDs(
+                        workspace_dir / filename, seed
+                    )
+            except Exception as e:
+                raise JobError(
+                    f"Failed to check output file {filename} for patient IDs: {e}"
+                )
+            if columns_names:
+                print(
+                    "The output data file {file} contains patient ID which is not "
+                    "allowed. The patient ID is replaced by a random ID.".format(
+                        file=workspace_dir / filename
+                    )
+                )
+    finally:
+        if pool:
+            pool.shutdown()
+
+
 def cleanup_job(job):
     if config.CLEAN_UP_DOCKER_OBJECTS:
         log.info("Cleaning up container and volume")
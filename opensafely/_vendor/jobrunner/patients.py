@@ -1,61 +1,226 @@
 import pandas
+import gzip
 import hashlib
-from numpy.random import uniform
-from numpy import array
+import os
+import tempfile
+from pandas.api.types import is_string_dtype
 
-def inspect_pat_ID(data_file_path):
-    data = pandas.read_csv(data_file_path, index_col=False)
+# Number of rows to read at a time. Output files can be larger than the memory available to the job-runner, so we
+# never load a whole file at once.
+CHUNK_SIZE = 100_000
+
+# The output file formats we can inspect, by file extension. pyarrow is only needed (and imported) for the columnar
+# formats.
+CSV_FORMATS = (".csv", ".csv.gz")
+ARROW_FORMATS = (".feather", ".arrow")
+PARQUET_FORMATS = (".parquet",)
+
+def get_file_format(data_file_path):
+    # Returns the file extension which identifies the file's format, or None if we can't inspect files of this kind.
+    name = str(data_file_path).lower()
+    for file_format in CSV_FORMATS + ARROW_FORMATS + PARQUET_FORMATS:
+        if name.endswith(file_format):
+            return file_format
+    return None
+
+def inspect_pat_ID(data_file_path, chunk_size=CHUNK_SIZE):
+    unique_columns_names = []
+    for data in read_string_columns(data_file_path, chunk_size):
+        # There's no need to look any further in columns where we've already found a patient ID.
+        data = data.drop(columns=unique_columns_names, errors="ignore")
+        unique_columns_names.extend(detect_pat_ID(data)[2])
+    detected_columns_names = [unique_columns_names] if unique_columns_names else []
+    return bool(unique_columns_names), detected_columns_names, unique_columns_names
+
+def read_string_columns(data_file_path, chunk_size):
+    # Yields DataFrames of up to chunk_size rows. For the columnar formats we only read the string columns, as the
+    # others can't hold patient IDs, and Arrow files are memory-mapped rather than read.
+    file_format = get_file_format(data_file_path)
+    if file_format in CSV_FORMATS:
+        # Every column is read as a string, as otherwise a column (or just a chunk of one) in which every value looks
+        # like a number would be parsed as numbers and not inspected. The compression is inferred from the file
+        # extension.
+        yield from pandas.read_csv(
+            data_file_path, index_col=False, dtype=str, keep_default_na=False, chunksize=chunk_size
+        )
+    elif file_format in ARROW_FORMATS:
+        import pyarrow.ipc
+
+        with pyarrow.memory_map(str(data_file_path)) as source:
+            reader = pyarrow.ipc.open_file(source)
+            columns_names = get_string_columns(reader.schema)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i).select(columns_names)
+                for offset in range(0, batch.num_rows, chunk_size):
+                    yield batch.slice(offset, chunk_size).to_pandas()
+    elif file_format in PARQUET_FORMATS:
+        import pyarrow.parquet
+
+        parquet_file = pyarrow.parquet.ParquetFile(data_file_path)
+        columns_names = get_string_columns(parquet_file.schema_arrow)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns_names):
+            yield batch.to_pandas()
+    else:
+        raise ValueError(f"Unsupported file format: {data_file_path}")
 
-    # Select some rows randomly for patient ID inspection.    
-    random_rows = array(uniform(0, data.shape[0], 5), dtype=int)
-
-    # This list has length equal to the number of random rows. Its value is True when the corresponding row has a patient ID.
-    result = []
-    
-    # This list holds the names of all columns detected with patient ID.
-    detected_columns_names = []
-    for row_idx in random_rows:
-        pat_id_found = False
-        # A temporary list to hold the columns names in the current row where the patient ID exists.
-        curr_columns_names = []
-        for col_name in data.columns:
-            curr_col_val = data.loc[row_idx, col_name]
-            if type(curr_col_val) is str:
-                # The patient ID data type in the databse is CHAR(50). When the ID length is less than 50 characters, it is filled by spaces at the end.
-                # The strip() method is called to remove ant spaces at the beginning and end of the ID.
-                curr_col_val = curr_col_val.strip()
-                if curr_col_val.isalnum():
-                    if len(curr_col_val) > 2:
-                        pat_id_length = curr_col_val[:2]
-                        if pat_id_length.isdecimal(): # 03123
-                            pat_id_length = int(curr_col_val[:2])
-                            if len(curr_col_val) > (2 + pat_id_length):
-                                pat_id = curr_col_val[2:2+pat_id_length]
-                                hash_code = hashlib.md5(pat_id.encode()).hexdigest()
-                                hash_summary = hash_code[0] + hash_code[16] + hash_code[-1]
-                                if hash_summary == curr_col_val[2+pat_id_length:]:
-                                    # print("The value {curr_col_val} at the column named {col_name} of the row with index {row_idx} represents a patient ID.".format(curr_col_val=curr_col_val, col_name=col_name, row_idx=row_idx))
-                                    pat_id_found = True
-                                    curr_columns_names.append(col_name)
-
-        result.append(pat_id_found)
-
-        # It is expected to have dubplicate columns names stored in this list.
-        detected_columns_names.append(curr_columns_names)
+def get_string_columns(schema):
+    import pyarrow
+
+    columns_names = []
+    for field in schema:
+        value_type = field.type.value_type if pyarrow.types.is_dictionary(field.type) else field.type
+        if pyarrow.types.is_string(value_type) or pyarrow.types.is_large_string(value_type):
+            columns_names.append(field.name)
+    return columns_names
+
+def detect_pat_ID(data):
+    # Every row of every string column is inspected. Rather than checking each cell in turn, we use vectorised pandas
+    # string operations to find the values which have the shape of a patient ID, and only hash those. As we only need
+    # to know which columns contain patient IDs, we stop hashing a column's values as soon as we find one.
 
     # This is the list of unique columns names.
-    unique_columns_names = list(set([column_name for curr_columns_names in detected_columns_names for column_name in curr_columns_names]))
+    unique_columns_names = []
+    for col_name in data.columns:
+        column = data[col_name]
+        # Columnar formats can store strings as categories (i.e. dictionary encoded), which we need to inspect too.
+        if isinstance(column.dtype, pandas.CategoricalDtype):
+            column = column.astype(object)
+        if column.dtype != object and not is_string_dtype(column.dtype):
+            continue
+        if contains_pat_ID(column):
+            unique_columns_names.append(col_name)
+
+    # For compatibility with the previous (row sampling) version of this function, which returned a list of the
+    # columns names found in each of the rows it inspected.
+    detected_columns_names = [unique_columns_names] if unique_columns_names else []
+
+    return bool(unique_columns_names), detected_columns_names, unique_columns_names
 
-    return any(result), detected_columns_names, unique_columns_names
+# A patient ID is made up of a 2 digit length prefix, the ID itself and a 3 character summary of the MD5 hash of the ID.
+# The patient ID data type in the databse is CHAR(50). When the ID length is less than 50 characters, it is filled by
+# spaces at the end, so we allow for any spaces at the beginning and end of the value. The whole value must have this
+# shape, not just some part of it, as str.extract() only searches for the pattern.
+PAT_ID_SHAPE = r"^\s*(\d\d)([^\W_]+)([0-9a-f]{3})\s*$"
+
+def contains_pat_ID(column):
+    # Output columns tend to contain many repeated values, so we only need to inspect each distinct value once. We then
+    # use a single vectorised regular expression match to find the values with the shape of a patient ID. We keep these
+    # as Python objects (rather than pandas' own string type) so the regular expression is always Python's own.
+    values = pandas.Series(column.dropna().unique(), dtype=object)
+    matches = values.str.extract(PAT_ID_SHAPE).dropna()
+
+    # Only the values which survived the checks above need hashing.
+    for pat_id_length, pat_id, hash_summary in matches.itertuples(index=False):
+        if len(pat_id) != int(pat_id_length):
+            continue
+        hash_code = hashlib.md5(pat_id.encode()).hexdigest()
+        if hash_code[0] + hash_code[16] + hash_code[-1] == hash_summary:
+            return True
+    return False
+
+def remove_pat_IDs(data_file_path, seed):
+    # Inspects the file and, if any patient IDs are found, rewrites it with the columns which contain them hashed.
+    # Returns the names of those columns. This is run in a separate process when there are several files to check.
+    result, detected_columns_names, unique_columns_names = inspect_pat_ID(data_file_path=data_file_path)
+    # If the patient ID found, then hash the columns which contain it.
+    if result:
+        # The file is rewritten in chunks so that we never need to hold all of it in memory.
+        hash_columns_in_place(data_file_path=data_file_path, columns_names=unique_columns_names, seed=seed)
+    return unique_columns_names
 
 def hash_columns(data_file_path, columns_names, seed):
     data = pandas.read_csv(data_file_path, index_col=False)
 
     for column_name in columns_names:
-        data[column_name] = data[column_name].apply(lambda pat_ID_str: hashlib.md5(str(pat_ID_str.strip() + seed).encode()).hexdigest())
+        data[column_name] = hash_values(data[column_name], seed)
 
     return data
 
+def hash_columns_in_place(data_file_path, columns_names, seed, chunk_size=CHUNK_SIZE):
+    # Streaming version of hash_columns() which rewrites the file chunk by chunk, in its original format, so memory use
+    # is bounded by the chunk size rather than the size of the file. The new file is written alongside the original and
+    # then moved into place, so the original is never left partially rewritten.
+    data_file_path = str(data_file_path)
+    file_format = get_file_format(data_file_path)
+    if file_format in CSV_FORMATS:
+        rewrite = rewrite_csv
+    elif file_format in ARROW_FORMATS:
+        rewrite = rewrite_arrow
+    elif file_format in PARQUET_FORMATS:
+        rewrite = rewrite_parquet
+    else:
+        raise ValueError(f"Unsupported file format: {data_file_path}")
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(data_file_path), suffix=".tmp")
+    os.close(fd)
+    try:
+        rewrite(data_file_path, tmp_path, columns_names, seed, chunk_size)
+        os.replace(tmp_path, data_file_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def rewrite_csv(data_file_path, tmp_path, columns_names, seed, chunk_size):
+    # Every column is read as a string so that the columns we don't hash are written back exactly as they were.
+    open_file = gzip.open if data_file_path.lower().endswith(".gz") else open
+    with open_file(tmp_path, "wt", encoding="utf-8", newline="") as tmp_file:
+        chunks = pandas.read_csv(data_file_path, index_col=False, dtype=str, keep_default_na=False, chunksize=chunk_size)
+        for chunk_number, data in enumerate(chunks):
+            for column_name in columns_names:
+                data[column_name] = hash_values(data[column_name], seed)
+            data.to_csv(tmp_file, index=False, header=(chunk_number == 0))
+
+def rewrite_arrow(data_file_path, tmp_path, columns_names, seed, chunk_size):
+    import pyarrow
+
+    with pyarrow.memory_map(data_file_path) as source:
+        reader = pyarrow.ipc.open_file(source)
+        schema = get_hashed_schema(reader.schema, columns_names)
+        with pyarrow.ipc.new_file(tmp_path, schema) as writer:
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                for offset in range(0, batch.num_rows, chunk_size):
+                    writer.write_batch(hash_batch(batch.slice(offset, chunk_size), schema, columns_names, seed))
+
+def rewrite_parquet(data_file_path, tmp_path, columns_names, seed, chunk_size):
+    import pyarrow.parquet
+
+    parquet_file = pyarrow.parquet.ParquetFile(data_file_path)
+    schema = get_hashed_schema(parquet_file.schema_arrow, columns_names)
+    with pyarrow.parquet.ParquetWriter(tmp_path, schema) as writer:
+        for batch in parquet_file.iter_batches(batch_size=chunk_size):
+            writer.write_batch(hash_batch(batch, schema, columns_names, seed))
+
+def get_hashed_schema(schema, columns_names):
+    # Hashed columns always hold plain strings, whatever type they had before (e.g. dictionary encoded).
+    import pyarrow
+
+    for column_name in columns_names:
+        i = schema.get_field_index(column_name)
+        schema = schema.set(i, schema.field(i).with_type(pyarrow.string()))
+    return schema
+
+def hash_batch(batch, schema, columns_names, seed):
+    import pyarrow
+
+    arrays = []
+    for column_name, array in zip(batch.schema.names, batch.columns):
+        if column_name in columns_names:
+            array = pyarrow.array(hash_values(array.to_pylist(), seed), type=pyarrow.string())
+        arrays.append(array)
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+def hash_values(column, seed):
+    # Hashing a whole column in one list comprehension is much faster than calling apply() with a lambda. Missing values
+    # are left as they are.
+    return [
+        hashlib.md5((str(pat_ID_str).strip() + seed).encode()).hexdigest() if not is_missing(pat_ID_str) else pat_ID_str
+        for pat_ID_str in column
+    ]
+
+def is_missing(value):
+    return value == "" or (not isinstance(value, str) and pandas.isna(value))
+
 if __name__ == "__main__":
     # data_file_path = "C:\\Users\\agad069\\Anaconda3\\Lib\\site-packages\\workdir\\high_privacy\\workspaces\\test\\output\\input.csv"
     data_file_path = "$HOME/job-runner/jobrunner/workdir/high_privacy/workspaces/test/output/input.csv"
@@ -1,26 +1,75 @@
-from itertools import groupby
-from operator import attrgetter
+import threading
+from contextlib import contextmanager
 
-from opensafely._vendor.jobrunner.lib.database import find_where
+from opensafely._vendor.jobrunner.lib.database import find_latest_by
 from opensafely._vendor.jobrunner.models import Job
 
+# Within a single pass of the run loop we need the state of the same workspace
+# once for every dependency of every job, so we memoise it for the duration of
+# the pass. The cache is only used by the threads which are handling that pass
+# (see `workspace_state_cache`), so other threads always see the current state.
+_CACHE = threading.local()
+
+
+class WorkspaceStateCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = {}
+        # Incremented by every invalidation, so that a state calculated before
+        # an invalidation is never stored after it
+        self.generations = {}
+
+
+@contextmanager
+def workspace_state_cache(cache=None):
+    """
+    Memoise `calculate_workspace_state` on this thread for the duration of the
+    block, and yield the cache. Other threads can share it by passing it in to
+    their own block. Anything which changes a job's outputs or moves it to a
+    terminal state within the block must call `invalidate_workspace_state`.
+    """
+    previous = getattr(_CACHE, "cache", None)
+    _CACHE.cache = cache or WorkspaceStateCache()
+    try:
+        yield _CACHE.cache
+    finally:
+        _CACHE.cache = previous
+
+
+def invalidate_workspace_state(workspace):
+    cache = getattr(_CACHE, "cache", None)
+    if cache is None:
+        return
+    with cache.lock:
+        cache.states.pop(workspace, None)
+        cache.generations[workspace] = cache.generations.get(workspace, 0) + 1
+
 
 def calculate_workspace_state(workspace):
+    cache = getattr(_CACHE, "cache", None)
+    if cache is None:
+        return _calculate_workspace_state(workspace)
+    with cache.lock:
+        states = cache.states.get(workspace)
+        generation = cache.generations.get(workspace, 0)
+    if states is None:
+        # We don't hold the lock while querying the database, so other threads
+        # aren't held up by workspaces they aren't interested in
+        states = _calculate_workspace_state(workspace)
+        with cache.lock:
+            if cache.generations.get(workspace, 0) == generation:
+                cache.states[workspace] = states
+    return list(states)
+
+
+def _calculate_workspace_state(workspace):
     """
     Return a list containing the most recent uncancelled job (if any) for each action in the workspace. We always
     ignore cancelled jobs when considering the historical state of the system. We also ignore jobs whose action is
     '__error__'; these are dummy jobs created only to help us communicate failure states back to the job-server (see
     create_or_update_jobs.create_failed_job()).
     """
-    all_jobs = find_where(Job, workspace=workspace, cancelled=False)
-    latest_jobs = []
-    for action, jobs in group_by(all_jobs, attrgetter("action")):
-        if action == "__error__":
-            continue
-        ordered_jobs = sorted(jobs, key=attrgetter("created_at"), reverse=True)
-        latest_jobs.append(ordered_jobs[0])
-    return latest_jobs
-
-
-def group_by(iterable, key):
-    return groupby(sorted(iterable, key=key), key=key)
+    latest_jobs = find_latest_by(
+        Job, "action", "created_at", workspace=workspace, cancelled=False
+    )
+    return [job for job in latest_jobs if job.action != "__error__"]
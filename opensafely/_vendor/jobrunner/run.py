@@ -2,16 +2,22 @@
 Script which polls the database for active (i.e. non-terminated) jobs, takes
 the appropriate action for each job depending on its current state, and then
 updates its state as appropriate.
+
+Rather than polling on a fixed interval, the loop sleeps until something
+happens which might need acting on: new jobs being created, a job changing
+state or one of our containers exiting. A timer is kept only as a fallback.
 """
 import datetime
 import logging
 import random
 import shlex
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
-from opensafely._vendor.jobrunner import config
+from opensafely._vendor.jobrunner import action_cache, config
 from opensafely._vendor.jobrunner.executors import get_executor_api
 from opensafely._vendor.jobrunner.job_executor import (
     ExecutorAPI,
@@ -20,7 +26,9 @@ from opensafely._vendor.jobrunner.job_executor import (
     Privacy,
     Study,
 )
+from opensafely._vendor.jobrunner.lib import docker, wakeup
 from opensafely._vendor.jobrunner.lib.database import find_where, select_values, update
+from opensafely._vendor.jobrunner.lib.docker_events import DockerEventWatcher
 from opensafely._vendor.jobrunner.lib.log_utils import configure_logging, set_log_context
 from opensafely._vendor.jobrunner.manage_jobs import (
     BrokenContainerError,
@@ -34,6 +42,10 @@ from opensafely._vendor.jobrunner.manage_jobs import (
 )
 from opensafely._vendor.jobrunner.models import Job, State, StatusCode
 from opensafely._vendor.jobrunner.project import is_generate_cohort_command
+from opensafely._vendor.jobrunner.queries import (
+    invalidate_workspace_state,
+    workspace_state_cache,
+)
 
 log = logging.getLogger(__name__)
 
@@ -50,12 +62,32 @@ def main(exit_callback=lambda _: False):
         log.info("using new EXECUTION_API")
         api = get_executor_api()
 
-    while True:
-        active_jobs = handle_jobs(api)
+    # Any container we start carries this label, so this wakes us whenever one
+    # of our jobs finishes
+    watcher = DockerEventWatcher(
+        callback=lambda _name: wakeup.notify(), label=docker.LABEL
+    )
+    watcher.start()
+
+    try:
+        while True:
+            active_jobs = handle_jobs(api)
 
-        if exit_callback(active_jobs):
-            break
-        time.sleep(config.JOB_LOOP_INTERVAL)
+            if exit_callback(active_jobs):
+                break
+            wait_for_next_loop(watcher)
+    finally:
+        watcher.stop()
+
+
+def wait_for_next_loop(watcher):
+    # If we're not receiving Docker events then we have to poll to notice
+    # containers exiting
+    if watcher.connected:
+        timeout = config.JOB_LOOP_FALLBACK_INTERVAL
+    else:
+        timeout = config.JOB_LOOP_INTERVAL
+    wakeup.wait(timeout)
 
 
 def handle_jobs(api: Optional[ExecutorAPI]):
@@ -69,22 +101,80 @@ def handle_jobs(api: Optional[ExecutorAPI]):
     if config.RANDOMISE_JOB_ORDER:
         random.shuffle(active_jobs)
 
-    for job in active_jobs:
-        # `set_log_context` ensures that all log messages triggered anywhere
-        # further down the stack will have `job` set on them
-        with set_log_context(job=job):
-            if api:
-                handle_active_job_api(job, api)
-            else:
-                # old way
-                if job.state == State.PENDING:
-                    handle_pending_job(job)
-                elif job.state == State.RUNNING:
-                    handle_running_job(job)
+    # Many jobs in a pass share dependencies, so we only want to work out the
+    # state of each workspace once
+    with workspace_state_cache() as cache:
+        statuses = get_statuses(api, active_jobs) if api else {}
+
+        if config.JOB_HANDLER_THREADS > 1:
+            # Preparing and finalising jobs can be slow so, if configured, we
+            # handle jobs concurrently. We still wait for every job to be
+            # handled before starting the next pass.
+            futures = [
+                get_handler_pool().submit(
+                    handle_job_with_cache, cache, job, api, statuses.get(job.id)
+                )
+                for job in active_jobs
+            ]
+            for future in futures:
+                future.result()
+        else:
+            for job in active_jobs:
+                handle_job(job, api, statuses.get(job.id))
 
     return active_jobs
 
 
+def handle_job(job, api, status=None):
+    # `set_log_context` ensures that all log messages triggered anywhere
+    # further down the stack will have `job` set on them
+    with set_log_context(job=job):
+        if api:
+            handle_active_job_api(job, api, status)
+        else:
+            # old way
+            if job.state == State.PENDING:
+                handle_pending_job(job)
+            elif job.state == State.RUNNING:
+                handle_running_job(job)
+
+
+def handle_job_with_cache(cache, job, api, status):
+    # The handler threads share the workspace states cached for this pass
+    with workspace_state_cache(cache):
+        handle_job(job, api, status)
+
+
+_HANDLER_POOL = None
+
+
+def get_handler_pool():
+    global _HANDLER_POOL
+    if _HANDLER_POOL is None:
+        _HANDLER_POOL = ThreadPoolExecutor(
+            max_workers=config.JOB_HANDLER_THREADS, thread_name_prefix="job"
+        )
+    return _HANDLER_POOL
+
+
+def get_statuses(api, jobs):
+    """
+    Fetch the executor status of all (non-cancelled) active jobs in a single
+    batch, rather than asking the executor about each one in turn
+    """
+    definitions = []
+    for job in jobs:
+        if job.cancelled:
+            continue
+        try:
+            definitions.append(job_to_job_definition(job))
+        except Exception:
+            # This job will fail, with the appropriate logging, when we come to
+            # handle it individually
+            continue
+    return api.get_statuses(definitions)
+
+
 def handle_pending_job(job):
     if job.cancelled:
         # Mark the job as running and then immediately invoke
@@ -106,8 +196,14 @@ def handle_pending_job(job):
         set_message(
             job, "Waiting on dependencies", code=StatusCode.WAITING_ON_DEPENDENCIES
         )
+    elif action_cache.restore(job):
+        # Cached results don't need a worker, so we check for them first
+        job.started_at = int(time.time())
+        set_state(
+            job, State.SUCCEEDED, "Completed successfully (outputs restored from cache)"
+        )
     else:
-        not_started_reason = get_reason_job_not_started(job)
+        not_started_reason = reserve_workers(job)
         if not_started_reason:
             set_message(job, not_started_reason, code=StatusCode.WAITING_ON_WORKERS)
         else:
@@ -126,6 +222,8 @@ def handle_pending_job(job):
                 raise
             else:
                 mark_job_as_running(job)
+            finally:
+                STARTING_JOBS.pop(job.id, None)
 
 
 def handle_running_job(job):
@@ -145,6 +243,10 @@ def handle_running_job(job):
             # We expect the job to be transitioned into its final state at this
             # point
             assert job.state in [State.SUCCEEDED, State.FAILED]
+            if job.state == State.SUCCEEDED:
+                action_cache.store(job)
+            else:
+                action_cache.forget(job)
         except JobError as exception:
             mark_job_as_failed(job, exception)
             # Question: do we want to clean up failed jobs? Given that we now
@@ -173,9 +275,9 @@ STABLE_STATES = [
 ]
 
 
-def handle_active_job_api(job, api):
+def handle_active_job_api(job, api, initial_status=None):
     try:
-        handle_job_api(job, api)
+        handle_job_api(job, api, initial_status)
     except Exception:
         mark_job_as_failed(job, "Internal error")
         # Do not clean up, as we may want to debug
@@ -187,13 +289,16 @@ def handle_active_job_api(job, api):
         raise
 
 
-def handle_job_api(job, api):
+def handle_job_api(job, api, initial_status=None):
     """Handle an active job.
 
     This contains the main state machine logic for a job. For the most part,
     state transitions follow the same logic, which is abstracted. Some
     transitions require special logic, mainly the initial and final states, as
     well as supporting cancellation.
+
+    `initial_status` is the job's status as fetched in the batch at the start
+    of this loop, if available.
     """
     assert job.state in (State.PENDING, State.RUNNING)
     definition = job_to_job_definition(job)
@@ -206,7 +311,8 @@ def handle_job_api(job, api):
         api.cleanup(definition)
         return
 
-    initial_status = api.get_status(definition)
+    if initial_status is None:
+        initial_status = api.get_status(definition)
 
     # handle the simple no change needed states.
     if initial_status.state in STABLE_STATES:
@@ -256,6 +362,12 @@ def handle_job_api(job, api):
         expected_state = ExecutorState.FINALIZING
         new_status = api.finalize(definition)
 
+    elif initial_status.state == ExecutorState.ERROR:
+        # a background prepare or finalize task has failed
+        mark_job_as_failed(job, initial_status.message)
+        api.cleanup(definition)
+        return
+
     elif initial_status.state == ExecutorState.FINALIZED:
         # final state - we have finished!
         results = api.get_results(definition)
@@ -298,6 +410,9 @@ def handle_job_api(job, api):
                 f"state error: got {new_status.state} for job we thought was {job.state}"
             )
         set_message(job, new_status.state.value.title())
+        # The executor may already have completed the task synchronously, so
+        # check back straight away rather than waiting for the next event
+        wakeup.notify()
 
     elif new_status.state == ExecutorState.ERROR:
         # all transitions can go straight to error
@@ -338,6 +453,7 @@ def save_results(job, results):
     job.outputs = results.outputs
     job.updated_at = int(time.time())
     update(job)
+    invalidate_workspace_state(job.workspace)
 
 
 def get_obsolete_files(definition, outputs):
@@ -431,6 +547,7 @@ def mark_job_as_failed(job, error, code=None):
     if job.cancelled:
         message = "Cancelled by user"
         code = StatusCode.CANCELLED_BY_USER
+    action_cache.forget(job)
     set_state(job, State.FAILED, message, code=code)
 
 
@@ -450,7 +567,10 @@ def mark_job_as_completed(job):
     log.debug("Updating full job record")
     update_job(job)
     log.debug("Update done")
+    invalidate_workspace_state(job.workspace)
     log.info(job.status_message, extra={"status_code": job.status_code})
+    # Jobs waiting on this one may now be able to start
+    wakeup.notify()
 
 
 def set_state(job, state, message, code=None):
@@ -466,7 +586,11 @@ def set_state(job, state, message, code=None):
     log.debug("Updating job status and timestamps")
     update_job(job)
     log.debug("Update done")
+    if state == State.FAILED or state == State.SUCCEEDED:
+        invalidate_workspace_state(job.workspace)
     log.info(job.status_message, extra={"status_code": job.status_code})
+    # State changes can unblock other jobs (or free up workers for them)
+    wakeup.notify()
 
 
 def set_message(job, message, code=None):
@@ -494,6 +618,26 @@ def set_message(job, message, code=None):
             log.info(job.status_message, extra={"status_code": job.status_code})
 
 
+# Maps the IDs of jobs which are being started, but aren't yet marked as
+# running, to their resource weights
+STARTING_JOBS = {}
+_STARTING_JOBS_LOCK = threading.Lock()
+
+
+def reserve_workers(job):
+    """
+    Return the reason the job can't be started yet, if there is one. Otherwise
+    reserve the workers it needs until it's been started (or failed to start)
+    so that, when jobs are handled concurrently, they can't all see the same
+    free workers.
+    """
+    with _STARTING_JOBS_LOCK:
+        not_started_reason = get_reason_job_not_started(job)
+        if not not_started_reason:
+            STARTING_JOBS[job.id] = get_job_resource_weight(job)
+        return not_started_reason
+
+
 def get_reason_job_not_started(job):
     log.debug("Querying for running jobs")
     running_jobs = find_where(Job, state=State.RUNNING)
@@ -501,6 +645,7 @@ def get_reason_job_not_started(job):
     used_resources = sum(
         get_job_resource_weight(running_job) for running_job in running_jobs
     )
+    used_resources += sum(STARTING_JOBS.values())
     required_resources = get_job_resource_weight(job)
     if used_resources + required_resources > config.MAX_WORKERS:
         if required_resources > 1:
@@ -1,4 +1,8 @@
 -- See jobrunner/models.py for comments on the fields here
+--
+-- This must always contain the complete current schema. Changes to it must
+-- also be added to `MIGRATIONS` in jobrunner/lib/database.py so that existing
+-- databases pick them up.
 
 CREATE TABLE job_request (
     id TEXT,
@@ -38,6 +42,10 @@ CREATE TABLE job (
 
 CREATE INDEX idx_job__job_request_id ON job (job_request_id);
 
+-- Supports finding the latest job for each action in a workspace, see
+-- `queries.calculate_workspace_state`
+CREATE INDEX idx_job__workspace_action_created_at ON job (workspace, action, created_at);
+
 -- Once jobs transition into a terminal state (failed or succeeded) they become
 -- basically irrelevant from the application's point of view as it never needs
 -- to query them. By creating an index only on non-terminal states we ensure
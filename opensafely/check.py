@@ -1,7 +1,13 @@
-import glob
+import hashlib
+import io
+import json
 import os
 import re
+import subprocess
 import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import configparser
 
@@ -21,6 +27,15 @@ RESTRICTED_DATASETS = {
 
 PERMISSIONS_URL = "https://raw.githubusercontent.com/mediciaai/opensafely-cli/main/repository_permissions.yaml"
 
+# How long, in seconds, we use our cached copy of the permissions without
+# checking whether it has changed
+PERMISSIONS_CACHE_TTL = 60 * 60
+PERMISSIONS_TIMEOUT = 10
+
+# Directories we never look in for code, along with hidden directories (like
+# `.git`), virtualenvs and anything ignored by git
+IGNORED_DIRS = {"__pycache__", "node_modules"}
+
 
 def add_arguments(parser):
     pass
@@ -40,13 +55,27 @@ def main(continue_on_error=False):
         for k, v in RESTRICTED_DATASETS.items()
         if k not in allowed_datasets
     }
-    files_to_check = glob.glob("**/*.py", recursive=True)
+    files_to_check = find_files_to_check()
 
-    found_datasets = {
-        dataset: check_dataset(functions, files_to_check)
-        for dataset, functions in datasets_to_check.items()
-        if check_dataset(functions, files_to_check)
-    }
+    # Scan for all the restricted functions at once, so that we only read
+    # each file once, and then attribute them to their datasets
+    all_functions = [
+        function
+        for functions in datasets_to_check.values()
+        for function in functions
+    ]
+    cache = ScanCache(get_cache_file(), all_functions)
+    found_functions = check_dataset(all_functions, files_to_check, cache)
+    cache.save()
+    found_datasets = {}
+    for dataset, functions in datasets_to_check.items():
+        found = {
+            function: found_functions[function]
+            for function in functions
+            if function in found_functions
+        }
+        if found:
+            found_datasets[dataset] = found
 
     if found_datasets:
         violations = "\n".join(format_violations(found_datasets))
@@ -71,39 +100,387 @@ def format_violations(found_datasets):
                     yield f"    line {ln}: {line}"
 
 
-def check_dataset(functions, files_to_check):
-    found_functions = {}
-    for function in functions:
-        regex = re.compile(rf"\.{function}\(")
-        found_files = {}
-        for f in files_to_check:
-            matches = check_file(f, regex)
-            if matches:
-                found_files[f] = matches
-        if found_files:
-            found_functions[function] = found_files
-    return found_functions
+def check_dataset(functions, files_to_check, cache=None):
+    if not functions:
+        return {}
+    # A single regex matching calls to any of the functions
+    regex = re.compile(
+        r"\.(" + "|".join(re.escape(function) for function in functions) + r")\("
+    )
+
+    def check(f):
+        if cache is None:
+            return check_file(f, regex)
+        return cache.check_file(f, regex)
+
+    found_functions = {function: {} for function in functions}
+    # Scan the files in parallel, which mostly helps when reading them is slow
+    # (e.g. on network drives) but we collect the results in order
+    with ThreadPoolExecutor() as pool:
+        for f, matches in zip(files_to_check, pool.map(check, files_to_check)):
+            for function, found_lines in matches.items():
+                found_functions[function][f] = found_lines
+    return {
+        function: found_files
+        for function, found_files in found_functions.items()
+        if found_files
+    }
 
 
 def check_file(filename, regex):
-    found_lines = {}
+    """
+    Return a dict mapping each function matched by `regex` in the file to the
+    lines (by line number) which call it
+    """
+    found_functions = {}
     with open(filename, "r", encoding="utf8", errors="ignore") as f:
-        for ln, line in enumerate(f, start=1):
-            if line.lstrip().startswith("#"):
+        contents = f.read()
+    # Most files don't call any of the functions, which we can tell without
+    # looking at each line
+    if not regex.search(contents):
+        return found_functions
+    # Reading the file has already normalised the line endings to "\n", so
+    # this gives the same lines as iterating over the file would
+    for ln, line in enumerate(io.StringIO(contents), start=1):
+        if line.lstrip().startswith("#"):
+            continue
+        for match in regex.finditer(line):
+            found_lines = found_functions.setdefault(match.group(1), {})
+            found_lines[ln] = line
+    return found_functions
+
+
+def find_files_to_check(root="."):
+    """
+    Return the paths of all the Python files under `root`, like
+    `glob.glob("**/*.py", recursive=True)` does, but without descending into
+    directories which can't contain the project's code: those in IGNORED_DIRS,
+    virtualenvs and, in a git repository, anything git ignores
+
+    Files which git tracks are always checked, wherever they are (e.g. because
+    they were force-added), as they'll still be run. Outside a git repository
+    we can't tell which files those are, so we don't look at `.gitignore`
+    files at all.
+    """
+    files_to_check = []
+    tracked_files = get_tracked_files(root)
+    if tracked_files is not None:
+        gitignore = GitIgnore()
+        tracked_dirs = {
+            parent.as_posix() for path in tracked_files for parent in Path(path).parents
+        }
+    else:
+        gitignore = None
+        tracked_files = tracked_dirs = set()
+    # Directories we'd otherwise skip but visit because they contain tracked
+    # files, in which we only check those files
+    excluded_dirs = set()
+    # Like glob we follow symlinks to directories, but only visit each
+    # directory once in case the links form a loop
+    seen_dirs = set()
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        rel_dir = os.path.relpath(dirpath, root)
+        rel_dir = "" if rel_dir == os.curdir else rel_dir
+        if gitignore:
+            gitignore.add_file(rel_dir, Path(dirpath, ".gitignore"))
+
+        def rel_path(name):
+            return os.path.join(rel_dir, name)
+
+        def is_git_ignored(name, is_dir):
+            path = rel_path(name).replace(os.sep, "/")
+            return gitignore is not None and gitignore.is_ignored(path, is_dir)
+
+        def is_tracked(name, tracked):
+            return rel_path(name).replace(os.sep, "/") in tracked
+
+        def skip_dir(name):
+            # Like glob, we skip hidden directories
+            if name.startswith("."):
+                return True
+            excluded = (
+                rel_dir in excluded_dirs
+                or name in IGNORED_DIRS
+                or Path(dirpath, name, "pyvenv.cfg").exists()
+                or is_git_ignored(name, is_dir=True)
+            )
+            if not excluded:
+                return False
+            if is_tracked(name, tracked_dirs):
+                excluded_dirs.add(rel_path(name))
+                return False
+            return True
+
+        def skip_file(name):
+            if name.startswith(".") or not name.endswith(".py"):
+                return True
+            excluded = rel_dir in excluded_dirs or is_git_ignored(name, is_dir=False)
+            return excluded and not is_tracked(name, tracked_files)
+
+        def is_new_dir(name):
+            real_path = os.path.realpath(os.path.join(dirpath, name))
+            if real_path in seen_dirs:
+                return False
+            seen_dirs.add(real_path)
+            return True
+
+        seen_dirs.add(os.path.realpath(dirpath))
+        dirnames[:] = sorted(
+            name for name in dirnames if not skip_dir(name) and is_new_dir(name)
+        )
+        files_to_check.extend(
+            rel_path(name) for name in sorted(filenames) if not skip_file(name)
+        )
+    return files_to_check
+
+
+def get_tracked_files(root):
+    """
+    Return the set of paths, relative to `root`, of the files git tracks, or
+    None if `root` isn't in a git repository (or we don't have git)
+    """
+    try:
+        result = subprocess.run(
+            ["git", "ls-files", "-z"], cwd=root, capture_output=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return {os.fsdecode(path) for path in result.stdout.split(b"\0") if path}
+
+
+class GitIgnore:
+    """
+    The rules from the `.gitignore` files in a directory tree, supporting the
+    commonly used parts of the syntax: wildcards (including `**`), negation,
+    anchoring and directory-only patterns.
+
+    See: https://git-scm.com/docs/gitignore
+    """
+
+    def __init__(self):
+        # List of (base directory, regex, negated, directory only)
+        self.rules = []
+
+    def add_file(self, base, path):
+        """Add the rules from a `.gitignore` file in the directory `base`"""
+        try:
+            lines = path.read_text(encoding="utf8", errors="ignore").splitlines()
+        except OSError:
+            return
+        base = base.replace(os.sep, "/")
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.startswith("#"):
                 continue
-            if regex.search(line):
-                found_lines[ln] = line
-    return found_lines
+            negated = line.startswith("!")
+            if negated:
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            # Patterns with a slash are relative to the .gitignore's directory,
+            # others match at any depth below it
+            anchored = "/" in line
+            line = line.lstrip("/")
+            if not line:
+                continue
+            pattern = translate_gitignore_pattern(line)
+            if not anchored:
+                pattern = "(?:.*/)?" + pattern
+            self.rules.append((base, re.compile(pattern + "$"), negated, dir_only))
+
+    def is_ignored(self, path, is_dir):
+        path = path.replace(os.sep, "/")
+        ignored = False
+        # Later rules (including those from deeper .gitignores) take precedence
+        for base, regex, negated, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if base:
+                if not path.startswith(base + "/"):
+                    continue
+                rel_path = path[len(base) + 1 :]
+            else:
+                rel_path = path
+            if regex.match(rel_path):
+                ignored = not negated
+        return ignored
+
+
+def translate_gitignore_pattern(pattern):
+    """Convert a gitignore pattern into a regex, in which `*` doesn't match `/`"""
+    regex = ""
+    parts = pattern.split("/")
+    for i, part in enumerate(parts):
+        last = i == len(parts) - 1
+        if part == "**":
+            # Any number of directories (or, at the end, anything at all)
+            regex += ".*" if last else "(?:.*/)?"
+        else:
+            regex += translate_glob(part) + ("" if last else "/")
+    return regex
+
+
+def translate_glob(glob):
+    regex = ""
+    i = 0
+    while i < len(glob):
+        c = glob[i]
+        i += 1
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[" and "]" in glob[i + 1 :]:
+            end = glob.index("]", i + 1)
+            chars = glob[i:end]
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            regex += f"[{chars}]"
+            i = end + 1
+        elif c == "\\" and i < len(glob):
+            regex += re.escape(glob[i])
+            i += 1
+        else:
+            regex += re.escape(c)
+    return regex
+
+
+def get_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "opensafely"
+
+
+def get_cache_file():
+    # A cache for each project, as the paths of files are relative to it
+    project = hashlib.sha1(os.path.abspath(os.curdir).encode("utf-8")).hexdigest()
+    return get_cache_dir() / "check" / f"{project}.json"
+
+
+def write_json_atomic(path, data):
+    # Write to a temporary file and then move it into place so that concurrent
+    # invocations never see a partially written file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class ScanCache:
+    """
+    Results of scanning files for restricted functions, which we trust for as
+    long as a file's size and mtime and the functions we're looking for are
+    unchanged
+    """
+
+    # Files modified this recently might be modified again without their mtime
+    # changing, so we don't cache them (like git's "racy" index entries)
+    MIN_AGE_NS = 2 * 10**9
+
+    def __init__(self, path, functions):
+        self.path = path
+        self.functions = sorted(functions)
+        try:
+            cache = json.loads(path.read_text())
+            if cache["functions"] != self.functions:
+                raise ValueError("Looking for different functions")
+            self.entries = cache["files"]
+        except (OSError, ValueError, KeyError, TypeError):
+            self.entries = {}
+        self.new_entries = {}
+
+    def check_file(self, filename, regex):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return check_file(filename, regex)
+        key = [stat.st_size, stat.st_mtime_ns]
+        entry = self.entries.get(filename)
+        if entry and entry["stat"] == key:
+            self.new_entries[filename] = entry
+            return {
+                function: {ln: line for ln, line in lines}
+                for function, lines in entry["matches"].items()
+            }
+        matches = check_file(filename, regex)
+        if time.time_ns() - stat.st_mtime_ns >= self.MIN_AGE_NS:
+            # JSON objects only have string keys, so we store the line numbers
+            # and lines as pairs
+            self.new_entries[filename] = {
+                "stat": key,
+                "matches": {
+                    function: list(lines.items()) for function, lines in matches.items()
+                },
+            }
+        return matches
+
+    def save(self):
+        # This also drops the entries for any files we didn't look at
+        if self.new_entries == self.entries:
+            return
+        cache = {"functions": self.functions, "files": self.new_entries}
+        try:
+            write_json_atomic(self.path, cache)
+        except OSError:
+            # Failing to cache the results is never worth failing the check
+            pass
 
 
 def get_datasource_permissions(permissions_url):
-    resp = requests.get(permissions_url)
-    if resp.status_code != 200:
-        raise requests.RequestException(
-            f"Error {resp.status_code} getting {permissions_url}"
+    """
+    Return the permissions document, using our cached copy if we fetched it
+    less than PERMISSIONS_CACHE_TTL seconds ago, or if we can't fetch it now
+    (e.g. because we're offline)
+    """
+    cache_file = get_cache_dir() / "repository_permissions.json"
+    try:
+        cached = json.loads(cache_file.read_text())
+        if cached["url"] != permissions_url:
+            cached = None
+    except (OSError, ValueError, KeyError, TypeError):
+        cached = None
+    if cached and time.time() - cached["fetched_at"] < PERMISSIONS_CACHE_TTL:
+        return cached["permissions"]
+
+    headers = {}
+    if cached and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    try:
+        resp = requests.get(
+            permissions_url, headers=headers, timeout=PERMISSIONS_TIMEOUT
         )
-    yaml = YAML()
-    permissions = yaml.load(resp.text)
+        if resp.status_code == 304 and cached:
+            permissions = cached["permissions"]
+        elif resp.status_code != 200:
+            raise requests.RequestException(
+                f"Error {resp.status_code} getting {permissions_url}"
+            )
+        else:
+            permissions = YAML(typ="safe").load(resp.text)
+    except requests.RequestException:
+        if cached:
+            return cached["permissions"]
+        raise
+
+    etag = resp.headers.get("ETag")
+    if resp.status_code == 304:
+        # A 304 response needn't include the ETag again
+        etag = etag or headers["If-None-Match"]
+    cached = {
+        "url": permissions_url,
+        "etag": etag,
+        "fetched_at": time.time(),
+        "permissions": permissions,
+    }
+    try:
+        write_json_atomic(cache_file, cached)
+    except (OSError, TypeError, ValueError):
+        # Failing to cache the permissions is never worth failing the check
+        pass
     return permissions
 
 
@@ -5,6 +5,8 @@ import json
 import os
 import sys
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # from opensafely._vendor import requests
@@ -16,6 +18,14 @@ CODELISTS_DIR = "codelists"
 CODELISTS_FILE = "codelists.txt"
 MANIFEST_FILE = "codelists.json"
 
+# Maximum number of codelists we download at once
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Once the cache of downloaded codelists shared by all projects grows beyond
+# this many bytes we delete the least recently used ones
+CACHE_MAX_SIZE = 256 * 1024 * 1024
+
 
 def add_arguments(parser):
     def show_help(**kwargs):
@@ -45,6 +55,11 @@ def add_arguments(parser):
         ),
     )
     parser_check.set_defaults(function=check)
+    parser_check.add_argument(
+        "--strict",
+        action="store_true",
+        help="Re-hash every CSV file, even those which don't appear to have changed",
+    )
 
 
 # Just here for consistency so we can always reference `<module>.main()` in the
@@ -61,24 +76,20 @@ def update(codelists_dir=None):
     old_files = set(codelists_dir.glob("*.csv"))
     new_files = set()
     manifest = {"files": {}}
-    for codelist in codelists:
-        print(f"Fetching {codelist.id}")
-        try:
-            response = requests.get(codelist.download_url)
-            response.raise_for_status()
-        except Exception as e:
-            exit_with_error(
-                f"Error downloading codelist: {e}\n\n"
-                f"Check that you can access the codelist at:\n{codelist.url}"
-            )
-        codelist.filename.write_bytes(response.content)
+    cache = CodelistCache(get_cache_dir())
+    downloads = download_codelists(codelists, codelists_dir, cache)
+    # We build the manifest in the order the codelists are listed, rather than
+    # the order their downloads happened to finish, so that it only changes
+    # when they do
+    for codelist, (tmp_file, sha) in zip(codelists, downloads):
+        os.replace(tmp_file, codelist.filename)
         new_files.add(codelist.filename)
         key = str(codelist.filename.relative_to(codelists_dir))
         manifest["files"][key] = {
             "id": codelist.id,
             "url": codelist.url,
             "downloaded_at": f"{datetime.datetime.utcnow()}Z",
-            "sha": hash_bytes(response.content),
+            "sha": sha,
         }
     manifest_file = codelists_dir / MANIFEST_FILE
     preserve_download_dates(manifest, manifest_file)
@@ -86,10 +97,107 @@ def update(codelists_dir=None):
     for file in old_files - new_files:
         print(f"Deleting {file.name}")
         file.unlink()
+    cache.evict()
     return True
 
 
-def check():
+def download_codelists(codelists, codelists_dir, cache):
+    """
+    Download the codelists, several at a time, each to a temporary file in
+    `codelists_dir`. Codelists we've downloaded before are copied from the
+    cache instead. Returns a list of (temporary file, sha) for each codelist,
+    in the same order as `codelists`.
+
+    If any of the downloads fail we delete all the temporary files and exit,
+    so the existing codelists are left untouched.
+    """
+    session = get_session()
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        futures = []
+        for codelist in codelists:
+            cached = cache.get(codelist.id)
+            if cached:
+                print(f"Using cached {codelist.id}")
+            else:
+                print(f"Fetching {codelist.id}")
+            futures.append(
+                pool.submit(
+                    fetch_codelist, session, cache, cached, codelist, codelists_dir
+                )
+            )
+    downloads = []
+    error = None
+    for codelist, future in zip(codelists, futures):
+        try:
+            downloads.append(future.result())
+        except Exception as e:
+            error = error or (codelist, e)
+    if error:
+        for tmp_file, _ in downloads:
+            tmp_file.unlink()
+        codelist, e = error
+        exit_with_error(
+            f"Error downloading codelist: {e}\n\n"
+            f"Check that you can access the codelist at:\n{codelist.url}"
+        )
+    return downloads
+
+
+def fetch_codelist(session, cache, cached, codelist, codelists_dir):
+    if cached:
+        cached_file, cached_sha = cached
+        try:
+            with cached_file.open("rb") as f:
+                chunks = iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b"")
+                tmp_file, sha = write_temp_file(chunks, codelists_dir)
+        except OSError:
+            pass
+        else:
+            if sha == cached_sha:
+                return tmp_file, sha
+            # The cache has been corrupted somehow, so download it afresh
+            tmp_file.unlink()
+    tmp_file, sha = download_codelist(session, codelist, codelists_dir)
+    cache.put(codelist.id, tmp_file, sha)
+    return tmp_file, sha
+
+
+def download_codelist(session, codelist, codelists_dir):
+    """
+    Stream a codelist to a temporary file, hashing it as we go, and return the
+    path of the file and its sha
+    """
+    with session.get(codelist.download_url, stream=True) as response:
+        response.raise_for_status()
+        chunks = response.iter_content(DOWNLOAD_CHUNK_SIZE)
+        return write_temp_file(chunks, codelists_dir)
+
+
+def write_temp_file(chunks, directory):
+    hasher = NormalisedHasher()
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    tmp_file = Path(tmp_path)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                hasher.update(chunk)
+    except BaseException:
+        tmp_file.unlink()
+        raise
+    return tmp_file, hasher.hexdigest()
+
+
+def get_session():
+    session = requests.Session()
+    # Keep a connection open for each of the download workers
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=DOWNLOAD_WORKERS)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def check(strict=False):
     codelists_dir = Path.cwd() / CODELISTS_DIR
     if not codelists_dir.exists():
         print(f"No '{CODELISTS_DIR}' directory present so nothing to check")
@@ -136,11 +244,13 @@ def check():
             f"'{CODELISTS_DIR}' folder.\n{diff}\n"
         )
     modified = []
+    stat_cache = StatCache(get_stat_cache_file(codelists_dir), strict=strict)
     for filename, details in manifest["files"].items():
         csv_file = codelists_dir / filename
-        sha = hash_bytes(csv_file.read_bytes())
+        sha = stat_cache.get_sha(csv_file)
         if sha != details["sha"]:
             modified.append(f"  {CODELISTS_DIR}/{filename}")
+    stat_cache.save()
     if modified:
         exit_with_prompt(
             "A CSV file seems to have been modified since it was downloaded:\n"
@@ -150,7 +260,62 @@ def check():
     return True
 
 
+def get_stat_cache_file(codelists_dir):
+    # A cache for each project, kept outside it so that it never gets
+    # committed along with the codelists
+    project = hashlib.sha1(str(codelists_dir.resolve()).encode("utf-8")).hexdigest()
+    return get_cache_dir() / "stat" / f"{project}.json"
+
+
+class StatCache:
+    """
+    Cache of the shas of files, which we trust for as long as a file's size,
+    mtime and inode are unchanged, so that `check` only needs to re-hash files
+    which look like they've changed. With `strict` we re-hash every file (and
+    update the cache).
+    """
+
+    # Files modified this recently might be modified again without their mtime
+    # changing, so we don't cache them (like git's "racy" index entries)
+    MIN_AGE_NS = 2 * 10**9
+
+    def __init__(self, path, strict=False):
+        self.path = path
+        self.strict = strict
+        try:
+            self.entries = json.loads(path.read_text())["files"]
+        except (OSError, ValueError, KeyError, TypeError):
+            self.entries = {}
+        self.new_entries = {}
+
+    def get_sha(self, file):
+        stat = file.stat()
+        key = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        entry = self.entries.get(file.name)
+        if not self.strict and entry and entry["stat"] == key:
+            self.new_entries[file.name] = entry
+            return entry["sha"]
+        sha = hash_bytes(file.read_bytes())
+        if time.time_ns() - stat.st_mtime_ns >= self.MIN_AGE_NS:
+            self.new_entries[file.name] = {"stat": key, "sha": sha}
+        return sha
+
+    def save(self):
+        # This also drops the entries for any files we didn't look at
+        if self.new_entries == self.entries:
+            return
+        try:
+            CodelistCache.write_atomic(
+                self.path, json.dumps({"files": self.new_entries}).encode("utf-8")
+            )
+        except OSError:
+            # e.g. a read-only home directory, in which case we just go without
+            pass
+
+
 def make_temporary_manifest(codelists_dir):
+    # This uses the cache of downloaded codelists, so works offline if the
+    # cache has been pre-seeded
     with tempfile.TemporaryDirectory() as tmpdir:
         tmpdir = Path(tmpdir)
         contents = codelists_dir.joinpath(CODELISTS_FILE).read_bytes()
@@ -160,6 +325,104 @@ def make_temporary_manifest(codelists_dir):
     return manifest
 
 
+def get_cache_dir():
+    if os.environ.get("OPENSAFELY_CODELISTS_CACHE"):
+        return Path(os.environ["OPENSAFELY_CODELISTS_CACHE"])
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "opensafely" / "codelists"
+
+
+class CodelistCache:
+    """
+    Cache of downloaded codelists shared between all the projects on a
+    machine. Versions of codelists never change once published, so we only
+    ever need to download each one once.
+
+    The contents of codelists are stored, as downloaded, in `objects/` under
+    their (normalised) sha, and we record the sha of each codelist in `ids/`.
+    We can pre-seed the cache (e.g. in CI) by pointing the
+    OPENSAFELY_CODELISTS_CACHE environment variable at a copy of it.
+
+    The cache is never the reason an update fails: if we can't read from it
+    we download the codelists instead, and if we can't write to it we carry
+    on without it.
+    """
+
+    def __init__(self, path, max_size=CACHE_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    def get(self, codelist_id):
+        """Return (path, sha) of the cached contents of a codelist, or None"""
+        try:
+            entry = json.loads(self.id_file(codelist_id).read_text())
+            sha = entry["sha"]
+            object_file = self.object_file(sha)
+            # Mark it as recently used
+            os.utime(object_file)
+        except (OSError, ValueError, KeyError):
+            return None
+        return object_file, sha
+
+    def put(self, codelist_id, source_file, sha):
+        try:
+            object_file = self.object_file(sha)
+            if not object_file.exists():
+                self.write_atomic(object_file, source_file.read_bytes())
+            entry = {"id": codelist_id, "sha": sha}
+            self.write_atomic(
+                self.id_file(codelist_id), json.dumps(entry).encode("utf-8")
+            )
+        except OSError:
+            pass
+
+    def evict(self):
+        """
+        Delete the least recently used codelists until the cache is no larger
+        than `max_size` bytes. We leave the entries in `ids/` pointing at them,
+        which will just be cache misses.
+        """
+        try:
+            objects = [
+                (path.stat(), path)
+                for path in self.path.glob("objects/*")
+                if not path.name.endswith(".tmp")
+            ]
+        except OSError:
+            return
+        total_size = sum(stat.st_size for stat, _ in objects)
+        for stat, path in sorted(objects, key=lambda item: item[0].st_mtime):
+            if total_size <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total_size -= stat.st_size
+
+    def id_file(self, codelist_id):
+        # Codelist ids contain slashes, so we use a hash of them as filenames
+        key = hashlib.sha1(codelist_id.encode("utf-8")).hexdigest()
+        return self.path / "ids" / f"{key}.json"
+
+    def object_file(self, sha):
+        return self.path / "objects" / sha
+
+    @staticmethod
+    def write_atomic(path, content):
+        # Several projects can be updating at once, so we write to a
+        # temporary file and move it into place
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
 @dataclasses.dataclass
 class Codelist:
     id: str
@@ -220,6 +483,40 @@ def hash_bytes(content):
     return hashlib.sha1(content).hexdigest()
 
 
+class NormalisedHasher:
+    """
+    Incremental version of `hash_bytes()`, for content which arrives in chunks
+
+    Joining the lines with "\n" normalises "\r\n" and "\r" to "\n" and drops
+    any final line ending, which we reproduce here. A "\r\n" can be split
+    across chunks, and we can't know if a line ending is the final one until
+    we've seen the next chunk, so we carry both over.
+    """
+
+    def __init__(self):
+        self.sha = hashlib.sha1()
+        self.after_cr = False
+        self.held_newline = False
+
+    def update(self, chunk):
+        if not chunk:
+            return
+        if self.after_cr and chunk.startswith(b"\n"):
+            # The rest of a "\r\n" which we've already counted
+            chunk = chunk[1:]
+        self.after_cr = chunk.endswith(b"\r")
+        chunk = chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        if self.held_newline:
+            chunk = b"\n" + chunk
+        self.held_newline = chunk.endswith(b"\n")
+        if self.held_newline:
+            chunk = chunk[:-1]
+        self.sha.update(chunk)
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+
 def format_diff(set_a, set_b):
     return "\n".join(
         [
@@ -1,14 +1,16 @@
+import json
 import subprocess
 import sys
-from http.cookiejar import split_header_words
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from urllib.parse import urlparse
 
-# from opensafely._vendor import requests
-import requests
-
+from opensafely import registry
 from opensafely._vendor.jobrunner import config
 from opensafely._vendor.jobrunner.cli.local_run import docker_preflight_check
+from opensafely._vendor.jobrunner.lib import docker_api
 
 # from opensafely._vendor.ruamel.yaml import YAML
 from ruamel.yaml import YAML
@@ -22,11 +24,22 @@ DESCRIPTION = (
     "Command for updating the docker images used to run MediciaSAFELY studies locally"
 )
 REGISTRY = config.DOCKER_REGISTRY
+REGISTRY_HOST = REGISTRY.partition("/")[0]
 IMAGES = list(config.ALLOWED_IMAGES)
 FULL_IMAGES = {f"{REGISTRY}/{image}" for image in IMAGES}
 DEPRECATED_REGISTRIES = ["docker.opensafely.org", "ghcr.io/opensafely"]
 IMAGES.sort()  # this is just for consistency for testing
 
+# Digests of the latest images in the registry, so that we don't need to ask
+# the registry for them on every invocation. After DIGEST_CACHE_TTL seconds we
+# check with the registry whether they've changed.
+DIGEST_CACHE_FILE = Path(tempfile.gettempdir()) / "opensafely-image-digests.json"
+DIGEST_CACHE_TTL = 2 * 60 * 60
+
+# Maximum number of images we pull at once. The images share many of their
+# layers, which docker only downloads once however many pulls need them.
+PULL_WORKERS = 4
+
 
 def add_arguments(parser):
     choices = ["all"] + IMAGES
@@ -63,19 +76,22 @@ def main(image="all", force=False, project=None):
         images = [image]
 
     local_images = get_local_images()
-    try:
-        updated = False
-        for image in images:
-            # currently databuilder is not published, so we ignore it when pulling
-            if image == "databuilder":
-                continue
-            tag = f"{REGISTRY}/{image}"
-            if force or tag in local_images:
-                updated = True
-                print(f"Updating MediciaSAFELY {image} image")
-                subprocess.run(["docker", "pull", tag + ":latest"], check=True)
+    tags = []
+    for image in images:
+        # currently databuilder is not published, so we ignore it when pulling
+        if image == "databuilder":
+            continue
+        tag = f"{REGISTRY}/{image}"
+        if force or tag in local_images:
+            print(f"Updating MediciaSAFELY {image} image")
+            tags.append(tag + ":latest")
 
-        if updated:
+    try:
+        if tags:
+            pull_images(tags)
+            # The digests we've cached may be older than the images we've
+            # just pulled
+            clear_digest_cache()
             print("Cleaning up old images")
             remove_deprecated_images(local_images)
             subprocess.run(["docker", "image", "prune", "--force"], check=True)
@@ -86,6 +102,107 @@ def main(image="all", force=False, project=None):
         sys.exit(exc.stderr)
 
 
+def pull_images(tags, workers=PULL_WORKERS):
+    """
+    Pull the given images, up to `workers` at a time, showing their combined
+    progress. Raises CalledProcessError if any of them fail, once they've all
+    finished.
+    """
+    progress = PullProgress(tags, interactive=sys.stdout.isatty())
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(pull_image, tag, progress) for tag in tags]
+    progress.finish()
+    for future in futures:
+        future.result()
+
+
+def pull_image(tag, progress):
+    cmd = ["docker", "pull", tag]
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+    )
+    output = []
+    for line in process.stdout:
+        output.append(line)
+        progress.update(tag, line)
+    returncode = process.wait()
+    progress.done(tag, failed=returncode != 0)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(
+            returncode, cmd, output="".join(output), stderr="".join(output)
+        )
+
+
+class PullProgress:
+    """
+    Combined progress of several concurrent `docker pull`s, based on the
+    per-layer status lines (e.g. "3f4d90098f5b: Pull complete") which docker
+    prints when its output isn't a terminal.
+
+    When `interactive` is true we keep a single status line up to date,
+    otherwise we just print a line as each image finishes.
+    """
+
+    LAYER_DONE = {"Pull complete", "Already exists"}
+
+    def __init__(self, tags, interactive=False, stream=None):
+        self.tags = list(tags)
+        self.interactive = interactive
+        self.stream = stream or sys.stdout
+        self.layers = {tag: {} for tag in self.tags}
+        self.finished = {}
+        self.lock = threading.Lock()
+
+    def update(self, tag, line):
+        layer, sep, status = line.strip().partition(": ")
+        # Ignore everything which isn't a layer status, e.g. "Digest: ..."
+        if not sep or not is_layer_id(layer):
+            return
+        with self.lock:
+            self.layers[tag][layer] = status
+            self.show()
+
+    def done(self, tag, failed=False):
+        with self.lock:
+            self.finished[tag] = "failed" if failed else "done"
+            if self.interactive:
+                self.show()
+            else:
+                print(
+                    f"[{len(self.finished)}/{len(self.tags)}] {tag}: "
+                    f"{self.finished[tag]}",
+                    file=self.stream,
+                    flush=True,
+                )
+
+    def finish(self):
+        if self.interactive:
+            print(file=self.stream, flush=True)
+
+    def describe(self, tag):
+        if tag in self.finished:
+            return self.finished[tag]
+        layers = self.layers[tag]
+        if not layers:
+            return "waiting"
+        complete = sum(status in self.LAYER_DONE for status in layers.values())
+        return f"{complete}/{len(layers)} layers"
+
+    def summary(self):
+        return ", ".join(
+            f"{tag.rpartition('/')[2]} {self.describe(tag)}" for tag in self.tags
+        )
+
+    def show(self):
+        if self.interactive:
+            # Clear the rest of the line in case it's shorter than before
+            print(f"\r{self.summary()}\x1b[K", end="", file=self.stream, flush=True)
+
+
+def is_layer_id(value):
+    return len(value) == 12 and all(c in "0123456789abcdef" for c in value)
+
+
 def get_actions_from_project_file(project_yaml):
     path = Path(project_yaml)
     if not path.exists():
@@ -106,7 +223,9 @@ def get_actions_from_project_file(project_yaml):
             continue
 
         name, _, version = command.partition(":")
-        if name in IMAGES:
+        # Several actions (possibly using different versions) can share an
+        # image, which we only want to pull once
+        if name in IMAGES and name not in images:
             images.append(name)
 
     if not images:
@@ -117,11 +236,19 @@ def get_actions_from_project_file(project_yaml):
 
 def get_local_images():
     """Returns a dict of locally installed MediciaSAFELY images and their SHA."""
+    client = docker_api.get_client()
+    if client is not None:
+        try:
+            return get_local_images_from_api(client)
+        except (OSError, docker_api.DockerAPIError):
+            # Fall back to the CLI, which will give a more helpful error if
+            # there's something wrong with docker
+            pass
     ps = subprocess.run(
         [
             "docker",
             "images",
-            "ghcr.io/mediciaai/*",
+            f"{REGISTRY}/*",
             "--no-trunc",
             "--format={{.Repository}}={{.ID}}",
         ],
@@ -134,66 +261,87 @@ def get_local_images():
     return {k: v for k, v in all_images.items() if k in FULL_IMAGES}
 
 
+def get_local_images_from_api(client):
+    """As get_local_images() but asks the docker daemon directly."""
+    filters = json.dumps({"reference": [f"{REGISTRY}/*"]})
+    response = client.request("GET", "/images/json", params={"filters": filters})
+    if response.status != 200:
+        raise docker_api.DockerAPIError(response.status, response.message)
+    local_images = {}
+    for image in response.json():
+        for repo_tag in image.get("RepoTags") or []:
+            repository, _, tag = repo_tag.rpartition(":")
+            if repository not in FULL_IMAGES:
+                continue
+            # Prefer the image tagged "latest" as that's the one we compare
+            if tag == "latest" or repository not in local_images:
+                local_images[repository] = image["Id"]
+    return local_images
+
+
 def remove_deprecated_images(local_images):
     """Temporary clean up functon to remove orphaned images."""
-    for registry in DEPRECATED_REGISTRIES:
+    for deprecated_registry in DEPRECATED_REGISTRIES:
         for image in IMAGES:
-            tag = f"{registry}/{image}"
+            tag = f"{deprecated_registry}/{image}"
             if tag in local_images:
                 subprocess.run(["docker", "image", "rm", tag], capture_output=True)
 
 
-session = requests.Session()
-token = None
+def get_registry_client(cache_file=None):
+    return registry.RegistryClient(f"https://{REGISTRY_HOST}", cache_file=cache_file)
 
 
-def get_remote_sha(full_name, tag):
+def get_remote_sha(full_name, tag, client=None):
     """Get the current sha for a tag from a docker registry."""
-    global token
-
-    parsed = urlparse("https://" + full_name)
-    manifest_url = f"https://ghcr.io/v2/{parsed.path}/manifests/{tag}"
-
-    if token is None:
-        # Docker API requires auth token, even for public resources.
-        # However, we can reuse a public token.
-        response = session.get(manifest_url)
-        token = get_auth_token(response.headers["www-authenticate"])
+    client = client or get_registry_client()
+    repository = urlparse("https://" + full_name).path.lstrip("/")
+    return client.get_digest(repository, tag)
 
-    response = session.get(manifest_url, headers={"Authorization": f"Bearer {token}"})
-    response.raise_for_status()
-    return response.json()["config"]["digest"]
 
-
-def get_auth_token(header):
-    """Parse a docker v2 www-authentication header and fetch a token.
-
-    Bearer realm="https://ghcr.io/token",service="ghcr.io",scope="repository:mediciaai/busybox:pull"
-    """
-    header = header.lstrip("Bearer")
-    # split_header_words is weird, but better than doing it ourselves
-    words = split_header_words([header])
-    values = dict(next(zip(*words)))
-    url = values.pop("realm")
-    auth_response = session.get(url, params=values)
-    return auth_response.json()["token"]
+def clear_digest_cache():
+    try:
+        DIGEST_CACHE_FILE.unlink()
+    except FileNotFoundError:
+        pass
 
 
-def check_version():
+def get_outdated_images():
     need_update = []
     local_images = get_local_images()
+    # A single client, so that we only need one token for all the images
+    client = get_registry_client(cache_file=DIGEST_CACHE_FILE)
 
     for image in IMAGES:
         full_name = f"{REGISTRY}/{image}"
         local_sha = local_images.get(full_name)
         if local_sha is None:
             continue
-        if local_sha != get_remote_sha(full_name, "latest"):
+        repository = full_name[len(REGISTRY_HOST) + 1 :]
+        remote_sha = client.get_digest(repository, "latest", max_age=DIGEST_CACHE_TTL)
+        if local_sha != remote_sha:
             need_update.append(image)
 
+    return need_update
+
+
+def format_version_warning(need_update):
+    return (
+        f"Warning: the MediciaSAFELY docker images for {', '.join(need_update)} actions are out of date - please update by running:\n"
+        "    opensafely pull\n"
+    )
+
+
+def get_version_warning():
+    """Return a warning if any local images are out of date, otherwise None"""
+    need_update = get_outdated_images()
     if need_update:
-        print(
-            f"Warning: the MediciaSAFELY docker images for {', '.join(need_update)} actions are out of date - please update by running:\n"
-            "    opensafely pull\n"
-        )
+        return format_version_warning(need_update)
+    return None
+
+
+def check_version():
+    need_update = get_outdated_images()
+    if need_update:
+        print(format_version_warning(need_update))
     return need_update
@@ -0,0 +1,164 @@
+"""
+Minimal client for the docker registry HTTP API, which we use to find the
+digests of the latest versions of images without involving docker itself
+
+Registries require a token even for public images. We fetch one the first time
+we're challenged for it and re-use it until it expires. Digests are persisted
+along with the manifest's ETag, so that we can usually confirm an image hasn't
+changed with a conditional request which returns `304 Not Modified`.
+
+See: https://docs.docker.com/registry/spec/api/
+"""
+import json
+import os
+import tempfile
+import time
+from http.cookiejar import split_header_words
+
+import requests
+
+# Tokens which don't say how long they last are valid for 60 seconds, see:
+# https://docs.docker.com/registry/spec/auth/token/
+DEFAULT_TOKEN_EXPIRES_IN = 60
+
+# Allowance for the time between fetching a token and using it
+TOKEN_EXPIRY_MARGIN = 5
+
+
+class RegistryClient:
+    def __init__(self, url="https://ghcr.io", cache_file=None, session=None):
+        """
+        `url` is the base URL of the registry and `cache_file` is the path of
+        a JSON file in which to persist digests (if any)
+        """
+        self.url = url.rstrip("/")
+        self.cache_file = cache_file
+        self.session = session or requests.Session()
+        # Maps (realm, service) to (token, expiry time)
+        self.tokens = {}
+        # The last challenge we got, whose token we use for new requests
+        self.challenge = None
+
+    def get_digest(self, repository, tag="latest", max_age=None):
+        """
+        Return the digest of the config of the given image, i.e. the ID docker
+        gives the image once pulled
+
+        If we've cached the digest less than `max_age` seconds ago we use that
+        without asking the registry.
+        """
+        key = f"{repository}:{tag}"
+        entry = self.read_cache().get(key)
+        if (
+            entry
+            and max_age is not None
+            and time.time() - entry["timestamp"] < max_age
+        ):
+            return entry["digest"]
+
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        response = self.get(f"{self.url}/v2/{repository}/manifests/{tag}", headers)
+        if response.status_code == 304 and "If-None-Match" in headers:
+            digest = entry["digest"]
+            etag = entry.get("etag")
+        else:
+            response.raise_for_status()
+            if response.status_code != 200:
+                # raise_for_status() lets redirects through, and a 304 to a
+                # request which wasn't conditional has no digest for us
+                raise requests.HTTPError(
+                    f"Unexpected {response.status_code} response for {response.url}",
+                    response=response,
+                )
+            digest = response.json()["config"]["digest"]
+            etag = response.headers.get("ETag")
+
+        self.update_cache(key, {"digest": digest, "etag": etag, "timestamp": time.time()})
+        return digest
+
+    def get(self, url, headers):
+        """
+        Make an authenticated GET request, fetching a new token if the registry
+        challenges us for one
+        """
+        token = self.get_cached_token(self.challenge)
+        response = self.session.get(url, headers=self.with_token(headers, token))
+        if response.status_code == 401 and "www-authenticate" in response.headers:
+            self.challenge = parse_challenge(response.headers["www-authenticate"])
+            token = self.fetch_token(self.challenge)
+            response = self.session.get(url, headers=self.with_token(headers, token))
+        return response
+
+    def get_cached_token(self, challenge):
+        if challenge is None:
+            return None
+        token, expires_at = self.tokens.get(token_key(challenge), (None, 0))
+        if time.time() >= expires_at:
+            return None
+        return token
+
+    def fetch_token(self, challenge):
+        params = dict(challenge)
+        url = params.pop("realm")
+        response = self.session.get(url, params=params)
+        response.raise_for_status()
+        data = response.json()
+        # The spec allows "access_token" as an alias for "token"
+        token = data.get("token") or data["access_token"]
+        expires_in = data.get("expires_in", DEFAULT_TOKEN_EXPIRES_IN)
+        expires_at = time.time() + expires_in - TOKEN_EXPIRY_MARGIN
+        self.tokens[token_key(challenge)] = (token, expires_at)
+        return token
+
+    @staticmethod
+    def with_token(headers, token):
+        if token is None:
+            return headers
+        return {**headers, "Authorization": f"Bearer {token}"}
+
+    def read_cache(self):
+        if self.cache_file is None:
+            return {}
+        try:
+            return json.loads(self.cache_file.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def update_cache(self, key, entry):
+        if self.cache_file is None:
+            return
+        # Re-read the cache in case it's been updated by another invocation
+        # since we last looked
+        cache = self.read_cache()
+        cache[key] = entry
+        # Write to a temporary file and then move it into place so that
+        # concurrent invocations never see a partially written file
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_file.parent)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, self.cache_file)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def parse_challenge(header):
+    """Parse a docker v2 www-authenticate header into a dict
+
+    Bearer realm="https://ghcr.io/token",service="ghcr.io",scope="repository:mediciaai/busybox:pull"
+    """
+    header = header.strip()
+    if header.lower().startswith("bearer"):
+        header = header[len("bearer") :]
+    # split_header_words is weird, but better than doing it ourselves
+    words = split_header_words([header])
+    return dict(next(zip(*words)))
+
+
+def token_key(challenge):
+    # Tokens for public images aren't specific to the image, so we share them
+    # between all the images from the same service
+    return (challenge["realm"], challenge.get("service"))
@@ -94,12 +94,19 @@ def need_to_update(latest):
     return comparable(latest) > comparable(current)
 
 
-def check_version():
+def get_version_warning():
+    """Return a warning if there is a newer version available, otherwise None"""
     latest = get_latest_version()
-    update = need_to_update(latest)
-    if update:
-        print(
+    if need_to_update(latest):
+        return (
             f"Warning: there is a newer version of opensafely available ({latest}) - please upgrade by running:\n"
             "    opensafely upgrade\n"
         )
-    return update
+    return None
+
+
+def check_version():
+    warning = get_version_warning()
+    if warning:
+        print(warning)
+    return warning is not None
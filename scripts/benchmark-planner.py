@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Time how long the job-runner takes to plan the jobs for large generated
+projects, of several shapes, from an empty workspace and from one in which
+every action has already succeeded.
+
+Usage: ./scripts/benchmark-planner.py [NUMBER_OF_ACTIONS]
+"""
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from opensafely._vendor.jobrunner.create_or_update_jobs import plan_jobs  # noqa: E402
+from opensafely._vendor.jobrunner.models import Job, JobRequest, State  # noqa: E402
+
+# Layered projects have this many actions in each layer, each needing up to
+# NEEDS_PER_ACTION actions from earlier layers
+LAYER_SIZE = 50
+NEEDS_PER_ACTION = 5
+
+
+def generate_project(shape, size, seed=0):
+    rnd = random.Random(seed)
+    actions = {}
+    for i in range(size):
+        if shape == "chain":
+            needs = [i - 1] if i else []
+        elif shape == "wide":
+            needs = [0] if i else []
+        elif shape == "fan-in":
+            needs = list(range(1, size)) if i == 0 else []
+        elif shape == "layered":
+            layer_start = (i // LAYER_SIZE) * LAYER_SIZE
+            needs = sorted(
+                {rnd.randrange(layer_start) for _ in range(NEEDS_PER_ACTION)}
+                if layer_start
+                else []
+            )
+        else:
+            raise ValueError(f"Unknown shape: {shape}")
+        actions[f"a{i}"] = {
+            "run": f"python:latest analysis/a{i}.py",
+            "needs": [f"a{n}" for n in needs],
+            "outputs": {"moderately_sensitive": {"o": f"output/a{i}.csv"}},
+        }
+    return {"version": 3, "actions": actions}
+
+
+def make_job_request(actions, **kwargs):
+    return JobRequest(
+        id="request",
+        repo_url="repo",
+        commit="abcdef",
+        requested_actions=actions,
+        cancelled_actions=[],
+        workspace="workspace",
+        database_name="dummy",
+        **kwargs,
+    )
+
+
+def best_time(fn, *args, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(size):
+    for shape in ["chain", "wide", "fan-in", "layered"]:
+        project = generate_project(shape, size)
+        succeeded = [
+            Job(id=f"job-{action}", action=action, state=State.SUCCEEDED)
+            for action in project["actions"]
+        ]
+        last_action = list(project["actions"])[-1]
+        cases = [
+            ("run_all, empty workspace", make_job_request(["run_all"]), []),
+            (
+                "run_all --force-run-dependencies",
+                make_job_request(["run_all"], force_run_dependencies=True),
+                succeeded,
+            ),
+            ("last action, all succeeded", make_job_request([last_action]), succeeded),
+        ]
+        for description, job_request, current_jobs in cases:
+            seconds = best_time(plan_jobs, job_request, project, current_jobs)
+            print(f"{shape:8} {description:35} {seconds * 1000:8.1f}ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -13,9 +13,6 @@ from opensafely import check
 # from opensafely._vendor import requests
 import requests
 
-# from opensafely._vendor.ruamel.yaml.comments import CommentedMap
-from ruamel.yaml.comments import CommentedMap
-
 # from opensafely._vendor.requests.exceptions import RequestException
 from requests.exceptions import RequestException
 
@@ -39,6 +36,13 @@ opensafely/dummy_all:
     allow: ['icnarc','ons','therapeutics', 'isaric]
 """
 
+PERMISSIONS_TEXT_VALID = """
+opensafely/dummy_icnarc:
+    allow: ['icnarc']
+opensafely/dummy_all:
+    allow: ['icnarc', 'ons', 'therapeutics', 'isaric']
+"""
+
 
 class Repo(Enum):
     PERMITTED_ICNARC = "opensafely/dummy_icnarc"
@@ -166,6 +170,13 @@ def validate_norepo(capsys, continue_on_error):
         assert stdout == ""
 
 
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path_factory, monkeypatch):
+    cache_home = tmp_path_factory.mktemp("cache")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(cache_home))
+    yield cache_home
+
+
 @pytest.fixture
 def repo_path(tmp_path):
     prev_dir = os.getcwd()
@@ -256,7 +267,280 @@ def test_repository_permissions_yaml():
             pytest.xfail("Permissions file does not exist on main yet") 
 
     assert permissions, "empty permissions file"
-    assert type(permissions) == CommentedMap, "invalid permissions file"
+    assert type(permissions) == dict, "invalid permissions file"
     for k, v in permissions.items():
         assert len(v.keys()) == 1, f"multiple keys specified for {k}"
         assert "allow" in v.keys(), f"allow key not present for {k}"
+
+
+def write_files(root, files):
+    for name, contents in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(contents)
+
+
+def test_find_files_to_check(repo_path):
+    subprocess.run(["git", "init", "-q"], check=True)
+    write_files(
+        repo_path,
+        {
+            "analysis/study_definition.py": "",
+            "analysis/notes.txt": "",
+            "analysis/.hidden.py": "",
+            "analysis/__pycache__/study_definition.py": "",
+            ".git/hooks/hook.py": "",
+            "venv/pyvenv.cfg": "",
+            "venv/lib/site.py": "",
+            "myenv/pyvenv.cfg": "",
+            "myenv/lib/site.py": "",
+            "node_modules/x.py": "",
+            "output/generated.py": "",
+            "lib/build/generated.py": "",
+            "lib/keep/build/generated.py": "",
+            "lib/keep/util.py": "",
+            "lib/scratch_1.py": "",
+            "lib/scratch_important.py": "",
+            ".gitignore": "# comment\n/output/\nbuild/\n",
+            "lib/.gitignore": "scratch_*.py\n!scratch_important.py\n",
+        },
+    )
+    assert check.find_files_to_check() == [
+        os.path.join("analysis", "study_definition.py"),
+        os.path.join("lib", "scratch_important.py"),
+        os.path.join("lib", "keep", "util.py"),
+    ]
+
+
+def test_find_files_to_check_tracked_but_ignored(repo_path):
+    subprocess.run(["git", "init", "-q"], check=True)
+    write_files(
+        repo_path,
+        {
+            ".gitignore": "/output/\nscratch_*.py\n",
+            "output/tracked.py": "",
+            "output/untracked.py": "",
+            "analysis/scratch_tracked.py": "",
+            "analysis/scratch_untracked.py": "",
+        },
+    )
+    write_study_def(repo_path / "output", Dataset.RESTRICTED)
+    subprocess.run(
+        ["git", "add", "-f", "output/tracked.py", "analysis/scratch_tracked.py"],
+        check=True,
+    )
+    subprocess.run(
+        ["git", "add", "-f", "output/study_definition_restricted_1.py"], check=True
+    )
+
+    files = check.find_files_to_check()
+    assert files == [
+        os.path.join("analysis", "scratch_tracked.py"),
+        os.path.join("output", "study_definition_restricted_1.py"),
+        os.path.join("output", "tracked.py"),
+    ]
+    found = check.check_dataset(RESTRICTED_FUNCTIONS, files)
+    assert list(found["admitted_to_icu"]) == [
+        os.path.join("output", "study_definition_restricted_1.py")
+    ]
+
+
+def test_find_files_to_check_tracked_in_skipped_dirs(repo_path):
+    subprocess.run(["git", "init", "-q"], check=True)
+    write_files(
+        repo_path,
+        {
+            "analysis/pyvenv.cfg": "",
+            "analysis/untracked.py": "",
+            "node_modules/x.py": "",
+            "node_modules/untracked.py": "",
+        },
+    )
+    write_study_def(repo_path / "analysis", Dataset.RESTRICTED)
+    subprocess.run(
+        [
+            "git",
+            "add",
+            "analysis/pyvenv.cfg",
+            "analysis/study_definition_restricted_1.py",
+            "node_modules/x.py",
+        ],
+        check=True,
+    )
+
+    files = check.find_files_to_check()
+    assert files == [
+        os.path.join("analysis", "study_definition_restricted_1.py"),
+        os.path.join("node_modules", "x.py"),
+    ]
+    found = check.check_dataset(RESTRICTED_FUNCTIONS, files)
+    assert list(found["admitted_to_icu"]) == [
+        os.path.join("analysis", "study_definition_restricted_1.py")
+    ]
+
+
+def test_find_files_to_check_outside_git(repo_path):
+    # Without git we can't tell what's tracked, so nothing counts as ignored
+    write_files(
+        repo_path, {".gitignore": "/output/\n", "output/generated.py": ""}
+    )
+    assert check.find_files_to_check() == [os.path.join("output", "generated.py")]
+
+
+def test_find_files_to_check_follows_symlinks(repo_path, tmp_path_factory):
+    shared = tmp_path_factory.mktemp("shared")
+    write_files(shared, {"lib.py": ""})
+    (repo_path / "analysis").mkdir()
+    try:
+        (repo_path / "analysis" / "shared").symlink_to(shared)
+    except OSError:
+        # e.g. on Windows without the privilege to create symlinks
+        pytest.skip("can't create symlinks")
+    # A link back to a parent would loop forever if we followed it every time
+    (shared / "loop").symlink_to(repo_path)
+    assert check.find_files_to_check() == [
+        os.path.join("analysis", "shared", "lib.py")
+    ]
+
+
+@pytest.mark.parametrize(
+    "pattern,path,is_dir,ignored",
+    [
+        ("*.py", "a.py", False, True),
+        ("*.py", "sub/a.py", False, True),
+        ("/*.py", "sub/a.py", False, False),
+        ("output/", "output", True, True),
+        ("output/", "output", False, False),
+        ("output/", "sub/output", True, True),
+        ("sub/output", "other/sub/output", True, False),
+        ("**/output", "a/b/output", True, True),
+        ("a/**/b", "a/x/y/b", True, True),
+        ("a/**", "a/x/y.py", False, True),
+        ("scratch?.py", "scratch1.py", False, True),
+        ("scratch[0-9].py", "scratchx.py", False, False),
+    ],
+)
+def test_gitignore(tmp_path, pattern, path, is_dir, ignored):
+    (tmp_path / ".gitignore").write_text(pattern)
+    gitignore = check.GitIgnore()
+    gitignore.add_file("", tmp_path / ".gitignore")
+    assert gitignore.is_ignored(path, is_dir) == ignored
+
+
+@pytest.fixture
+def count_file_checks(monkeypatch):
+    checked = []
+    check_file = check.check_file
+
+    def counting_check_file(filename, regex):
+        checked.append(filename)
+        return check_file(filename, regex)
+
+    monkeypatch.setattr(check, "check_file", counting_check_file)
+    yield checked
+
+
+def test_check_dataset_cache(repo_path, count_file_checks):
+    write_study_def(repo_path, Dataset.RESTRICTED)
+    write_study_def(repo_path, Dataset.UNRESTRICTED)
+    # Make the files old enough to cache
+    for path in repo_path.glob("*.py"):
+        os.utime(path, (1, 1))
+    files = check.find_files_to_check()
+
+    def run_check():
+        cache = check.ScanCache(check.get_cache_file(), RESTRICTED_FUNCTIONS)
+        found = check.check_dataset(RESTRICTED_FUNCTIONS, files, cache)
+        cache.save()
+        return found
+
+    found = run_check()
+    assert len(count_file_checks) == 4
+    assert list(found["admitted_to_icu"]["study_definition_restricted_1.py"]) == [3]
+
+    # Nothing has changed, so nothing is re-read and the results are the same
+    assert run_check() == found
+    assert len(count_file_checks) == 4
+
+    # Only the edited file is re-read
+    edited = repo_path / "study_definition_restricted_1.py"
+    edited.write_text(STUDY_DEF_HEADER)
+    os.utime(edited, (2, 2))
+    found = run_check()
+    assert count_file_checks[4:] == ["study_definition_restricted_1.py"]
+    assert "study_definition_restricted_1.py" not in found["admitted_to_icu"]
+
+    # Looking for different functions means re-reading everything
+    cache = check.ScanCache(check.get_cache_file(), RESTRICTED_FUNCTIONS[:1])
+    check.check_dataset(RESTRICTED_FUNCTIONS[:1], files, cache)
+    assert len(count_file_checks) == 9
+
+
+PERMISSIONS_URL = "https://example.com/repository_permissions.yaml"
+
+
+def test_get_datasource_permissions_cached(requests_mock):
+    requests_mock.get(
+        PERMISSIONS_URL, text=PERMISSIONS_TEXT_VALID, headers={"ETag": '"v1"'}
+    )
+    permissions = check.get_datasource_permissions(PERMISSIONS_URL)
+    assert permissions["opensafely/dummy_icnarc"] == {"allow": ["icnarc"]}
+    assert requests_mock.call_count == 1
+
+    # Within the TTL we don't make any requests
+    assert check.get_datasource_permissions(PERMISSIONS_URL) == permissions
+    assert requests_mock.call_count == 1
+
+
+def test_get_datasource_permissions_revalidates(requests_mock, monkeypatch):
+    requests_mock.get(
+        PERMISSIONS_URL, text=PERMISSIONS_TEXT_VALID, headers={"ETag": '"v1"'}
+    )
+    permissions = check.get_datasource_permissions(PERMISSIONS_URL)
+
+    monkeypatch.setattr(check, "PERMISSIONS_CACHE_TTL", 0)
+    requests_mock.get(PERMISSIONS_URL, status_code=304)
+    assert check.get_datasource_permissions(PERMISSIONS_URL) == permissions
+    assert requests_mock.last_request.headers["If-None-Match"] == '"v1"'
+
+    # The ETag is still sent after a 304 which didn't repeat it
+    requests_mock.get(PERMISSIONS_URL, text="opensafely/new:\n  allow: ['ons']\n")
+    assert check.get_datasource_permissions(PERMISSIONS_URL) == {
+        "opensafely/new": {"allow": ["ons"]}
+    }
+    assert requests_mock.last_request.headers["If-None-Match"] == '"v1"'
+
+
+def test_get_datasource_permissions_offline(requests_mock, monkeypatch):
+    requests_mock.get(PERMISSIONS_URL, text=PERMISSIONS_TEXT_VALID)
+    permissions = check.get_datasource_permissions(PERMISSIONS_URL)
+
+    monkeypatch.setattr(check, "PERMISSIONS_CACHE_TTL", 0)
+    requests_mock.get(
+        PERMISSIONS_URL, exc=requests.exceptions.ConnectionError("offline")
+    )
+    assert check.get_datasource_permissions(PERMISSIONS_URL) == permissions
+
+
+def test_get_datasource_permissions_offline_no_cache(requests_mock):
+    requests_mock.get(
+        PERMISSIONS_URL, exc=requests.exceptions.ConnectionError("offline")
+    )
+    with pytest.raises(RequestException):
+        check.get_datasource_permissions(PERMISSIONS_URL)
+
+
+def test_get_datasource_permissions_error(requests_mock):
+    requests_mock.get(PERMISSIONS_URL, status_code=404)
+    with pytest.raises(RequestException, match="Error 404"):
+        check.get_datasource_permissions(PERMISSIONS_URL)
+
+
+def test_get_datasource_permissions_ignores_cache_for_other_url(requests_mock):
+    requests_mock.get(PERMISSIONS_URL, text=PERMISSIONS_TEXT_VALID)
+    check.get_datasource_permissions(PERMISSIONS_URL)
+    other_url = "https://example.com/other.yaml"
+    requests_mock.get(other_url, text="opensafely/other:\n  allow: []\n")
+    assert check.get_datasource_permissions(other_url) == {
+        "opensafely/other": {"allow": []}
+    }
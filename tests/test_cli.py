@@ -0,0 +1,143 @@
+import importlib
+import subprocess
+import sys
+import time
+import types
+
+import pytest
+
+import opensafely
+
+# Modules which are slow to import and which no subcommand needs just to start
+HEAVY_MODULES = ["numpy", "pandas", "pyarrow"]
+
+# Generous upper bound on the cumulative import time, in seconds, so that this
+# only fails when something slow gets imported rather than on a slow machine
+IMPORT_TIME_BUDGET = 1.0
+
+
+def get_import_times(statement):
+    """
+    Run `statement` in a fresh interpreter with `-X importtime` and return a
+    dict mapping the name of every module imported to its cumulative import time
+    in seconds
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative) / 1_000_000
+    return times
+
+
+def test_import_opensafely():
+    times = get_import_times("import opensafely")
+    for name in HEAVY_MODULES:
+        assert name not in times
+    # None of the subcommands are imported until they're used
+    for module_name, _ in opensafely.SUBCOMMANDS.values():
+        assert module_name not in times
+    assert times["opensafely"] < IMPORT_TIME_BUDGET
+
+
+@pytest.mark.parametrize("cmd", opensafely.SUBCOMMANDS)
+def test_subcommand_import_time(cmd):
+    module_name, _ = opensafely.SUBCOMMANDS[cmd]
+    times = get_import_times(f"import opensafely, {module_name}")
+    for name in HEAVY_MODULES:
+        assert name not in times
+    total = times["opensafely"] + times[module_name]
+    assert total < IMPORT_TIME_BUDGET
+
+
+@pytest.mark.parametrize("cmd", opensafely.SUBCOMMANDS)
+def test_subcommand_help_matches_description(cmd):
+    module_name, help = opensafely.SUBCOMMANDS[cmd]
+    module = importlib.import_module(module_name)
+    assert help == module.DESCRIPTION.strip()
+
+
+@pytest.fixture
+def version_check_modules(monkeypatch):
+    """
+    Install fake modules with the given `get_version_warning()` functions and
+    return their names
+    """
+
+    def install(*functions):
+        names = []
+        for i, function in enumerate(functions):
+            name = f"fake_version_check_{i}"
+            module = types.ModuleType(name)
+            module.get_version_warning = function
+            monkeypatch.setitem(sys.modules, name, module)
+            names.append(name)
+        return names
+
+    yield install
+
+
+def test_check_versions(version_check_modules, capsys):
+    module_names = version_check_modules(
+        lambda: "first warning", lambda: None, lambda: "second warning"
+    )
+    opensafely.check_versions(module_names)
+    out, _ = capsys.readouterr()
+    assert out.splitlines() == ["first warning", "second warning"]
+
+
+def test_check_versions_ignores_errors(version_check_modules, capsys):
+    def fail():
+        raise Exception("no network")
+
+    module_names = version_check_modules(fail, lambda: "warning")
+    opensafely.check_versions(module_names)
+    out, _ = capsys.readouterr()
+    assert out.splitlines() == ["warning"]
+
+
+def test_check_versions_timeout(version_check_modules, capsys, monkeypatch):
+    # Don't hold up the tests exiting
+    monkeypatch.setattr(opensafely, "VERSION_CHECK_EXIT_TIMEOUT", 0)
+
+    def slow():
+        time.sleep(5)
+        return "slow warning"
+
+    module_names = version_check_modules(slow, lambda: "warning")
+    start = time.monotonic()
+    opensafely.check_versions(module_names, timeout=0.2)
+    assert time.monotonic() - start < 1
+    out, _ = capsys.readouterr()
+    assert out.splitlines() == ["warning"]
+
+
+# A command which finishes before its version check has cached anything
+FAST_COMMAND = """
+import sys, time, types
+import opensafely
+
+def get_version_warning():
+    time.sleep(0.5)
+    open(sys.argv[1], "w").write("cached")
+
+module = types.ModuleType("fake_version_check")
+module.get_version_warning = get_version_warning
+sys.modules["fake_version_check"] = module
+opensafely.check_versions(["fake_version_check"], timeout=0.1)
+"""
+
+
+def test_check_versions_finish_at_exit(tmp_path):
+    cache_file = tmp_path / "cache"
+    subprocess.run(
+        [sys.executable, "-c", FAST_COMMAND, str(cache_file)], check=True
+    )
+    assert cache_file.read_text() == "cached"
@@ -1,5 +1,6 @@
 import json
 import os
+import re
 import shutil
 from pathlib import Path
 
@@ -18,6 +19,27 @@ import requests
 # mocker._original_send = requests.Session.send
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("OPENSAFELY_CODELISTS_CACHE", str(cache_dir))
+    yield cache_dir
+
+
+def make_project(path, codelist_ids):
+    codelist_dir = path / "codelists"
+    codelist_dir.mkdir(parents=True)
+    (codelist_dir / "codelists.txt").write_text("\n".join(codelist_ids))
+    return codelist_dir
+
+
+def mock_codelist(requests_mock, codelist_id, text):
+    requests_mock.get(
+        f"https://codelists.opensafely.org/codelist/{codelist_id}/download.csv",
+        text=text,
+    )
+
+
 def test_codelists_update(tmp_path, requests_mock):
     codelist_dir = tmp_path / "codelists"
     codelist_dir.mkdir()
@@ -48,6 +70,141 @@ def test_codelists_update(tmp_path, requests_mock):
     }
 
 
+def test_codelists_update_manifest_order(tmp_path, requests_mock):
+    codelist_dir = tmp_path / "codelists"
+    codelist_dir.mkdir()
+    ids = [f"project{i}/codelist/version1" for i in range(20)]
+    (codelist_dir / "codelists.txt").write_text("\n".join(ids))
+    for codelist_id in ids:
+        requests_mock.get(
+            f"https://codelists.opensafely.org/codelist/{codelist_id}/download.csv",
+            text=f"code\r\n{codelist_id}\r\n",
+        )
+    codelists.update(codelists_dir=codelist_dir)
+    manifest = json.loads((codelist_dir / "codelists.json").read_text())
+    assert [f["id"] for f in manifest["files"].values()] == ids
+    for filename, details in manifest["files"].items():
+        content = (codelist_dir / filename).read_bytes()
+        assert details["sha"] == codelists.hash_bytes(content)
+    assert not list(codelist_dir.glob("*.tmp"))
+
+
+def test_codelists_update_failure_leaves_files_untouched(tmp_path, requests_mock):
+    codelist_dir = tmp_path / "codelists"
+    codelist_dir.mkdir()
+    (codelist_dir / "project123-codelist456.csv").write_text("old")
+    (codelist_dir / "codelists.txt").write_text(
+        "project123/codelist456/version2\nproject123/codelist789/version1\n"
+    )
+    requests_mock.get(
+        "https://codelists.opensafely.org/"
+        "codelist/project123/codelist456/version2/download.csv",
+        text="new",
+    )
+    requests_mock.get(
+        "https://codelists.opensafely.org/"
+        "codelist/project123/codelist789/version1/download.csv",
+        status_code=404,
+    )
+    with pytest.raises(SystemExit):
+        codelists.update(codelists_dir=codelist_dir)
+    assert (codelist_dir / "project123-codelist456.csv").read_text() == "old"
+    assert not (codelist_dir / "codelists.json").exists()
+    assert not list(codelist_dir.glob("*.tmp"))
+
+
+def test_codelists_update_uses_cache(tmp_path, requests_mock):
+    mock_codelist(requests_mock, "project123/codelist456/version2", "foo\r\n")
+    mock_codelist(requests_mock, "project123/codelist789/version1", "bar\r\n")
+    first = make_project(tmp_path / "first", ["project123/codelist456/version2"])
+    codelists.update(codelists_dir=first)
+    assert requests_mock.call_count == 1
+
+    second = make_project(
+        tmp_path / "second",
+        ["project123/codelist456/version2", "project123/codelist789/version1"],
+    )
+    codelists.update(codelists_dir=second)
+    # Only the codelist we haven't seen before is downloaded
+    assert requests_mock.call_count == 2
+    assert (second / "project123-codelist456.csv").read_bytes() == b"foo\r\n"
+    assert (second / "project123-codelist789.csv").read_bytes() == b"bar\r\n"
+    first_manifest = json.loads((first / "codelists.json").read_text())
+    second_manifest = json.loads((second / "codelists.json").read_text())
+    assert (
+        first_manifest["files"]["project123-codelist456.csv"]["sha"]
+        == second_manifest["files"]["project123-codelist456.csv"]["sha"]
+    )
+
+
+def test_codelists_update_corrupt_cache(tmp_path, requests_mock, cache_dir):
+    mock_codelist(requests_mock, "project123/codelist456/version2", "foo")
+    first = make_project(tmp_path / "first", ["project123/codelist456/version2"])
+    codelists.update(codelists_dir=first)
+    for path in cache_dir.glob("objects/*"):
+        path.write_text("corrupted")
+
+    second = make_project(tmp_path / "second", ["project123/codelist456/version2"])
+    codelists.update(codelists_dir=second)
+    assert requests_mock.call_count == 2
+    assert (second / "project123-codelist456.csv").read_text() == "foo"
+
+
+def test_make_temporary_manifest_offline(tmp_path, requests_mock):
+    mock_codelist(requests_mock, "project123/codelist456/version2", "foo")
+    seed = make_project(tmp_path / "seed", ["project123/codelist456/version2"])
+    codelists.update(codelists_dir=seed)
+    expected = json.loads((seed / "codelists.json").read_text())
+
+    # Any request now fails, as if we were offline
+    requests_mock.get(
+        re.compile(".*"), exc=requests.exceptions.ConnectionError("offline")
+    )
+    project = make_project(tmp_path / "project", ["project123/codelist456/version2"])
+    manifest = codelists.make_temporary_manifest(project)
+    assert manifest["files"]["project123-codelist456.csv"]["sha"] == (
+        expected["files"]["project123-codelist456.csv"]["sha"]
+    )
+
+
+def test_codelist_cache_evict(tmp_path):
+    cache = codelists.CodelistCache(tmp_path / "cache", max_size=10)
+    source = tmp_path / "source.csv"
+    for i in range(3):
+        source.write_text(f"content{i}")
+        sha = codelists.hash_bytes(source.read_bytes())
+        cache.put(f"project/codelist{i}/v1", source, sha)
+        object_file, _ = cache.get(f"project/codelist{i}/v1")
+        os.utime(object_file, (i, i))
+    # Using it makes it the most recently used
+    cache.get("project/codelist0/v1")
+
+    cache.evict()
+    assert cache.get("project/codelist0/v1") is not None
+    assert cache.get("project/codelist1/v1") is None
+    assert cache.get("project/codelist2/v1") is None
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        b"",
+        b"\n",
+        b"a,b\nc,d\n",
+        b"a,b\r\nc,d\r\n",
+        b"a,b\rc,d",
+        b"a,b\n\n\n",
+        b"a\r\r\n\n\rb",
+    ],
+)
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 1024])
+def test_normalised_hasher(content, chunk_size):
+    hasher = codelists.NormalisedHasher()
+    for i in range(0, len(content), chunk_size):
+        hasher.update(content[i : i + chunk_size])
+    assert hasher.hexdigest() == codelists.hash_bytes(content)
+
+
 @pytest.fixture
 def codelists_path(tmp_path):
     fixture_path = Path(__file__).parent / "fixtures" / "codelists"
@@ -93,4 +250,61 @@ def test_codelists_check_fail_if_invalid_manifest_file(codelists_path):
     filename.write_text("blah")
     os.chdir(codelists_path)
     with pytest.raises(SystemExit):
-        codelists.check()
\ No newline at end of file
+        codelists.check()
+
+@pytest.fixture
+def count_hashes(monkeypatch):
+    hashed = []
+    hash_bytes = codelists.hash_bytes
+
+    def counting_hash_bytes(content):
+        hashed.append(content)
+        return hash_bytes(content)
+
+    monkeypatch.setattr(codelists, "hash_bytes", counting_hash_bytes)
+    yield hashed
+
+
+def test_codelists_check_uses_stat_cache(codelists_path, count_hashes):
+    os.chdir(codelists_path)
+    codelists.check()
+    n_files = len(count_hashes)
+    assert n_files > 0
+    assert codelists.get_stat_cache_file(codelists_path / "codelists").exists()
+    # Nothing is written into the project
+    files = (codelists_path / "codelists").iterdir()
+    assert {path.suffix for path in files} == {".csv", ".json", ".txt"}
+
+    # Nothing has changed, so nothing needs hashing
+    codelists.check()
+    assert len(count_hashes) == n_files
+
+    codelists.check(strict=True)
+    assert len(count_hashes) == 2 * n_files
+
+
+def test_codelists_check_stat_cache_detects_modification(codelists_path):
+    os.chdir(codelists_path)
+    codelists.check()
+    filename = codelists_path / "codelists" / "opensafely-covid-identification.csv"
+    stat = filename.stat()
+    filename.write_bytes(filename.read_bytes().replace(b"U07", b"X07"))
+    # Simulate a modification which doesn't change the mtime, which we only
+    # catch with --strict
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    codelists.check()
+    with pytest.raises(SystemExit):
+        codelists.check(strict=True)
+
+    # An ordinary modification changes the mtime
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    with pytest.raises(SystemExit):
+        codelists.check()
+
+
+def test_codelists_check_ignores_invalid_stat_cache(codelists_path):
+    stat_cache_file = codelists.get_stat_cache_file(codelists_path / "codelists")
+    stat_cache_file.parent.mkdir(parents=True)
+    stat_cache_file.write_text("blah")
+    os.chdir(codelists_path)
+    assert codelists.check()
@@ -0,0 +1,174 @@
+import json
+import os
+
+import pytest
+
+from opensafely._vendor.jobrunner import action_cache, config
+from opensafely._vendor.jobrunner.lib import docker
+from opensafely._vendor.jobrunner.models import Job
+
+PROJECT_YAML = """
+version: '3.0'
+actions:
+  generate:
+    run: python:latest analysis/generate.py
+    outputs:
+      highly_sensitive:
+        data: output/data.csv
+  model:
+    run: python:latest analysis/model.py
+    needs: [generate]
+    outputs:
+      moderately_sensitive:
+        result: output/result.txt
+"""
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """
+    A workspace in which `generate` has run and `model` is about to, with the
+    cache enabled and the Python image available
+    """
+    monkeypatch.setattr(config, "HIGH_PRIVACY_WORKSPACES_DIR", tmp_path)
+    monkeypatch.setattr(config, "LOCAL_ACTION_CACHE_DIR", tmp_path / "cache")
+    monkeypatch.setattr(action_cache, "_KEYS", {})
+    monkeypatch.setattr(action_cache, "_FILE_HASHES", {})
+    images = {f"{config.DOCKER_REGISTRY}/python:latest": "sha256:python"}
+    monkeypatch.setattr(docker, "image_id", images.get)
+    outputs = {"generate": ["output/data.csv"], "model": []}
+    monkeypatch.setattr(
+        action_cache,
+        "list_outputs_from_action",
+        lambda workspace, action: outputs[action],
+    )
+
+    workspace_dir = tmp_path / "workspace"
+    (workspace_dir / "analysis").mkdir(parents=True)
+    (workspace_dir / "metadata").mkdir()
+    (workspace_dir / "output").mkdir()
+    (workspace_dir / "project.yaml").write_text(PROJECT_YAML)
+    (workspace_dir / "analysis/model.py").write_text("print('model')")
+    (workspace_dir / "output/data.csv").write_text("patient_id\n1\n")
+    yield workspace_dir
+
+
+def make_job(job_id="job-1", run_command="python:latest analysis/model.py"):
+    return Job(
+        id=job_id,
+        workspace="workspace",
+        action="model",
+        run_command=run_command,
+        requires_outputs_from=["generate"],
+        output_spec={"moderately_sensitive": {"result": "output/result.txt"}},
+    )
+
+
+def run_job(workspace_dir, job_id="job-1", result="done"):
+    """Start a job, as run.py does, and if it misses the cache "run" it"""
+    job = make_job(job_id)
+    if action_cache.restore(job):
+        return job, True
+    (workspace_dir / "output/result.txt").write_text(result)
+    (workspace_dir / "metadata/model.log").write_text(f"ran {job_id}")
+    job.outputs = {"output/result.txt": "moderately_sensitive"}
+    job.image_id = "sha256:python"
+    action_cache.store(job)
+    return job, False
+
+
+def test_miss_then_store_then_hit(workspace):
+    _, restored = run_job(workspace)
+    assert not restored
+    assert not action_cache._KEYS
+
+    # The output has changed since, and should be put back as it was
+    (workspace / "output/result.txt").write_text("something else")
+    job, restored = run_job(workspace, job_id="job-2")
+    assert restored
+    assert job.outputs == {"output/result.txt": "moderately_sensitive"}
+    assert job.image_id == "sha256:python"
+    assert (workspace / "output/result.txt").read_text() == "done"
+    assert (workspace / "metadata/model.log").read_text() == "ran job-1"
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        lambda workspace: (workspace / "analysis/model.py").write_text("changed!"),
+        lambda workspace: (workspace / "analysis/new.py").write_text("new"),
+        lambda workspace: (workspace / "output/data.csv").write_text("patient_id\n22\n"),
+    ],
+    ids=["code", "new code", "inputs"],
+)
+def test_changes_invalidate_cache(workspace, change):
+    run_job(workspace)
+    change(workspace)
+    _, restored = run_job(workspace, job_id="job-2")
+    assert not restored
+
+
+def test_image_change_invalidates_cache(workspace, monkeypatch):
+    run_job(workspace)
+    images = {f"{config.DOCKER_REGISTRY}/python:latest": "sha256:newer"}
+    monkeypatch.setattr(docker, "image_id", images.get)
+    _, restored = run_job(workspace, job_id="job-2")
+    assert not restored
+
+
+def test_run_command_change_invalidates_cache(workspace):
+    run_job(workspace)
+    job = make_job("job-2", run_command="python:latest analysis/model.py --all")
+    assert not action_cache.restore(job)
+
+
+def test_missing_image_skips_cache(workspace, monkeypatch):
+    monkeypatch.setattr(docker, "image_id", lambda image: None)
+    _, restored = run_job(workspace)
+    assert not restored
+    assert not (workspace.parent / "cache").exists()
+
+
+def test_disabled(workspace, monkeypatch):
+    # `local_run --no-cache` leaves the cache directory unset
+    monkeypatch.setattr(config, "LOCAL_ACTION_CACHE_DIR", None)
+    run_job(workspace)
+    _, restored = run_job(workspace, job_id="job-2")
+    assert not restored
+    assert not action_cache._KEYS
+
+
+def test_forget(workspace):
+    job = make_job()
+    assert not action_cache.restore(job)
+    assert job.id in action_cache._KEYS
+    action_cache.forget(job)
+    assert not action_cache._KEYS
+    # Nothing is stored for a job which was forgotten
+    action_cache.store(job)
+    assert not (workspace.parent / "cache").exists()
+
+
+def make_entry(cache_dir, name, size, last_used):
+    entry_dir = cache_dir / name
+    entry_dir.mkdir(parents=True)
+    entry_file = entry_dir / action_cache.ENTRY_FILE
+    entry_file.write_text(json.dumps({"size": size}))
+    os.utime(entry_file, (last_used, last_used))
+
+
+def test_evict(tmp_path):
+    make_entry(tmp_path, "oldest", 10, 1000)
+    make_entry(tmp_path, "newest", 10, 3000)
+    make_entry(tmp_path, "middle", 10, 2000)
+    # Entries still being built are left alone
+    (tmp_path / ".tmp-abc").mkdir()
+
+    action_cache.evict(tmp_path, 20)
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        ".tmp-abc",
+        "middle",
+        "newest",
+    ]
+    action_cache.evict(tmp_path, 20)
+    assert len(list(tmp_path.iterdir())) == 3
@@ -0,0 +1,122 @@
+import pytest
+
+from opensafely._vendor.jobrunner import create_or_update_jobs
+from opensafely._vendor.jobrunner.models import Job, JobRequest, State
+from opensafely._vendor.jobrunner.project import ProjectValidationError
+
+
+def make_project(needs):
+    """Build a project from a dict mapping each action to the actions it needs"""
+    return {
+        "version": 3,
+        "actions": {
+            action: {
+                "run": f"python:latest analysis/{action}.py",
+                "needs": action_needs,
+                "outputs": {"moderately_sensitive": {"o": f"output/{action}.csv"}},
+            }
+            for action, action_needs in needs.items()
+        },
+    }
+
+
+def make_job_request(actions, **kwargs):
+    return JobRequest(
+        id="request-1",
+        repo_url="repo",
+        commit="abcdef",
+        requested_actions=actions,
+        cancelled_actions=[],
+        workspace="workspace",
+        database_name="dummy",
+        **kwargs,
+    )
+
+
+def make_job(action, state):
+    return Job(id=f"job-{action}", action=action, state=state)
+
+
+# d needs b and c, which both need a; c needs a via the longer route through b
+DIAMOND = {"a": [], "b": ["a"], "c": ["b", "a"], "d": ["b", "c"]}
+
+
+def test_plan_jobs_order():
+    plan = create_or_update_jobs.plan_jobs(
+        make_job_request(["d"]), make_project(DIAMOND), []
+    )
+
+    assert [job.action for job in plan.jobs] == ["a", "b", "c", "d"]
+    positions = {job.id: i for i, job in enumerate(plan.jobs)}
+    jobs = {job.action: job for job in plan.jobs}
+    for job in plan.jobs:
+        # Every job comes after those it waits for
+        for job_id in job.wait_for_job_ids:
+            assert positions[job_id] < positions[job.id]
+        assert job.requires_outputs_from == DIAMOND[job.action]
+    assert jobs["d"].wait_for_job_ids == [jobs["b"].id, jobs["c"].id]
+
+
+def test_plan_jobs_critical_path():
+    plan = create_or_update_jobs.plan_jobs(
+        make_job_request(["run_all"]), make_project(DIAMOND), []
+    )
+    assert plan.depths == {"a": 0, "b": 1, "c": 2, "d": 3}
+    assert plan.critical_path == ["a", "b", "c", "d"]
+
+
+def test_plan_jobs_waits_for_unfinished_jobs():
+    current_jobs = [
+        make_job("a", State.SUCCEEDED),
+        make_job("b", State.RUNNING),
+        make_job("c", State.PENDING),
+    ]
+    plan = create_or_update_jobs.plan_jobs(
+        make_job_request(["d"]), make_project(DIAMOND), current_jobs
+    )
+
+    # Nothing new is started for the dependencies, but d waits for them
+    assert [job.action for job in plan.jobs] == ["d"]
+    assert plan.jobs[0].wait_for_job_ids == ["job-b", "job-c"]
+    assert plan.depths == {"d": 1}
+    # Jobs which are already running or pending start the critical path
+    assert plan.critical_path == ["b", "d"]
+
+
+def test_plan_jobs_skips_succeeded_dependencies():
+    current_jobs = [make_job("a", State.SUCCEEDED), make_job("b", State.SUCCEEDED)]
+    plan = create_or_update_jobs.plan_jobs(
+        make_job_request(["c"]), make_project(DIAMOND), current_jobs
+    )
+    assert [job.action for job in plan.jobs] == ["c"]
+    assert plan.jobs[0].wait_for_job_ids == []
+
+    # Unless we're forcing them to run
+    plan = create_or_update_jobs.plan_jobs(
+        make_job_request(["c"], force_run_dependencies=True),
+        make_project(DIAMOND),
+        current_jobs,
+    )
+    assert [job.action for job in plan.jobs] == ["a", "b", "c"]
+
+
+def test_plan_jobs_dependency_cycle():
+    project = make_project({"a": ["c"], "b": ["a"], "c": ["b"], "d": ["c"]})
+    with pytest.raises(ProjectValidationError) as exc_info:
+        create_or_update_jobs.plan_jobs(make_job_request(["d"]), project, [])
+    assert str(exc_info.value) == (
+        "Action 'c' depends on itself through its `needs` config:\n"
+        "c -> b -> a -> c"
+    )
+
+
+def test_plan_jobs_long_chain():
+    # Deeper than Python's recursion limit
+    length = 5000
+    needs = {"a0": []}
+    needs.update({f"a{i}": [f"a{i - 1}"] for i in range(1, length)})
+    plan = create_or_update_jobs.plan_jobs(
+        make_job_request([f"a{length - 1}"]), make_project(needs), []
+    )
+    assert [job.action for job in plan.jobs] == list(needs)
+    assert len(plan.critical_path) == length
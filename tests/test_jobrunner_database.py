@@ -0,0 +1,113 @@
+import random
+import sqlite3
+from itertools import groupby
+from operator import attrgetter
+
+import pytest
+
+from opensafely._vendor.jobrunner import config, queries
+from opensafely._vendor.jobrunner.lib import database
+from opensafely._vendor.jobrunner.models import Job
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "DATABASE_FILE", tmp_path / "db.sqlite")
+    monkeypatch.setattr(database, "CONNECTION_CACHE", database.threading.local())
+    yield tmp_path / "db.sqlite"
+
+
+def get_indexes(conn):
+    return {
+        row[0]
+        for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+    }
+
+
+def test_migrate_from_unversioned_database(db):
+    # A database created before the migrations existed, from the schema as it
+    # was then
+    schema = config.DATABASE_SCHEMA_FILE.read_text().replace(
+        "CREATE INDEX idx_job__workspace_action_created_at"
+        " ON job (workspace, action, created_at);",
+        "",
+    )
+    conn = sqlite3.connect(db)
+    conn.executescript(schema)
+    conn.execute("INSERT INTO job (id, workspace) VALUES ('job-1', 'workspace')")
+    conn.commit()
+    conn.close()
+
+    conn = database.get_connection_from_file(db)
+    assert "idx_job__workspace_action_created_at" in get_indexes(conn)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(database.MIGRATIONS)
+    assert [row["id"] for row in conn.execute("SELECT id FROM job")] == ["job-1"]
+
+
+def test_new_database_is_up_to_date(db):
+    conn = database.get_connection_from_file(db)
+    assert "idx_job__workspace_action_created_at" in get_indexes(conn)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(database.MIGRATIONS)
+
+
+def calculate_workspace_state_in_python(workspace):
+    # How queries.calculate_workspace_state() used to work, before the
+    # grouping was done by the database
+    all_jobs = database.find_where(Job, workspace=workspace, cancelled=False)
+    latest_jobs = []
+    key = attrgetter("action")
+    for action, jobs in groupby(sorted(all_jobs, key=key), key=key):
+        if action == "__error__":
+            continue
+        ordered_jobs = sorted(jobs, key=attrgetter("created_at"), reverse=True)
+        latest_jobs.append(ordered_jobs[0])
+    return latest_jobs
+
+
+@pytest.mark.parametrize("use_window_functions", [True, False])
+def test_find_latest_by_matches_python_grouping(db, monkeypatch, use_window_functions):
+    if not use_window_functions:
+        monkeypatch.setattr(database.sqlite3, "sqlite_version_info", (3, 24, 0))
+    rnd = random.Random(1)
+    for i in range(300):
+        database.insert(
+            Job(
+                id=f"job-{i}",
+                workspace=rnd.choice(["workspace", "other"]),
+                action=rnd.choice(["a", "b", "c", "__error__"]),
+                # Plenty of ties, which go to the job created first
+                created_at=rnd.randrange(10),
+                cancelled=rnd.random() < 0.2,
+            )
+        )
+
+    expected = calculate_workspace_state_in_python("workspace")
+    actual = queries._calculate_workspace_state("workspace")
+    assert [job.id for job in actual] == [job.id for job in expected]
+    assert [job.action for job in actual] == ["a", "b", "c"]
+
+
+def get_pragmas(conn):
+    return (
+        conn.execute("PRAGMA journal_mode").fetchone()[0],
+        conn.execute("PRAGMA synchronous").fetchone()[0],
+    )
+
+
+def test_default_profile(db):
+    conn = database.get_connection_from_file(db)
+    # synchronous=NORMAL
+    assert get_pragmas(conn) == ("wal", 1)
+
+
+def test_compat_profile(db, monkeypatch):
+    monkeypatch.setattr(config, "DATABASE_PROFILE", "compat")
+    conn = database.get_connection_from_file(db)
+    # synchronous=FULL
+    assert get_pragmas(conn) == ("delete", 2)
+
+
+def test_default_profile_without_wal():
+    # In-memory databases can't use WAL mode, just like some filesystems
+    conn = database.get_connection_from_file(":memory:")
+    assert get_pragmas(conn) == ("memory", 2)
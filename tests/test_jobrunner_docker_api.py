@@ -0,0 +1,261 @@
+import io
+import json
+import shutil
+import socketserver
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from opensafely._vendor.jobrunner.lib import docker, docker_api
+
+# The fake daemon listens on a unix socket
+pytestmark = pytest.mark.skipif(
+    sys.platform == "win32", reason="unix sockets aren't available on Windows"
+)
+
+
+class FakeDockerDaemon:
+    """
+    Stand-in for the Docker daemon listening on a unix socket, which answers
+    requests from a table of canned responses and records the requests it gets
+    """
+
+    def __init__(self, socket_path):
+        # Maps (method, path) to (status, body, delay in seconds)
+        self.responses = {("GET", "/_ping"): (200, "OK", 0)}
+        self.requests = []
+        self.connections = 0
+        self.server = socketserver.ThreadingUnixStreamServer(
+            str(socket_path), self.handler_class()
+        )
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+        )
+
+    def respond(self, method, path, status=200, body=None, delay=0):
+        self.responses[(method, path)] = (status, body, delay)
+
+    def handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Allows the client to keep connections alive
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                fake.connections += 1
+
+            def do_GET(self):
+                fake.handle(self)
+
+            do_POST = do_PUT = do_DELETE = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def handle(self, request):
+        url = urlparse(request.path)
+        body = read_body(request)
+        self.requests.append(
+            (request.command, url.path, parse_qs(url.query), body)
+        )
+        status, response_body, delay = self.responses.get(
+            (request.command, url.path), (404, {"message": "page not found"}, 0)
+        )
+        time.sleep(delay)
+        if isinstance(response_body, (dict, list)):
+            data = json.dumps(response_body).encode("utf-8")
+        else:
+            data = (response_body or "").encode("utf-8")
+        request.send_response(status)
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def paths(self):
+        return [(method, path) for method, path, _, _ in self.requests]
+
+
+def read_body(request):
+    if request.headers.get("Transfer-Encoding") == "chunked":
+        body = b""
+        while True:
+            size = int(request.rfile.readline().strip(), 16)
+            chunk = request.rfile.read(size + 2)[:size]
+            if not size:
+                return body
+            body += chunk
+    length = int(request.headers.get("Content-Length") or 0)
+    return request.rfile.read(length)
+
+
+@pytest.fixture
+def socket_dir():
+    # Unix socket paths are limited to around 100 characters, which pytest's
+    # temporary directories can exceed
+    path = Path(tempfile.mkdtemp(prefix="docker"))
+    yield path
+    shutil.rmtree(path)
+
+
+@pytest.fixture
+def reset_client(monkeypatch):
+    monkeypatch.setattr(docker_api, "_client", None)
+    monkeypatch.setattr(docker_api, "_client_checked", False)
+    monkeypatch.delenv("DOCKER_USE_CLI", raising=False)
+
+
+@pytest.fixture
+def daemon(socket_dir, reset_client, monkeypatch):
+    socket_path = socket_dir / "docker.sock"
+    fake = FakeDockerDaemon(socket_path)
+    fake.thread.start()
+    monkeypatch.setenv("DOCKER_HOST", f"unix://{socket_path}")
+    yield fake
+    fake.server.shutdown()
+    fake.server.server_close()
+
+
+def test_get_client(daemon):
+    assert isinstance(docker_api.get_client(), docker_api.DockerAPIClient)
+    # Only checked once
+    docker_api.get_client()
+    assert daemon.paths() == [("GET", "/_ping")]
+
+
+@pytest.mark.parametrize(
+    "env",
+    [
+        {"DOCKER_USE_CLI": "true"},
+        {"DOCKER_HOST": "tcp://127.0.0.1:2375"},
+        {"DOCKER_HOST": "unix:///no/such/docker.sock"},
+    ],
+)
+def test_get_client_uses_cli(reset_client, monkeypatch, env):
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    assert docker_api.get_client() is None
+
+
+def test_request_reuses_connections(daemon):
+    daemon.respond("GET", "/volumes", body={"Volumes": [{"Name": "v1"}]})
+    client = docker_api.get_client()
+    for _ in range(3):
+        assert client.request("GET", "/volumes").json() == {"Volumes": [{"Name": "v1"}]}
+    assert daemon.connections == 1
+
+
+def test_run(daemon):
+    daemon.respond("POST", "/containers/create", 201, {"Id": "abc"})
+    daemon.respond("POST", "/containers/job-1/start", 204)
+
+    docker.run(
+        "job-1",
+        ["python:latest", "analysis/model.py", 1],
+        volume=("volume-1", "/workspace"),
+        env={"A": "1"},
+        allow_network_access=False,
+        label="job",
+        labels={"action": "model"},
+    )
+
+    assert daemon.paths() == [
+        ("GET", "/_ping"),
+        ("POST", "/containers/create"),
+        ("POST", "/containers/job-1/start"),
+    ]
+    _, _, params, body = daemon.requests[1]
+    assert params == {"name": ["job-1"]}
+    assert json.loads(body) == {
+        "Image": "python:latest",
+        "Cmd": ["analysis/model.py", "1"],
+        "Env": ["A=1"],
+        "Labels": {docker.LABEL: "", "job": "", "action": "model"},
+        "HostConfig": {
+            "Init": True,
+            "NetworkMode": "none",
+            "Binds": ["volume-1:/workspace"],
+        },
+    }
+
+
+def test_run_missing_image_uses_cli(daemon, run):
+    daemon.respond("POST", "/containers/create", 404, {"message": "No such image"})
+    run.expect(
+        [
+            "docker",
+            "run",
+            "--init",
+            "--detach",
+            "--label",
+            docker.LABEL,
+            "--name",
+            "job-1",
+            "--network",
+            "none",
+            "python:latest",
+        ]
+    )
+    docker.run("job-1", ["python:latest"], allow_network_access=False)
+
+
+def test_run_removes_container_if_start_fails(daemon):
+    daemon.respond("POST", "/containers/create", 201, {"Id": "abc"})
+    daemon.respond("POST", "/containers/job-1/start", 500, {"message": "bad mount"})
+    daemon.respond("DELETE", "/containers/job-1", 204)
+
+    with pytest.raises(docker.DockerAPIError, match="bad mount"):
+        docker.run("job-1", ["python:latest"])
+
+    method, path, params, _ = daemon.requests[-1]
+    assert (method, path, params) == ("DELETE", "/containers/job-1", {"force": ["1"]})
+
+
+def test_api_request_errors(daemon):
+    daemon.respond("POST", "/full", 500, {"message": "write: no space left on device"})
+    daemon.respond("POST", "/broken", 500, {"message": "something went wrong"})
+    daemon.respond("GET", "/slow", delay=1)
+
+    with pytest.raises(docker.DockerDiskSpaceError):
+        docker.api_request("POST", "/full")
+    with pytest.raises(docker.DockerAPIError) as e:
+        docker.api_request("POST", "/broken")
+    assert (e.value.status, e.value.message) == (500, "something went wrong")
+    with pytest.raises(docker.DockerTimeoutError):
+        docker.api_request("GET", "/slow", timeout=0.1)
+    # Errors which we expect are returned like any other response
+    response = docker.api_request("POST", "/broken", allowed_statuses=(500,))
+    assert response.status == 500
+
+
+def test_put_archive(daemon):
+    daemon.respond("PUT", "/containers/volume-1-manager/archive")
+
+    def build_archive(tar):
+        info = tarfile.TarInfo("project.yaml")
+        info.size = 5
+        tar.addfile(info, io.BytesIO(b"hello"))
+
+    docker.put_archive("volume-1", build_archive, "analysis")
+
+    method, path, params, body = daemon.requests[-1]
+    assert params == {"path": ["/workspace/analysis"]}
+    with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+        assert tar.extractfile("project.yaml").read() == b"hello"
+
+
+def test_kill_uses_cli_without_socket(reset_client, monkeypatch, run):
+    monkeypatch.setenv("DOCKER_USE_CLI", "1")
+    run.expect(["docker", "container", "kill", "job-1"], check=True)
+    docker.kill("job-1")
@@ -0,0 +1,93 @@
+import subprocess
+import threading
+
+import pytest
+
+from opensafely._vendor.jobrunner import config, run
+from opensafely._vendor.jobrunner.lib import docker_events, wakeup
+
+
+class FakePopen:
+    """Stand-in for `docker events`, which outputs the given lines"""
+
+    def __init__(self, lines, returncode=None):
+        self.lines = lines
+        self.returncode = returncode
+
+    def __call__(self, cmd, **kwargs):
+        assert cmd[:2] == ["docker", "events"]
+        self.stdout = iter(self.lines)
+        return self
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        return self.returncode
+
+
+@pytest.fixture
+def watcher():
+    seen = []
+    watcher = docker_events.DockerEventWatcher(
+        lambda name: seen.append((name, watcher.connected)), "job-label"
+    )
+    watcher.seen = seen
+    yield watcher
+
+
+def probe(returncode):
+    def run(cmd, **kwargs):
+        assert "--since" in cmd and "--until" in cmd
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+    return run
+
+
+def test_watch_connected(watcher, monkeypatch):
+    monkeypatch.setattr(docker_events.subprocess, "Popen", FakePopen(["job-1\n", "\n"]))
+    monkeypatch.setattr(docker_events.subprocess, "run", probe(0))
+    watcher._watch()
+    assert watcher.seen == [("job-1", True)]
+
+
+def test_watch_daemon_unavailable(watcher, monkeypatch):
+    monkeypatch.setattr(docker_events.subprocess, "Popen", FakePopen([]))
+    monkeypatch.setattr(docker_events.subprocess, "run", probe(1))
+    watcher._watch()
+    assert not watcher.connected
+
+
+def test_watch_stream_exited(watcher, monkeypatch):
+    # Had it connected, there'd be nothing for the stream to print yet
+    monkeypatch.setattr(
+        docker_events.subprocess, "Popen", FakePopen(["job-1\n"], returncode=1)
+    )
+    monkeypatch.setattr(docker_events.subprocess, "run", probe(0))
+    watcher._watch()
+    assert watcher.seen == [("job-1", False)]
+
+
+def test_wakeup():
+    wakeup.notify()
+    assert wakeup.wait(0)
+    # Each notification only wakes one wait
+    assert not wakeup.wait(0)
+
+    timer = threading.Timer(0.01, wakeup.notify)
+    timer.start()
+    assert wakeup.wait(5)
+    timer.join()
+
+
+@pytest.mark.parametrize(
+    "connected,interval",
+    [(True, "JOB_LOOP_FALLBACK_INTERVAL"), (False, "JOB_LOOP_INTERVAL")],
+)
+def test_wait_for_next_loop(watcher, monkeypatch, connected, interval):
+    timeouts = []
+    monkeypatch.setattr(wakeup, "wait", timeouts.append)
+    watcher.connected = connected
+    run.wait_for_next_loop(watcher)
+    assert timeouts == [getattr(config, interval)]
@@ -0,0 +1,75 @@
+import io
+import os
+import subprocess
+import sys
+import tarfile
+import threading
+
+import pytest
+
+from opensafely._vendor.jobrunner.lib import git
+
+# Stands in for `git archive`, writing more to stderr than fits in a pipe
+# before writing a tar archive of a single file to stdout
+FAKE_GIT = """\
+import io, sys, tarfile
+sys.stderr.write("warning: lots of output\\n" * 10000)
+sys.stderr.flush()
+with tarfile.open(fileobj=sys.stdout.buffer, mode="w|") as tar:
+    info = tarfile.TarInfo("project.yaml")
+    info.size = 5
+    tar.addfile(info, io.BytesIO(b"hello"))
+sys.exit(int(sys.argv[-1] == "bad"))
+"""
+
+
+@pytest.fixture
+def fake_git(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "fake_git.py"
+    script.write_text(FAKE_GIT)
+    wrapper = bin_dir / "git"
+    wrapper.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{script}" "$@"\n')
+    wrapper.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(git, "get_local_repo_dir", lambda repo_url: tmp_path)
+    monkeypatch.setattr(git, "ensure_commit_fetched", lambda *args: None)
+
+
+def add_commit_to_archive(commit_sha):
+    """
+    Call add_commit_to_archive in a thread, so that if it deadlocks we fail
+    rather than hang, and return the names of the files in the archive
+    """
+    buffer = io.BytesIO()
+    errors = []
+
+    def target():
+        try:
+            with tarfile.open(fileobj=buffer, mode="w") as tar:
+                git.add_commit_to_archive("https://example.com/repo", commit_sha, tar)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive(), "add_commit_to_archive deadlocked"
+    if errors:
+        raise errors[0]
+    buffer.seek(0)
+    with tarfile.open(fileobj=buffer) as tar:
+        return tar.getnames()
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses a shell script as git")
+def test_add_commit_to_archive_with_lots_of_stderr(fake_git):
+    assert add_commit_to_archive("abc123") == ["project.yaml"]
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses a shell script as git")
+def test_add_commit_to_archive_error(fake_git):
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        add_commit_to_archive("bad")
+    assert e.value.stderr.startswith(b"warning: lots of output")
@@ -0,0 +1,90 @@
+from concurrent.futures import Future
+
+import pytest
+
+from opensafely._vendor.jobrunner import config
+from opensafely._vendor.jobrunner.executors import local
+from opensafely._vendor.jobrunner.job_executor import (
+    ExecutorState,
+    JobDefinition,
+    Study,
+)
+from opensafely._vendor.jobrunner.lib import docker
+
+
+def make_job(job_id):
+    return JobDefinition(
+        id=job_id,
+        study=Study("repo", "commit"),
+        workspace="workspace",
+        action=f"action_{job_id}",
+        image="ghcr.io/opensafely-core/python",
+        args=[],
+        env={},
+        inputs=[],
+        output_spec={},
+        allow_database_access=False,
+    )
+
+
+@pytest.fixture
+def tasks(monkeypatch):
+    monkeypatch.setattr(config, "EXECUTION_API", True)
+    monkeypatch.setattr(local, "PREPARE_TASKS", {})
+    monkeypatch.setattr(local, "FINALIZE_TASKS", {})
+    monkeypatch.setattr(local, "RESULTS", {})
+
+
+def test_get_statuses(tasks, monkeypatch):
+    preparing, prepared, executing = make_job("1"), make_job("2"), make_job("3")
+    local.PREPARE_TASKS[preparing.id] = Future()
+    monkeypatch.setattr(
+        docker, "list_containers", lambda label: {local.container_name(executing): True}
+    )
+    monkeypatch.setattr(
+        docker, "list_volumes", lambda label: {local.volume_name(prepared)}
+    )
+
+    statuses = local.LocalDockerAPI().get_statuses([preparing, prepared, executing])
+    assert {job_id: status.state for job_id, status in statuses.items()} == {
+        "1": ExecutorState.PREPARING,
+        "2": ExecutorState.PREPARED,
+        "3": ExecutorState.EXECUTING,
+    }
+
+
+def test_get_statuses_task_finishes_during_snapshot(tasks, monkeypatch):
+    job = make_job("1")
+    future = Future()
+    local.PREPARE_TASKS[job.id] = future
+
+    def list_containers(label):
+        # The task creates the volume and finishes just after the snapshot
+        future.set_result(None)
+        return {}
+
+    monkeypatch.setattr(docker, "list_containers", list_containers)
+    monkeypatch.setattr(docker, "list_volumes", lambda label: set())
+
+    # Another job which needs the snapshot
+    other_job = make_job("2")
+
+    # Reading the snapshot after the task had finished, we'd report the job as
+    # UNKNOWN, and so prepare it again
+    statuses = local.LocalDockerAPI().get_statuses([job, other_job])
+    assert future.done()
+    assert statuses[job.id].state == ExecutorState.PREPARING
+
+
+def test_get_statuses_only_tasks(tasks, monkeypatch):
+    job = make_job("1")
+    local.FINALIZE_TASKS[job.id] = Future()
+
+    def fail(label):
+        raise AssertionError("unexpected snapshot")
+
+    monkeypatch.setattr(docker, "list_containers", fail)
+    monkeypatch.setattr(docker, "list_volumes", fail)
+
+    statuses = local.LocalDockerAPI().get_statuses([job])
+    assert statuses[job.id].state == ExecutorState.FINALIZING
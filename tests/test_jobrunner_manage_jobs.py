@@ -0,0 +1,41 @@
+import pytest
+
+from opensafely._vendor.jobrunner import config, manage_jobs
+from opensafely._vendor.jobrunner.models import Job
+
+
+def make_job(filenames):
+    return Job(
+        id="job",
+        action="generate_cohort",
+        run_command="cohortextractor:latest generate_cohort",
+        outputs={filename: "highly_sensitive" for filename in filenames},
+    )
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_remove_patient_ids_wraps_errors(tmp_path, monkeypatch, workers):
+    monkeypatch.setattr(config, "PATIENT_ID_SCAN_WORKERS", workers)
+    filenames = ["output/input.csv", "output/input.parquet"]
+    (tmp_path / "output").mkdir()
+    (tmp_path / "output/input.csv").write_text("patient_id,age\n1,20\n")
+    (tmp_path / "output/input.parquet").write_text("not a parquet file")
+
+    with pytest.raises(manage_jobs.JobError, match="output/input.parquet"):
+        manage_jobs.remove_patient_ids(make_job(filenames), tmp_path)
+
+
+def test_remove_patient_ids_skips_other_images(tmp_path):
+    job = make_job(["output/input.parquet"])
+    job.run_command = "python:latest analysis/model.py"
+    # The file doesn't exist, but we don't look at it
+    manage_jobs.remove_patient_ids(job, tmp_path)
+
+
+def test_get_copy_timeout(tmp_path):
+    with open(tmp_path / "input.csv", "wb") as f:
+        f.truncate(manage_jobs.MIN_COPY_RATE * 2)
+    assert manage_jobs.get_copy_timeout(tmp_path, []) == manage_jobs.COPY_TIMEOUT
+    assert manage_jobs.get_copy_timeout(tmp_path, ["input.csv"]) == (
+        manage_jobs.COPY_TIMEOUT + 2
+    )
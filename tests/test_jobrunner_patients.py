@@ -0,0 +1,162 @@
+import hashlib
+
+import pandas
+import pytest
+
+from opensafely._vendor.jobrunner import patients
+
+
+def make_pat_id(pat_id):
+    hash_code = hashlib.md5(pat_id.encode()).hexdigest()
+    return f"{len(pat_id):02d}{pat_id}{hash_code[0] + hash_code[16] + hash_code[-1]}"
+
+
+PAT_ID = make_pat_id("12345")
+
+
+@pytest.mark.parametrize("value", [PAT_ID, f"  {PAT_ID}", f"{PAT_ID}     "])
+def test_contains_pat_id(value):
+    assert patients.contains_pat_ID(pandas.Series(["foo", value]))
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        # Only part of the value has the shape of an ID
+        f"x-{PAT_ID}",
+        f"AB{PAT_ID}",
+        f"{PAT_ID}-x",
+        f"{PAT_ID}AB",
+        # The length prefix doesn't match the ID
+        "06" + PAT_ID[2:],
+        # The hash summary doesn't match the ID
+        PAT_ID[:-3] + "000",
+    ],
+)
+def test_contains_pat_id_rejects_non_ids(value):
+    assert not patients.contains_pat_ID(pandas.Series(["foo", value]))
+
+
+def test_remove_pat_ids_leaves_partial_matches(tmp_path):
+    path = tmp_path / "output.csv"
+    pandas.DataFrame(
+        {"patient": [PAT_ID, PAT_ID], "code": [f"AB{PAT_ID}", "other"]}
+    ).to_csv(path, index=False)
+
+    assert patients.remove_pat_IDs(path, seed="1") == ["patient"]
+    data = pandas.read_csv(path)
+    assert PAT_ID not in list(data["patient"])
+    assert list(data["code"]) == [f"AB{PAT_ID}", "other"]
+
+
+def test_remove_pat_ids_keeps_non_ascii_data(tmp_path):
+    path = tmp_path / "output.csv"
+    path.write_text(f"patient,name\n{PAT_ID},Zoë\n{PAT_ID},Łódź ✓\n", encoding="utf-8")
+
+    assert patients.remove_pat_IDs(path, seed="1") == ["patient"]
+    data = pandas.read_csv(path, encoding="utf-8")
+    assert PAT_ID not in list(data["patient"])
+    assert list(data["name"]) == ["Zoë", "Łódź ✓"]
+
+
+def write_table(table, path):
+    import pyarrow.feather
+    import pyarrow.parquet
+
+    name = str(path)
+    if name.endswith(".csv.gz"):
+        table.to_pandas().to_csv(path, index=False, encoding="utf-8")
+    elif name.endswith(".parquet"):
+        pyarrow.parquet.write_table(table, path)
+    else:
+        # Feather V2 files are Arrow IPC files
+        pyarrow.feather.write_feather(table, path, compression="uncompressed")
+
+
+def read_table(path):
+    import pyarrow.feather
+    import pyarrow.parquet
+
+    name = str(path)
+    if name.endswith(".csv.gz"):
+        return pandas.read_csv(path, encoding="utf-8", keep_default_na=False)
+    if name.endswith(".parquet"):
+        return pyarrow.parquet.read_table(path).to_pandas()
+    return pyarrow.feather.read_table(path).to_pandas()
+
+
+@pytest.mark.parametrize("suffix", [".csv.gz", ".feather", ".arrow", ".parquet"])
+def test_remove_pat_ids_round_trip(tmp_path, suffix):
+    pyarrow = pytest.importorskip("pyarrow")
+    path = tmp_path / f"output{suffix}"
+    table = pyarrow.table(
+        {
+            "patient": pyarrow.array([PAT_ID, None, PAT_ID]).dictionary_encode(),
+            "name": ["Zoë", "Łódź ✓", "plain"],
+            "code": [f"AB{PAT_ID}", "other", "other"],
+            "age": [20, 30, 40],
+        }
+    )
+    write_table(table, path)
+
+    assert patients.inspect_pat_ID(path, chunk_size=2)[2] == ["patient"]
+    patients.hash_columns_in_place(path, ["patient"], seed="1", chunk_size=2)
+
+    data = read_table(path)
+    hashed = patients.hash_values([PAT_ID], "1")[0]
+    assert list(data["patient"])[0] == list(data["patient"])[2] == hashed
+    assert patients.is_missing(list(data["patient"])[1])
+    # Only the flagged column changes
+    assert list(data["name"]) == ["Zoë", "Łódź ✓", "plain"]
+    assert list(data["code"]) == [f"AB{PAT_ID}", "other", "other"]
+    assert list(data["age"]) == [20, 30, 40]
+    assert not patients.inspect_pat_ID(path)[0]
+
+
+def test_read_string_columns_skips_other_columns(tmp_path):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+
+    path = tmp_path / "output.parquet"
+    table = pyarrow.table(
+        {
+            "patient": [PAT_ID] * 3,
+            "code": pyarrow.array(["a", "b", "a"]).dictionary_encode(),
+            "age": [20, 30, 40],
+        }
+    )
+    pyarrow.parquet.write_table(table, path)
+
+    chunks = list(patients.read_string_columns(path, chunk_size=2))
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    assert list(chunks[0].columns) == ["patient", "code"]
+
+
+def test_get_hashed_schema():
+    pyarrow = pytest.importorskip("pyarrow")
+    schema = pyarrow.schema(
+        [
+            ("patient", pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+            ("code", pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+            ("age", pyarrow.int64()),
+        ]
+    )
+
+    hashed = patients.get_hashed_schema(schema, ["patient"])
+    assert hashed.field("patient").type == pyarrow.string()
+    assert hashed.field("code").type == schema.field("code").type
+    assert hashed.field("age").type == pyarrow.int64()
+
+
+def test_inspect_pat_id_numeric_ids(tmp_path):
+    # An ID which, like its hash summary, is all digits
+    pat_id = next(
+        make_pat_id(str(i)) for i in range(10000) if make_pat_id(str(i)).isdigit()
+    )
+    path = tmp_path / "output.csv"
+    # Only the second chunk contains the ID, and every value looks like a number
+    path.write_text(f"patient,age\n1,20\n2,30\n{pat_id},40\n")
+
+    result, _, columns_names = patients.inspect_pat_ID(path, chunk_size=2)
+    assert result
+    assert columns_names == ["patient"]
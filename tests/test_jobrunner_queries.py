@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from opensafely._vendor.jobrunner import queries
+
+
+@pytest.fixture
+def calculations(monkeypatch):
+    """Record the workspaces whose state is calculated from the database"""
+    calculated = []
+
+    def calculate(workspace):
+        calculated.append(workspace)
+        return [f"{workspace}-job-{len(calculated)}"]
+
+    monkeypatch.setattr(queries, "_calculate_workspace_state", calculate)
+    yield calculated
+
+
+def test_workspace_state_cache(calculations):
+    with queries.workspace_state_cache():
+        first = queries.calculate_workspace_state("w1")
+        assert queries.calculate_workspace_state("w1") == first
+        queries.invalidate_workspace_state("w1")
+        assert queries.calculate_workspace_state("w1") != first
+    assert calculations == ["w1", "w1"]
+
+    # Outside the block nothing is cached
+    queries.calculate_workspace_state("w1")
+    queries.calculate_workspace_state("w1")
+    assert calculations == ["w1"] * 4
+
+
+def test_workspace_state_cache_shared_between_threads(calculations):
+    def calculate_in_block(cache):
+        with queries.workspace_state_cache(cache):
+            return queries.calculate_workspace_state("w1")
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        with queries.workspace_state_cache() as cache:
+            state = queries.calculate_workspace_state("w1")
+            assert pool.submit(calculate_in_block, cache).result() == state
+            # Threads which aren't handling this pass don't see the cache
+            assert pool.submit(queries.calculate_workspace_state, "w1").result() != state
+    assert calculations == ["w1", "w1"]
+
+
+def test_workspace_state_not_stored_after_invalidation(calculations, monkeypatch):
+    calculate = queries._calculate_workspace_state
+
+    def calculate_then_invalidate(workspace):
+        # Another thread changes the workspace while we're querying it
+        state = calculate(workspace)
+        queries.invalidate_workspace_state(workspace)
+        return state
+
+    with queries.workspace_state_cache():
+        monkeypatch.setattr(
+            queries, "_calculate_workspace_state", calculate_then_invalidate
+        )
+        queries.calculate_workspace_state("w1")
+        monkeypatch.setattr(queries, "_calculate_workspace_state", calculate)
+        queries.calculate_workspace_state("w1")
+    assert calculations == ["w1", "w1"]
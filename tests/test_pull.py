@@ -1,4 +1,5 @@
 import argparse
+import json
 from pathlib import Path
 
 import pytest
@@ -8,6 +9,31 @@ from opensafely import pull
 project_fixture_path = Path(__file__).parent / "fixtures" / "projects"
 
 
+@pytest.fixture(autouse=True)
+def digest_cache_file(tmp_path, monkeypatch):
+    cache_file = tmp_path / "digests.json"
+    monkeypatch.setattr(pull, "DIGEST_CACHE_FILE", cache_file)
+    yield cache_file
+
+
+@pytest.fixture(autouse=True)
+def no_docker_api(monkeypatch):
+    """Talk to docker via the CLI, which the run fixture stands in for"""
+    monkeypatch.setattr(pull.docker_api, "get_client", lambda: None)
+
+
+@pytest.fixture
+def pulled(monkeypatch):
+    """Record the images pulled, rather than running `docker pull`"""
+    tags = []
+
+    def pull_image(tag, progress):
+        tags.append(tag)
+
+    monkeypatch.setattr(pull, "pull_image", pull_image)
+    yield tags
+
+
 def tag(image):
     return f"{pull.REGISTRY}/{image}:latest"
 
@@ -15,95 +41,203 @@ def tag(image):
 def test_default_no_local_images(run, capsys):
 
     run.expect(["docker", "info"])
-    run.expect(["docker", "images", "ghcr.io/opensafely-core/*", "--no-trunc", "--format={{.Repository}}={{.ID}}"], stdout="")
+    run.expect(["docker", "images", f"{pull.REGISTRY}/*", "--no-trunc", "--format={{.Repository}}={{.ID}}"], stdout="")
 
     pull.main(image="all", force=False)
     out, err = capsys.readouterr()
     assert err == ""
-    assert out.strip() == "No OpenSAFELY docker images found to update."
+    assert out.strip() == "No MediciaSAFELY docker images found to update."
 
 
-def test_default_no_local_images_force(run, capsys):
+def test_default_no_local_images_force(run, pulled, capsys):
 
     run.expect(["docker", "info"])
-    run.expect(["docker", "images", "ghcr.io/opensafely-core/*", "--no-trunc", "--format={{.Repository}}={{.ID}}"], stdout="")
-    run.expect(["docker", "pull", tag("cohortextractor")])
-    run.expect(["docker", "pull", tag("cohortextractor-v2")])
-    run.expect(["docker", "pull", tag("jupyter")])
-    run.expect(["docker", "pull", tag("python")])
-    run.expect(["docker", "pull", tag("r")])
-    run.expect(["docker", "pull", tag("stata-mp")])
+    run.expect(["docker", "images", f"{pull.REGISTRY}/*", "--no-trunc", "--format={{.Repository}}={{.ID}}"], stdout="")
     run.expect(["docker", "image", "prune", "--force"])
 
     pull.main(image="all", force=True)
+    assert sorted(pulled) == sorted(
+        [
+            tag("cohortextractor"),
+            tag("cohortextractor-v2"),
+            tag("jupyter"),
+            tag("python"),
+            tag("r"),
+            tag("stata-mp"),
+        ]
+    )
     out, err = capsys.readouterr()
     assert err == ""
     assert out.splitlines() == [
-        "Updating OpenSAFELY cohortextractor image",
-        "Updating OpenSAFELY cohortextractor-v2 image",
-        "Updating OpenSAFELY jupyter image",
-        "Updating OpenSAFELY python image",
-        "Updating OpenSAFELY r image",
-        "Updating OpenSAFELY stata-mp image",
+        "Updating MediciaSAFELY cohortextractor image",
+        "Updating MediciaSAFELY cohortextractor-v2 image",
+        "Updating MediciaSAFELY jupyter image",
+        "Updating MediciaSAFELY python image",
+        "Updating MediciaSAFELY r image",
+        "Updating MediciaSAFELY stata-mp image",
         "Cleaning up old images",
     ]
 
 
-def test_default_with_local_images(run, capsys):
+def test_default_with_local_images(run, pulled, capsys):
 
     run.expect(["docker", "info"])
     run.expect(
-        ["docker", "images", "ghcr.io/opensafely-core/*", "--no-trunc", "--format={{.Repository}}={{.ID}}"],
-        stdout="ghcr.io/opensafely-core/r=sha",
+        ["docker", "images", f"{pull.REGISTRY}/*", "--no-trunc", "--format={{.Repository}}={{.ID}}"],
+        stdout=f"{pull.REGISTRY}/r=sha",
     )
-    run.expect(["docker", "pull", tag("r")])
     run.expect(["docker", "image", "prune", "--force"])
 
     pull.main(image="all", force=False)
+    assert sorted(pulled) == [tag("r")]
     out, err = capsys.readouterr()
     assert err == ""
     assert out.splitlines() == [
-        "Updating OpenSAFELY r image",
+        "Updating MediciaSAFELY r image",
         "Cleaning up old images",
     ]
 
 
-def test_specific_image(run, capsys):
+def test_specific_image(run, pulled, capsys):
 
     run.expect(["docker", "info"])
-    run.expect(["docker", "images", "ghcr.io/opensafely-core/*", "--no-trunc", "--format={{.Repository}}={{.ID}}"], stdout="")
-    run.expect(["docker", "pull", tag("r")])
+    run.expect(["docker", "images", f"{pull.REGISTRY}/*", "--no-trunc", "--format={{.Repository}}={{.ID}}"], stdout="")
     run.expect(["docker", "image", "prune", "--force"])
 
     pull.main(image="r", force=False)
+    assert sorted(pulled) == [tag("r")]
     out, err = capsys.readouterr()
     assert err == ""
     assert out.splitlines() == [
-        "Updating OpenSAFELY r image",
+        "Updating MediciaSAFELY r image",
         "Cleaning up old images",
     ]
 
 
-def test_project(run, capsys):
+def test_project(run, pulled, capsys):
 
     run.expect(["docker", "info"])
-    run.expect(["docker", "images", "ghcr.io/opensafely-core/*", "--no-trunc", "--format={{.Repository}}={{.ID}}"], stdout="")
-    run.expect(["docker", "pull", tag("cohortextractor")])
-    run.expect(["docker", "pull", tag("python")])
-    run.expect(["docker", "pull", tag("jupyter")])
+    run.expect(["docker", "images", f"{pull.REGISTRY}/*", "--no-trunc", "--format={{.Repository}}={{.ID}}"], stdout="")
     run.expect(["docker", "image", "prune", "--force"])
 
     pull.main(project=project_fixture_path / "project.yaml")
+    assert sorted(pulled) == [tag("cohortextractor"), tag("jupyter"), tag("python")]
     out, err = capsys.readouterr()
     assert err == ""
     assert out.splitlines() == [
-        "Updating OpenSAFELY cohortextractor image",
-        "Updating OpenSAFELY python image",
-        "Updating OpenSAFELY jupyter image",
+        "Updating MediciaSAFELY cohortextractor image",
+        "Updating MediciaSAFELY python image",
+        "Updating MediciaSAFELY jupyter image",
         "Cleaning up old images",
     ]
 
 
+class FakePopen:
+    """Stand-in for subprocess.Popen which outputs the given lines"""
+
+    def __init__(self, lines, returncode=0):
+        self.lines = lines
+        self.returncode = returncode
+
+    def __call__(self, cmd, **kwargs):
+        self.cmd = cmd
+        self.stdout = iter(self.lines)
+        return self
+
+    def wait(self):
+        return self.returncode
+
+
+DOCKER_PULL_OUTPUT = [
+    "latest: Pulling from mediciaai/r\n",
+    "0123456789ab: Already exists\n",
+    "123456789abc: Pulling fs layer\n",
+    "123456789abc: Verifying Checksum\n",
+    "123456789abc: Download complete\n",
+    "123456789abc: Pull complete\n",
+    "Digest: sha256:0123456789abcdef\n",
+    "Status: Downloaded newer image for ghcr.io/mediciaai/r:latest\n",
+]
+
+
+def test_pull_image(monkeypatch):
+    monkeypatch.setattr(pull.subprocess, "Popen", FakePopen(DOCKER_PULL_OUTPUT))
+    progress = pull.PullProgress([tag("r")])
+    pull.pull_image(tag("r"), progress)
+    assert progress.layers[tag("r")] == {
+        "0123456789ab": "Already exists",
+        "123456789abc": "Pull complete",
+    }
+    assert progress.describe(tag("r")) == "done"
+
+
+def test_pull_image_fails(monkeypatch):
+    monkeypatch.setattr(
+        pull.subprocess, "Popen", FakePopen(["Error: not found\n"], returncode=1)
+    )
+    progress = pull.PullProgress([tag("r")])
+    with pytest.raises(pull.subprocess.CalledProcessError) as exc_info:
+        pull.pull_image(tag("r"), progress)
+    assert exc_info.value.stderr == "Error: not found\n"
+    assert progress.describe(tag("r")) == "failed"
+
+
+def test_pull_images_reports_failure_after_others_finish(monkeypatch, capsys):
+    pulled = []
+
+    def pull_image(tag, progress):
+        if "python" in tag:
+            raise pull.subprocess.CalledProcessError(1, ["docker", "pull", tag])
+        pulled.append(tag)
+
+    monkeypatch.setattr(pull, "pull_image", pull_image)
+    with pytest.raises(pull.subprocess.CalledProcessError):
+        pull.pull_images([tag("python"), tag("r"), tag("jupyter")], workers=2)
+    assert sorted(pulled) == [tag("jupyter"), tag("r")]
+
+
+def test_pull_progress_summary():
+    progress = pull.PullProgress([tag("python"), tag("r"), tag("jupyter")])
+    progress.update(tag("python"), "0123456789ab: Already exists\n")
+    progress.update(tag("python"), "123456789abc: Downloading\n")
+    progress.update(tag("python"), "latest: Pulling from mediciaai/python\n")
+    progress.update(tag("r"), "0123456789ab: Pull complete\n")
+    progress.done(tag("r"))
+    assert progress.summary() == (
+        "python:latest 1/2 layers, r:latest done, jupyter:latest waiting"
+    )
+
+
+def test_pull_progress_non_interactive(capsys):
+    progress = pull.PullProgress([tag("python"), tag("r")])
+    progress.update(tag("r"), "0123456789ab: Pull complete\n")
+    progress.done(tag("r"))
+    progress.done(tag("python"), failed=True)
+    progress.finish()
+    out, _ = capsys.readouterr()
+    assert out.splitlines() == [
+        f"[1/2] {tag('r')}: done",
+        f"[2/2] {tag('python')}: failed",
+    ]
+
+
+def test_get_actions_from_project_file_dedupes_images(tmp_path):
+    project_yaml = tmp_path / "project.yaml"
+    project_yaml.write_text(
+        """
+version: '3.0'
+actions:
+  a:
+    run: python:latest python a.py
+  b:
+    run: r:latest analysis.R
+  c:
+    run: python:v1 python c.py
+"""
+    )
+    assert pull.get_actions_from_project_file(project_yaml) == ["python", "r"]
+
+
 def test_remove_deprecated_images(run):
     local_images = set(
         [
@@ -122,15 +256,15 @@ def test_remove_deprecated_images(run):
 def test_check_version_out_of_date(run, capsys):
 
     run.expect(
-        ["docker", "images", "ghcr.io/opensafely-core/*", "--no-trunc", "--format={{.Repository}}={{.ID}}"], 
-        stdout="ghcr.io/opensafely-core/python=sha256:oldsha"
+        ["docker", "images", f"{pull.REGISTRY}/*", "--no-trunc", "--format={{.Repository}}={{.ID}}"], 
+        stdout=f"{pull.REGISTRY}/python=sha256:oldsha"
     )
 
     assert len(pull.check_version()) == 1
     out, err = capsys.readouterr()
     assert err == ""
     assert out.splitlines() == [
-        "Warning: the OpenSAFELY docker images for python actions are out of date - please update by running:",
+        "Warning: the MediciaSAFELY docker images for python actions are out of date - please update by running:",
         "    opensafely pull",
         "",
     ]
@@ -138,12 +272,12 @@ def test_check_version_out_of_date(run, capsys):
 
 def test_check_version_up_to_date(run, capsys):
 
-    current_sha = pull.get_remote_sha("ghcr.io/opensafely-core/python", "latest")
+    current_sha = pull.get_remote_sha(f"{pull.REGISTRY}/python", "latest")
     pull.token = None
 
     run.expect(
-        ["docker", "images", "ghcr.io/opensafely-core/*", "--no-trunc", "--format={{.Repository}}={{.ID}}"], 
-        stdout=f"ghcr.io/opensafely-core/python={current_sha}"
+        ["docker", "images", f"{pull.REGISTRY}/*", "--no-trunc", "--format={{.Repository}}={{.ID}}"], 
+        stdout=f"{pull.REGISTRY}/python={current_sha}"
     )
 
     assert len(pull.check_version()) == 0
@@ -152,6 +286,51 @@ def test_check_version_up_to_date(run, capsys):
     assert out.splitlines() == []
 
 
+class FakeDockerAPIClient:
+    def __init__(self, images):
+        self.images = images
+
+    def request(self, method, path, params=None):
+        assert (method, path) == ("GET", "/images/json")
+        assert json.loads(params["filters"]) == {"reference": [f"{pull.REGISTRY}/*"]}
+        return pull.docker_api.Response(200, json.dumps(self.images).encode())
+
+
+def test_get_local_images_from_api(monkeypatch):
+    client = FakeDockerAPIClient(
+        [
+            {"Id": "sha256:r", "RepoTags": [f"{pull.REGISTRY}/r:latest"]},
+            {"Id": "sha256:python-v1", "RepoTags": [f"{pull.REGISTRY}/python:v1"]},
+            {"Id": "sha256:python", "RepoTags": [f"{pull.REGISTRY}/python:latest"]},
+            {"Id": "sha256:other", "RepoTags": [f"{pull.REGISTRY}/other:latest"]},
+            {"Id": "sha256:untagged", "RepoTags": None},
+        ]
+    )
+    monkeypatch.setattr(pull.docker_api, "get_client", lambda: client)
+    assert pull.get_local_images() == {
+        f"{pull.REGISTRY}/r": "sha256:r",
+        f"{pull.REGISTRY}/python": "sha256:python",
+    }
+
+
+def test_get_version_warning(run, monkeypatch):
+    def get_digest(self, repository, tag, max_age=None):
+        assert repository == "mediciaai/python"
+        assert max_age == pull.DIGEST_CACHE_TTL
+        return "sha256:new"
+
+    monkeypatch.setattr(pull.registry.RegistryClient, "get_digest", get_digest)
+    run.expect(
+        ["docker", "images", f"{pull.REGISTRY}/*", "--no-trunc", "--format={{.Repository}}={{.ID}}"],
+        stdout=f"{pull.REGISTRY}/python=sha256:old",
+    )
+
+    assert pull.get_version_warning().splitlines() == [
+        "Warning: the MediciaSAFELY docker images for python actions are out of date - please update by running:",
+        "    opensafely pull",
+    ]
+
+
 @pytest.mark.parametrize(
     "project_yaml,exc_msg",
     [
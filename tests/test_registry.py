@@ -0,0 +1,212 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from opensafely import registry
+
+TOKEN = "test-token"
+
+
+class FakeRegistry:
+    """
+    Stand-in for a docker registry which serves image manifests, requiring a
+    token for them as real registries do, and records the requests it gets
+    """
+
+    def __init__(self):
+        self.digests = {}
+        self.expires_in = 300
+        # Answer every manifest request with 304, as a misbehaving cache might
+        self.always_not_modified = False
+        self.tokens_issued = 0
+        self.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class())
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+        )
+
+    def handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def handle(self, request):
+        path = request.path.partition("?")[0]
+        if path == "/token":
+            self.tokens_issued += 1
+            self.requests.append(("token", 200))
+            token = f"{TOKEN}-{self.tokens_issued}"
+            self.respond(request, 200, {"token": token, "expires_in": self.expires_in})
+            return
+
+        repository, _, tag = path[len("/v2/") :].rpartition("/manifests/")
+        authorization = request.headers.get("Authorization", "")
+        if not authorization.startswith(f"Bearer {TOKEN}"):
+            self.requests.append((repository, 401))
+            challenge = (
+                f'Bearer realm="{self.url}/token",service="test",'
+                f'scope="repository:{repository}:pull"'
+            )
+            self.respond(request, 401, {}, {"WWW-Authenticate": challenge})
+            return
+
+        digest = self.digests.get(f"{repository}:{tag}")
+        if digest is None:
+            self.requests.append((repository, 404))
+            self.respond(request, 404, {"errors": [{"code": "MANIFEST_UNKNOWN"}]})
+            return
+        etag = f'"{digest}"'
+        if self.always_not_modified or request.headers.get("If-None-Match") == etag:
+            self.requests.append((repository, 304))
+            self.respond(request, 304, None, {"ETag": etag})
+            return
+        self.requests.append((repository, 200))
+        self.respond(request, 200, {"config": {"digest": digest}}, {"ETag": etag})
+
+    def respond(self, request, status, body, headers=None):
+        request.send_response(status)
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        if body is None:
+            request.end_headers()
+            return
+        data = json.dumps(body).encode("utf-8")
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+
+@pytest.fixture
+def fake_registry():
+    fake = FakeRegistry()
+    fake.thread.start()
+    yield fake
+    fake.server.shutdown()
+    fake.server.server_close()
+
+
+@pytest.fixture
+def cache_file(tmp_path):
+    yield tmp_path / "digests.json"
+
+
+IMAGES = ["cohortextractor", "databuilder", "jupyter", "python", "r", "stata-mp"]
+
+
+def test_get_digest(fake_registry):
+    fake_registry.digests["mediciaai/python:latest"] = "sha256:python"
+    client = registry.RegistryClient(fake_registry.url)
+    assert client.get_digest("mediciaai/python", "latest") == "sha256:python"
+    assert fake_registry.requests == [
+        ("mediciaai/python", 401),
+        ("token", 200),
+        ("mediciaai/python", 200),
+    ]
+
+
+def test_get_digest_many_images_one_token(fake_registry, cache_file):
+    for image in IMAGES:
+        fake_registry.digests[f"mediciaai/{image}:latest"] = f"sha256:{image}"
+
+    client = registry.RegistryClient(fake_registry.url, cache_file=cache_file)
+    for image in IMAGES:
+        assert client.get_digest(f"mediciaai/{image}") == f"sha256:{image}"
+    assert fake_registry.tokens_issued == 1
+
+    # A later invocation revalidates the cached digests, which haven't changed
+    fake_registry.requests = []
+    client = registry.RegistryClient(fake_registry.url, cache_file=cache_file)
+    for image in IMAGES:
+        assert client.get_digest(f"mediciaai/{image}") == f"sha256:{image}"
+    assert fake_registry.requests == [
+        ("mediciaai/cohortextractor", 401),
+        ("token", 200),
+    ] + [(f"mediciaai/{image}", 304) for image in IMAGES]
+
+
+def test_get_digest_changed(fake_registry, cache_file):
+    fake_registry.digests["mediciaai/r:latest"] = "sha256:old"
+    client = registry.RegistryClient(fake_registry.url, cache_file=cache_file)
+    assert client.get_digest("mediciaai/r") == "sha256:old"
+
+    fake_registry.digests["mediciaai/r:latest"] = "sha256:new"
+    assert client.get_digest("mediciaai/r") == "sha256:new"
+    assert fake_registry.requests[-1] == ("mediciaai/r", 200)
+    cache = json.loads(cache_file.read_text())
+    assert cache["mediciaai/r:latest"]["digest"] == "sha256:new"
+    assert cache["mediciaai/r:latest"]["etag"] == '"sha256:new"'
+
+
+def test_get_digest_max_age(fake_registry, cache_file):
+    fake_registry.digests["mediciaai/r:latest"] = "sha256:r"
+    client = registry.RegistryClient(fake_registry.url, cache_file=cache_file)
+    assert client.get_digest("mediciaai/r", max_age=60) == "sha256:r"
+
+    # Fresh enough, so we don't ask the registry at all
+    fake_registry.requests = []
+    assert client.get_digest("mediciaai/r", max_age=60) == "sha256:r"
+    assert fake_registry.requests == []
+
+    # Too old, so we check it's still current
+    cache = json.loads(cache_file.read_text())
+    cache["mediciaai/r:latest"]["timestamp"] = time.time() - 120
+    cache_file.write_text(json.dumps(cache))
+    assert client.get_digest("mediciaai/r", max_age=60) == "sha256:r"
+    assert fake_registry.requests == [("mediciaai/r", 304)]
+
+
+def test_get_digest_token_expired(fake_registry):
+    fake_registry.digests["mediciaai/r:latest"] = "sha256:r"
+    # Already expired once we allow for the margin
+    fake_registry.expires_in = registry.TOKEN_EXPIRY_MARGIN
+    client = registry.RegistryClient(fake_registry.url)
+    client.get_digest("mediciaai/r")
+    client.get_digest("mediciaai/r")
+    assert fake_registry.tokens_issued == 2
+
+
+def test_get_digest_corrupt_cache(fake_registry, cache_file):
+    fake_registry.digests["mediciaai/r:latest"] = "sha256:r"
+    cache_file.write_text("not json")
+    client = registry.RegistryClient(fake_registry.url, cache_file=cache_file)
+    assert client.get_digest("mediciaai/r") == "sha256:r"
+    assert json.loads(cache_file.read_text())["mediciaai/r:latest"]["digest"] == (
+        "sha256:r"
+    )
+
+
+def test_get_digest_not_found(fake_registry):
+    client = registry.RegistryClient(fake_registry.url)
+    with pytest.raises(requests.HTTPError):
+        client.get_digest("mediciaai/missing")
+
+
+def test_get_digest_not_modified_without_cache(fake_registry, cache_file):
+    fake_registry.digests["mediciaai/r:latest"] = "sha256:r"
+    fake_registry.always_not_modified = True
+    client = registry.RegistryClient(fake_registry.url, cache_file=cache_file)
+    with pytest.raises(requests.HTTPError, match="304"):
+        client.get_digest("mediciaai/r")
+    assert not cache_file.exists()
+
+
+def test_parse_challenge():
+    header = 'Bearer realm="https://ghcr.io/token",service="ghcr.io",scope="repository:mediciaai/busybox:pull"'
+    assert registry.parse_challenge(header) == {
+        "realm": "https://ghcr.io/token",
+        "service": "ghcr.io",
+        "scope": "repository:mediciaai/busybox:pull",
+    }